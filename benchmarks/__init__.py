@@ -0,0 +1,29 @@
+from lazy_build import cache
+from lazy_build import config
+
+
+def make_config(**kwargs):
+    """Return a Config suitable for driving the library directly."""
+    return config.Config(
+        action='build',
+        dry_run=False,
+        verbose=False,
+        context=frozenset(),
+        command=('true',),
+        ignore=frozenset(),
+        output=frozenset(),
+        backend=cache.FilesystemBackend(path='cache'),
+        after_download=(),
+        jobs=1,
+        hash_algorithm='sha256',
+        compression='none',
+        compression_level=None,
+        streaming=False,
+        stream_buffer_size=2**20,
+        delta_restore=False,
+        targets=(),
+        parallel_targets=4,
+        trace=None,
+        profile=None,
+        single_flight=None,
+    )._replace(**kwargs)
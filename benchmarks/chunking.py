@@ -0,0 +1,108 @@
+"""Benchmark bytes transferred by chunked storage for successive builds.
+
+Simulates a virtualenv being rebuilt with one package upgraded and one
+added: every file is rewritten (so timestamps change), but almost all of the
+contents are identical. Compares the bytes uploaded and downloaded with and
+without chunking.
+
+Usage: python -m benchmarks.chunking [--packages N] [--compression CODEC]
+"""
+import argparse
+import os
+import random
+import tempfile
+
+from benchmarks import make_config
+from lazy_build import cache
+from lazy_build import context
+
+
+def write_package(root, name, seed):
+    rand = random.Random(seed)
+    for i in range(rand.randrange(5, 60)):
+        path = os.path.join(root, 'venv', name, f'module{i}.py')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(rand.getrandbits(8 * 1024).to_bytes(1024, 'little') * (
+                rand.randrange(1, 40)
+            ))
+
+
+def write_venv(root, packages):
+    for name, seed in packages.items():
+        write_package(root, name, seed)
+
+
+def dir_size(path):
+    return sum(
+        entry.stat().st_size
+        for entry in os.scandir(path)
+        if entry.is_file()
+    )
+
+
+class Counter:
+
+    def __init__(self):
+        self.total = 0
+
+    def __call__(self, num_bytes):
+        self.total += num_bytes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packages', type=int, default=100)
+    parser.add_argument('--compression', default='gzip')
+    args = parser.parse_args(argv)
+
+    builds = {f'package{i}': i for i in range(args.packages)}
+    second = dict(builds, package0=-1, newpackage=-2)
+
+    with tempfile.TemporaryDirectory() as root:
+        os.chdir(root)
+        remote = os.path.join(root, 'remote')
+        local = os.path.join(root, 'local')
+        conf = make_config(output={'venv'}, compression=args.compression)
+        backend = cache.ChunkedBackend(
+            cache.ChainBackend((
+                cache.FilesystemBackend(local),
+                cache.FilesystemBackend(remote),
+            )),
+            compression=args.compression,
+        )
+
+        print(f'{"":>8} {"full artifact":>14} {"uploaded":>12} '
+              f'{"downloaded":>12}')
+        for i, packages in enumerate((builds, second)):
+            context.remove_outputs(conf)
+            write_venv(root, packages)
+            ctx = context.BuildContext(('build', str(i)), {}, 'sha256')
+
+            path = context.package_artifact(conf)
+            full = os.path.getsize(path)
+            os.remove(path)
+
+            path = context.package_artifact(conf._replace(compression='none'))
+            uploaded = Counter()
+            # Upload straight to the remote cache, as another host would.
+            backend._replace(
+                backend=backend.backend.backends[1],
+            ).store_artifact(ctx, path, uploaded)
+            os.remove(path)
+
+            # Download on this host, which has the previous build cached.
+            before = dir_size(local) if os.path.exists(local) else 0
+            with backend.get_artifact(ctx, lambda n: None):
+                pass
+            downloaded = dir_size(local) - before
+
+            print(
+                f'build {i + 1:<2} {full / 2**20:>12.2f}MB '
+                f'{uploaded.total / 2**20:>10.2f}MB '
+                f'{downloaded / 2**20:>10.2f}MB',
+            )
+
+
+if __name__ == '__main__':
+    exit(main())
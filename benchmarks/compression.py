@@ -0,0 +1,81 @@
+"""Benchmark matrix of compression ratio vs. pack/unpack speed.
+
+By default this packages a freshly created virtualenv (with pip), which is
+fairly representative of real artifacts; pass --source to use any directory.
+
+Usage: python -m benchmarks.compression [--source DIR]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import make_config
+from lazy_build import compression
+from lazy_build import context
+
+
+MATRIX = (
+    ('none', None),
+    ('gzip', 1),
+    ('gzip', 6),
+    ('bz2', 9),
+    ('xz', 0),
+    ('xz', 6),
+    ('zstd', 1),
+    ('zstd', 3),
+    ('zstd', 9),
+    ('zstd', 19),
+    ('lz4', 0),
+    ('lz4', 9),
+)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as root:
+        output = os.path.join(root, 'venv')
+        if args.source:
+            shutil.copytree(args.source, output, symlinks=True)
+        else:
+            subprocess.run((sys.executable, '-m', 'venv', output), check=True)
+        os.chdir(root)
+
+        conf = make_config(output=frozenset(('venv',)), jobs=args.jobs)
+        raw = None
+        print('{:<6} {:>5} {:>10} {:>7} {:>10} {:>10}'.format(
+            'codec', 'level', 'size', 'ratio', 'pack MB/s', 'unpack MB/s',
+        ))
+        for codec, level in MATRIX:
+            if not compression.CODECS[codec].available:
+                print(f'{codec:<6} (not installed)')
+                continue
+
+            conf = conf._replace(compression=codec, compression_level=level)
+            start = time.perf_counter()
+            path = context.package_artifact(conf)
+            pack = time.perf_counter() - start
+            try:
+                size = os.path.getsize(path)
+                raw = raw or size
+                start = time.perf_counter()
+                context.extract_artifact(conf, path, codec)
+                unpack = time.perf_counter() - start
+            finally:
+                os.remove(path)
+
+            print('{:<6} {:>5} {:>10} {:>7.2f} {:>10.1f} {:>10.1f}'.format(
+                codec, str(level), size, raw / size,
+                raw / pack / 2**20, raw / unpack / 2**20,
+            ))
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,108 @@
+"""Benchmark build context discovery on a large synthetic tree.
+
+Compares the original listdir/isdir/islink walk against find_files. If strace
+is installed, also counts the syscalls each one makes.
+
+Usage: python -m benchmarks.discovery [--files N]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from lazy_build import context
+
+
+PATTERNS = frozenset(('*.pyc', '__pycache__', '.git', 'node_modules/.cache'))
+
+
+def make_tree(root, files, per_dir=100):
+    for i in range(files):
+        d = os.path.join(root, 'pkg{}'.format(i // per_dir // 10))
+        d = os.path.join(d, 'mod{}'.format(i // per_dir))
+        if i % per_dir == 0:
+            os.makedirs(os.path.join(d, '__pycache__'))
+        open(os.path.join(d, 'file{}.py'.format(i)), 'w').close()
+        pyc = os.path.join(d, '__pycache__', 'file{}.pyc'.format(i))
+        open(pyc, 'w').close()
+
+
+def legacy_find_files(paths, matcher):
+    """The original fringe walk, kept here for comparison."""
+    fringe = {os.path.relpath(os.path.realpath(path)) for path in paths}
+    while len(fringe) > 0:
+        path = fringe.pop()
+        is_dir = os.path.isdir(path) and not os.path.islink(path)
+        if matcher(path, is_dir):
+            continue
+        if is_dir:
+            for child in os.listdir(path):
+                fringe.add(os.path.relpath(os.path.join(path, child)))
+        else:
+            yield path, os.path.islink(path)
+
+
+IMPLEMENTATIONS = {
+    'legacy': legacy_find_files,
+    'find_files': context.find_files,
+}
+
+
+def run(name):
+    matcher = context.IgnoreMatcher(PATTERNS)
+    start = time.perf_counter()
+    count = sum(1 for _ in IMPLEMENTATIONS[name]({'.'}, matcher))
+    return count, time.perf_counter() - start
+
+
+def count_syscalls(name):
+    if shutil.which('strace') is None:
+        return None
+    result = subprocess.run(
+        (
+            'strace', '-f', '-c', '-o', '/dev/stderr',
+            sys.executable, '-m', 'benchmarks.discovery', '--child', name,
+        ),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        env=dict(os.environ, PYTHONPATH=os.getcwd()),
+        cwd=os.getcwd(),
+        check=True,
+    )
+    total_line = result.stderr.decode().strip().splitlines()[-1]
+    # % time, seconds, usecs/call, calls, errors, 'total'
+    return int(total_line.split()[3])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        os.chdir(os.environ['BENCH_TREE'])
+        run(args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, args.files)
+        os.environ['BENCH_TREE'] = root
+        for name in IMPLEMENTATIONS:
+            syscalls = count_syscalls(name)
+            cwd = os.getcwd()
+            os.chdir(root)
+            try:
+                count, elapsed = run(name)
+            finally:
+                os.chdir(cwd)
+            print('{:<12} {:>8} files {:8.3f}s  syscalls: {}'.format(
+                name, count, elapsed, syscalls or 'n/a (no strace)',
+            ))
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,53 @@
+"""Compare the throughput of the available per-file hash algorithms.
+
+Measures raw hashing speed on an in-memory buffer, and end-to-end
+build_context time on a synthetic tree.
+
+Usage: python -m benchmarks.hash_algorithms [--files N] [--size BYTES]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks import make_config
+from benchmarks.hashing import make_tree
+from lazy_build import context
+
+
+def best_of(repeat, func):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    buf = os.urandom(64 * 2**20)
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, args.files, args.size)
+        os.chdir(root)
+        total = args.files * args.size
+
+        print('{:<10} {:>14} {:>16}'.format(
+            'algorithm', 'memory MB/s', 'context MB/s',
+        ))
+        for algorithm in sorted(context.HASH_ALGORITHMS):
+            raw = best_of(args.repeat, lambda: context.hash(buf, algorithm))
+            conf = make_config(context={'.'}, hash_algorithm=algorithm)
+            ctx = best_of(args.repeat, lambda: context.build_context(conf))
+            print('{:<10} {:>14.1f} {:>16.1f}'.format(
+                algorithm, len(buf) / raw / 2**20, total / ctx / 2**20,
+            ))
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,53 @@
+"""Benchmark build_context hashing throughput across worker counts.
+
+Usage: python -m benchmarks.hashing [--files N] [--size BYTES]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks import make_config
+from lazy_build import context
+
+
+def make_tree(root, files, size):
+    data = os.urandom(size)
+    for i in range(files):
+        path = os.path.join(root, 'dir{}'.format(i % 100), 'file{}'.format(i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=256 * 1024)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, args.files, args.size)
+        os.chdir(root)
+        conf = make_config(context={'.'})
+        total = args.files * args.size
+
+        jobs = 1
+        expected = None
+        while jobs <= 2 * (os.cpu_count() or 1):
+            best = float('inf')
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                ctx = context.build_context(conf._replace(jobs=jobs))
+                best = min(best, time.perf_counter() - start)
+            expected = expected or ctx.hash
+            assert ctx.hash == expected, 'hash differs from the serial path'
+            print('jobs={:<3} {:8.3f}s {:8.1f} MB/s'.format(
+                jobs, best, total / best / 2**20,
+            ))
+            jobs *= 2
+
+
+if __name__ == '__main__':
+    exit(main())
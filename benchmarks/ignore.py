@@ -0,0 +1,78 @@
+"""Compare IgnoreMatcher against the original fnmatch-based should_ignore.
+
+Usage: python -m benchmarks.ignore [--paths N] [--depth N]
+"""
+import argparse
+import fnmatch
+import itertools
+import random
+import time
+
+from lazy_build import context
+
+
+PATTERNS = frozenset((
+    '*.py[co]', '*~', '.*.sw*', '.DS_Store', '.nfs*', '__pycache__',
+    '*.egg-info', '.tox', '.git', '/build', '/dist', 'node_modules/.cache',
+    '*.log', '.coverage', 'coverage-html', '*.orig', '*.rej', '.mypy_cache',
+    '.pytest_cache', 'tmp*',
+))
+
+
+def legacy_should_ignore(patterns, path):
+    """The original implementation, kept here for comparison."""
+    path = '/' + path
+    components = path.split('/')
+    paths = {
+        '/'.join(components[i:j + 1])
+        for i in range(len(components))
+        for j in range(len(components))
+    }
+    return any(
+        fnmatch.fnmatch(path, pattern)
+        for path, pattern in itertools.product(paths, patterns)
+    )
+
+
+def make_paths(count, depth):
+    rand = random.Random(0)
+    names = ['node_modules', 'lib', 'src', 'index.js', 'package.json', 'a.py']
+    return [
+        '/'.join(rand.choice(names) for _ in range(rand.randint(1, depth)))
+        for _ in range(count)
+    ]
+
+
+def timed(func, paths):
+    start = time.perf_counter()
+    results = [func(path) for path in paths]
+    return time.perf_counter() - start, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paths', type=int, default=5000)
+    parser.add_argument('--depth', type=int, default=12)
+    args = parser.parse_args(argv)
+
+    paths = make_paths(args.paths, args.depth)
+    legacy, expected = timed(
+        lambda path: legacy_should_ignore(PATTERNS, path), paths,
+    )
+    matcher = context.IgnoreMatcher(PATTERNS)
+    full, results = timed(matcher, paths)
+    assert results == expected, 'matchers disagree'
+    entry, _ = timed(matcher.matches, paths)
+
+    for name, elapsed in (
+            ('legacy should_ignore', legacy),
+            ('IgnoreMatcher (path + parents)', full),
+            ('IgnoreMatcher.matches (entry only)', entry),
+    ):
+        print('{:<36} {:8.3f}s {:10.2f} us/path'.format(
+            name, elapsed, elapsed / len(paths) * 1e6,
+        ))
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,105 @@
+"""Benchmark S3 upload/download throughput for different transfer settings.
+
+Runs against a local moto server (``pip install 'moto[server]'``), or any
+S3-compatible endpoint passed with --endpoint-url (e.g. MinIO). A local
+stand-in has no real network latency, so absolute numbers are optimistic;
+it's the relative cost of the settings that matters.
+
+Usage: python -m benchmarks.s3_transfer [--size MIB] [--endpoint-url URL]
+"""
+import argparse
+import contextlib
+import logging
+import os
+import tempfile
+import time
+
+from lazy_build import cache
+
+
+MATRIX = (
+    # (multipart_threshold, multipart_chunksize, max_concurrency)
+    (None, None, None),
+    (8 * 2**20, 8 * 2**20, 1),
+    (8 * 2**20, 8 * 2**20, 4),
+    (8 * 2**20, 8 * 2**20, 16),
+    (8 * 2**20, 32 * 2**20, 4),
+    (64 * 2**20, 64 * 2**20, 4),
+)
+
+
+@contextlib.contextmanager
+def moto_server():
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=0, verbose=False)
+    server.start()
+    try:
+        host, port = server.get_host_and_port()
+        yield f'http://{host}:{port}'
+    finally:
+        server.stop()
+
+
+def _fmt(setting):
+    return 'default' if setting is None else f'{setting // 2**20}M'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=128, help='MiB')
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--bucket', default='lazy-build-benchmark')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    with contextlib.ExitStack() as stack:
+        if args.endpoint_url:
+            endpoint_url = args.endpoint_url
+        else:
+            endpoint_url = stack.enter_context(moto_server())
+        tmp = stack.enter_context(tempfile.TemporaryDirectory())
+
+        src = os.path.join(tmp, 'artifact.tar')
+        with open(src, 'wb') as f:
+            for _ in range(args.size):
+                f.write(os.urandom(2**20))
+
+        cache._s3_client(endpoint_url, 10).create_bucket(Bucket=args.bucket)
+
+        print(
+            f'{"threshold":>10} {"part size":>10} {"threads":>8} '
+            f'{"upload":>12} {"download":>12}',
+        )
+        for i, (threshold, chunksize, concurrency) in enumerate(MATRIX):
+            backend = cache.S3Backend(
+                bucket=args.bucket,
+                path='benchmark',
+                endpoint_url=endpoint_url,
+                multipart_threshold=threshold,
+                multipart_chunksize=chunksize,
+                max_concurrency=concurrency,
+            )
+            ctx = type('Ctx', (), {'hash': str(i)})
+
+            start = time.monotonic()
+            backend.store_artifact(ctx, src, lambda n: None)
+            upload = time.monotonic() - start
+
+            start = time.monotonic()
+            with backend.get_artifact(ctx, lambda n: None):
+                download = time.monotonic() - start
+
+            print(
+                f'{_fmt(threshold):>10} {_fmt(chunksize):>10} '
+                f'{concurrency or "default":>8} '
+                f'{args.size / upload:>8.1f}MB/s '
+                f'{args.size / download:>8.1f}MB/s',
+            )
+
+
+if __name__ == '__main__':
+    exit(main())
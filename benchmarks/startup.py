@@ -0,0 +1,148 @@
+"""Benchmark CLI startup: import time, and a warm no-op build.
+
+Every invocation pays for importing lazy-build before it can do anything,
+including runs where the outputs are already up to date. This reports the
+cumulative import time of lazy_build.main (from `python -X importtime`) along
+with its slowest imports, and the wall-clock time of a warm no-op build using
+a filesystem cache.
+
+It exits non-zero if lazy_build.main imports any of the --forbid modules
+(boto3 and botocore by default), or takes longer than --max-import-ms to
+import, so it can guard against regressions.
+
+Usage: python -m benchmarks.startup [--runs N] [--max-import-ms MS]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import lazy_build
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(lazy_build.__file__)))
+
+BUILD_ARGS = (
+    'build',
+    'context=', 'input',
+    'output=', 'output',
+    'command=', 'cp', 'input', 'output',
+)
+
+
+def python(*args, env=None, **kwargs):
+    env = dict(env or os.environ, PYTHONPATH=ROOT)
+    return subprocess.run(
+        (sys.executable,) + args,
+        env=env,
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        **kwargs
+    )
+
+
+def import_times():
+    """Return {module: cumulative microseconds} for importing lazy_build.main.
+
+    Only modules imported by lazy_build.main itself are included, not those
+    imported by the interpreter's startup (e.g. site).
+    """
+    proc = python('-X', 'importtime', '-c', 'import lazy_build.main')
+    times = {}
+    for line in proc.stderr.decode('UTF-8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('| ')
+        # Children are listed (indented) before their parent.
+        if name.startswith(' ') or name == 'lazy_build.main':
+            times[name.strip()] = int(cumulative)
+            if name == 'lazy_build.main':
+                break
+        else:
+            times.clear()
+    return times
+
+
+def time_noop_builds(runs):
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, '.lazy-build.json'), 'w') as f:
+            json.dump({'cache': {'source': 'filesystem', 'path': 'cache'}}, f)
+        with open(os.path.join(tmp, 'input'), 'w') as f:
+            f.write('input\n')
+        os.mkdir(os.path.join(tmp, 'cache'))
+
+        env = dict(os.environ, XDG_CACHE_HOME=os.path.join(tmp, 'xdg'))
+        script = 'from lazy_build import main; main.main()'
+        # The first run builds, the second writes a stamp which isn't racy
+        # by the time the timed runs start.
+        for _ in range(2):
+            python('-c', script, *BUILD_ARGS, cwd=tmp, env=env)
+            time.sleep(0.05)
+
+        timings = []
+        for _ in range(runs):
+            start = time.monotonic()
+            proc = python('-c', script, *BUILD_ARGS, cwd=tmp, env=env)
+            timings.append(time.monotonic() - start)
+        assert b'already up to date' in proc.stderr, proc.stderr
+        return timings
+
+
+def python_startup(runs):
+    timings = []
+    for _ in range(runs):
+        start = time.monotonic()
+        python('-c', 'pass')
+        timings.append(time.monotonic() - start)
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--max-import-ms', type=float)
+    parser.add_argument(
+        '--forbid', action='append', default=None,
+        help='module which must not be imported (default: boto3, botocore)',
+    )
+    args = parser.parse_args(argv)
+    forbidden = args.forbid or ['boto3', 'botocore']
+
+    times = import_times()
+    total_ms = times['lazy_build.main'] / 1000
+    print(f'import lazy_build.main: {total_ms:.1f} ms cumulative')
+    print('slowest imports:')
+    slowest = sorted(times.items(), key=lambda item: -item[1])
+    for name, us in slowest[:args.top]:
+        print(f'  {us / 1000:8.1f} ms  {name}')
+
+    baseline = statistics.median(python_startup(args.runs))
+    noop = time_noop_builds(args.runs)
+    print(f'python -c pass: {baseline * 1000:.1f} ms (median)')
+    print(
+        'no-op build: {:.1f} ms (median), {:.1f} ms (min)'.format(
+            statistics.median(noop) * 1000, min(noop) * 1000,
+        ),
+    )
+
+    status = 0
+    imported = sorted({
+        name.split('.')[0] for name in times
+    }.intersection(forbidden))
+    if imported:
+        print('FAIL: imported {}'.format(', '.join(imported)))
+        status = 1
+    if args.max_import_ms is not None and total_ms > args.max_import_ms:
+        print(f'FAIL: import took longer than {args.max_import_ms} ms')
+        status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
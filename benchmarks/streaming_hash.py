@@ -0,0 +1,52 @@
+"""Show that peak RSS while hashing stays flat as the input file grows.
+
+Each size is hashed in a fresh interpreter (using a sparse file, so this
+doesn't need much disk) which reports its own peak RSS.
+
+Usage: python -m benchmarks.streaming_hash [SIZE_MB ...]
+"""
+import subprocess
+import sys
+import tempfile
+
+
+CHILD = '''\
+import resource, sys, time
+from lazy_build import context
+start = time.perf_counter()
+if len(sys.argv) > 1:
+    context.FileContext.from_path(sys.argv[1])
+print(
+    time.perf_counter() - start,
+    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+)
+'''
+
+
+def measure(*args):
+    result = subprocess.run(
+        (sys.executable, '-c', CHILD) + args,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    elapsed, rss = result.stdout.decode().split()
+    return float(elapsed), int(rss)
+
+
+def main(argv=None):
+    sizes = [int(arg) for arg in (argv or sys.argv[1:])] or [
+        16, 256, 1024, 4096,
+    ]
+    print('interpreter baseline: peak RSS {:>8} KiB'.format(measure()[1]))
+
+    for size in sizes:
+        with tempfile.NamedTemporaryFile() as f:
+            f.truncate(size * 2**20)
+            elapsed, rss = measure(f.name)
+        print('{:>6} MiB: peak RSS {:>8} KiB  {:7.1f} MB/s'.format(
+            size, rss, size / elapsed,
+        ))
+
+
+if __name__ == '__main__':
+    exit(main())
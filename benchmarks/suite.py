@@ -0,0 +1,362 @@
+"""Benchmark suite for the hot paths, with comparison against a baseline.
+
+Generates synthetic trees (many small files, a few huge files, deep paths,
+and a tree with many ignore patterns) and times each phase on them:
+
+    hash (cold)   build_context with an empty hash index
+    hash (warm)   build_context with a populated hash index
+    ignore        IgnoreMatcher on every path in the tree
+    package       package_artifact
+    extract       extract_artifact
+    fs store/get  FilesystemBackend transfers (get includes reading the
+                  artifact back)
+    s3 store/get  S3Backend transfers against a local moto server (skipped if
+                  moto isn't installed, or with --no-s3)
+
+Each phase runs --repeat times and the fastest run is reported, along with
+its throughput. Results can be saved with --save and compared against later
+with --baseline: phases slower than the baseline by more than --tolerance are
+reported as regressions (ignoring differences under NOISE_FLOOR seconds), and
+the exit status is non-zero.
+
+Trees are generated from a fixed seed, so runs are comparable; --scale
+multiplies the number and size of files.
+
+Usage: python -m benchmarks.suite [--scale X] [--repeat N] [--only NAME]
+                                  [--save FILE] [--baseline FILE]
+"""
+import argparse
+import collections
+import contextlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks import make_config
+from benchmarks.s3_transfer import moto_server
+from lazy_build import cache
+from lazy_build import context
+from lazy_build import hashcache
+
+
+Key = collections.namedtuple('Key', ('hash',))
+
+# Differences smaller than this are noise, however large they are relatively.
+NOISE_FLOOR = 0.005
+
+
+def _write(path, size, rand):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        # Random blocks repeated a few times, so the data is somewhat
+        # compressible but not trivially so.
+        block = rand.getrandbits(8 * 4096).to_bytes(4096, 'little')
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def small_files(root, scale, rand):
+    for i in range(int(20000 * scale)):
+        path = os.path.join(
+            root, f'pkg{i // 1000}', f'mod{i // 50}', f'file{i}.py',
+        )
+        _write(path, rand.randrange(100, 4096), rand)
+
+
+def huge_files(root, scale, rand):
+    for i in range(4):
+        path = os.path.join(root, f'blob{i}.bin')
+        _write(path, int(64 * 2**20 * scale), rand)
+
+
+def deep_paths(root, scale, rand):
+    for i in range(int(2000 * scale)):
+        depth = rand.randrange(10, 30)
+        parts = [f'd{rand.randrange(3)}' for _ in range(depth)]
+        _write(os.path.join(root, *parts, f'file{i}.txt'), 512, rand)
+
+
+# Patterns for the many-ignores tree; about a third of the files match one.
+IGNORE_PATTERNS = frozenset(
+    [f'*.ext{i}' for i in range(100)] +
+    [f'/tree/gen{i}' for i in range(50)] +
+    [f'cache{i}/' for i in range(50)] +
+    ['!*.ext0', '**/keep/*.ext1']
+)
+
+
+def many_ignores(root, scale, rand):
+    for i in range(int(10000 * scale)):
+        kind = rand.randrange(3)
+        if kind == 0:
+            name = f'file{i}.ext{rand.randrange(120)}'
+        elif kind == 1:
+            name = os.path.join(f'cache{rand.randrange(60)}', f'file{i}')
+        else:
+            name = f'file{i}.py'
+        path = os.path.join(root, f'gen{rand.randrange(70)}', name)
+        _write(path, 256, rand)
+
+
+TREES = collections.OrderedDict((
+    ('small-files', (small_files, frozenset())),
+    ('huge-files', (huge_files, frozenset())),
+    ('deep-paths', (deep_paths, frozenset())),
+    ('many-ignores', (many_ignores, IGNORE_PATTERNS)),
+))
+
+
+@contextlib.contextmanager
+def chdir(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+Result = collections.namedtuple('Result', ('seconds', 'amount', 'unit'))
+
+
+def best_of(repeat, func, setup=None):
+    """Return the fastest of `repeat` runs of func()."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def tree_stats(root):
+    paths, size = [], 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames:
+            paths.append((os.path.join(dirpath, name), True))
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            paths.append((path, False))
+            size += os.path.getsize(path)
+    return paths, size
+
+
+def bench_tree(name, conf, repeat, backends):
+    """Yield (phase, Result) for each phase on the tree in ./tree."""
+    paths, size = tree_stats('tree')
+    files = sum(1 for _, is_dir in paths if not is_dir)
+
+    index = os.path.abspath('index.json')
+
+    def hash_tree():
+        context.build_context(
+            conf, hashcache.HashCache.load(index, conf.hash_algorithm),
+        )
+
+    def remove_index():
+        if os.path.exists(index):
+            os.remove(index)
+
+    yield 'hash (cold)', Result(
+        best_of(repeat, hash_tree, remove_index), size, 'B',
+    )
+
+    hash_cache = hashcache.HashCache.load(index, conf.hash_algorithm)
+    context.build_context(conf, hash_cache)
+    hash_cache.save()
+    yield 'hash (warm)', Result(best_of(repeat, hash_tree), files, 'files')
+
+    matcher = context.IgnoreMatcher(conf.ignore)
+    yield 'ignore', Result(
+        best_of(repeat, lambda: [matcher(*path) for path in paths]),
+        len(paths),
+        'paths',
+    )
+
+    artifacts = []
+
+    def package():
+        artifacts.append(context.package_artifact(conf, '.'))
+
+    yield 'package', Result(best_of(repeat, package), size, 'B')
+    artifact = artifacts.pop()
+    for path in artifacts:
+        os.remove(path)
+    artifact_size = os.path.getsize(artifact)
+
+    def clear_restore():
+        if os.path.exists('restore'):
+            shutil.rmtree('restore')
+        os.mkdir('restore')
+
+    def extract():
+        with chdir('restore'):
+            context.extract_artifact(
+                conf, os.path.join('..', artifact), conf.compression,
+            )
+
+    yield 'extract', Result(best_of(repeat, extract, clear_restore), size, 'B')
+    shutil.rmtree('restore')
+
+    for backend_name, backend in backends:
+        ctx = Key(f'{name}-{os.getpid()}')
+        yield f'{backend_name} store', Result(
+            best_of(
+                repeat,
+                lambda: backend.store_artifact(
+                    ctx, artifact, lambda n: None, conf.compression,
+                ),
+            ),
+            artifact_size,
+            'B',
+        )
+
+        def get():
+            # The filesystem backend hands out the cached file itself, so
+            # nothing is transferred until it's read.
+            with backend.get_artifact(ctx, lambda n: None) as path:
+                with open(path, 'rb') as f:
+                    while f.read(2**20):
+                        pass
+
+        yield f'{backend_name} get', Result(
+            best_of(repeat, get), artifact_size, 'B',
+        )
+    os.remove(artifact)
+
+
+@contextlib.contextmanager
+def s3_backend(enabled):
+    """Yield an S3Backend on a local moto server, or None if unavailable."""
+    if not enabled:
+        yield None
+        return
+    try:
+        import moto.server  # noqa: F401
+    except ImportError:
+        print('(moto is not installed; skipping S3)', file=sys.stderr)
+        yield None
+        return
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto_server() as endpoint_url:
+        cache._s3_client(endpoint_url, 10).create_bucket(
+            Bucket='lazy-build-benchmark',
+        )
+        yield cache.S3Backend(
+            bucket='lazy-build-benchmark',
+            path='suite',
+            endpoint_url=endpoint_url,
+        )
+
+
+def format_amount(result):
+    rate = result.amount / result.seconds
+    if result.unit == 'B':
+        return f'{rate / 2**20:10.1f} MB/s'
+    return f'{rate:10.0f} {result.unit}/s'
+
+
+def compare(results, baseline, tolerance):
+    """Print a comparison table and return the names of regressed phases."""
+    regressions = []
+    print()
+    print(f'{"benchmark":<34} {"baseline":>10} {"now":>10} {"change":>8}')
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['seconds']
+        change = result.seconds / before - 1
+        flag = ''
+        if change > tolerance and result.seconds - before > NOISE_FLOOR:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(
+            f'{name:<34} {before:>9.3f}s {result.seconds:>9.3f}s '
+            f'{change:>+7.1%}{flag}',
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', action='append', choices=list(TREES))
+    parser.add_argument('--compression', default='none')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--no-s3', action='store_true')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against saved results')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.1,
+        help='slowdown (as a fraction) counted as a regression',
+    )
+    args = parser.parse_args(argv)
+
+    cwd = os.getcwd()
+    results = collections.OrderedDict()
+    with contextlib.ExitStack() as stack:
+        tmp = stack.enter_context(tempfile.TemporaryDirectory())
+        stack.callback(os.chdir, cwd)
+        backends = [(
+            'fs',
+            cache.FilesystemBackend(path=os.path.join(tmp, 'cache')),
+        )]
+        s3 = stack.enter_context(s3_backend(not args.no_s3))
+        if s3 is not None:
+            backends.append(('s3', s3))
+
+        print(f'{"benchmark":<34} {"time":>9} {"throughput":>16}')
+        for name in args.only or TREES:
+            make_tree, ignore = TREES[name]
+            root = os.path.join(tmp, name)
+            os.makedirs(root)
+            os.chdir(root)
+            make_tree('tree', args.scale, random.Random(0))
+            conf = make_config(
+                context=frozenset(('tree',)),
+                output=frozenset(('tree',)),
+                ignore=ignore,
+                jobs=args.jobs,
+                compression=args.compression,
+            )
+            for phase, result in bench_tree(
+                    name, conf, args.repeat, backends,
+            ):
+                key = f'{name}: {phase}'
+                results[key] = result
+                print(
+                    f'{key:<34} {result.seconds:>8.3f}s '
+                    f'{format_amount(result):>16}',
+                    flush=True,
+                )
+            os.chdir(tmp)
+            shutil.rmtree(root)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(
+                {name: result._asdict() for name, result in results.items()},
+                f,
+                indent=2,
+            )
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -1,26 +1,184 @@
 import collections
+import concurrent.futures
+import contextlib
+import errno
+import functools
+import hashlib
+import io
+import json
 import os
+import socket
 import tempfile
+import threading
+import time
 
-import boto3
-import botocore
-
+from lazy_build import chunking
+from lazy_build import compression
 from lazy_build import util
 
 
-ArtifactDetails = collections.namedtuple('ArtifactDetails', ('size',))
+# How much of each ranged GET response to write at a time.
+RANGE_READ_SIZE = 256 * 2**10
+
+
+ArtifactDetails = collections.namedtuple('ArtifactDetails', (
+    'size',
+    # name of the codec the artifact was compressed with (see compression.py)
+    'compression',
+))
+
+
+# A lease on building an artifact expires unless it's renewed this often (in
+# seconds), so a job which dies doesn't hold others up for long.
+LEASE_TTL = 60
+LEASE_RENEW_INTERVAL = LEASE_TTL / 4
+
+
+class Lease:
+    """A claim on building an artifact, held until released.
+
+    While it's held, a background thread calls `renew` every
+    LEASE_RENEW_INTERVAL seconds to keep it from expiring. `renew` returns
+    False if the lease turns out to have been lost, which stops renewal.
+    """
+
+    def __init__(self, renew, release, interval=None):
+        self._renew = renew
+        self._release = release
+        self._interval = interval or LEASE_RENEW_INTERVAL
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+
+    def _heartbeat(self):
+        while not self._stop.wait(self._interval):
+            try:
+                if not self._renew():
+                    return
+            except Exception:
+                # Failing to renew isn't fatal: at worst the lease expires
+                # and someone else builds the artifact too.
+                pass
+
+    def release(self):
+        self._stop.set()
+        self._thread.join()
+        self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.release()
+
+
+def _lease_owner():
+    return json.dumps({
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        'time': time.time(),
+    })
+
+
+@functools.lru_cache(maxsize=None)
+def _s3_client(endpoint_url, max_pool_connections):
+    """Return a (thread-safe) S3 client, shared by everyone in the process.
+
+    Creating sessions and clients is slow, so we only do it once per set of
+    connection settings.
+    """
+    # boto3 takes a good fraction of a second to import, so it's only
+    # imported when an S3 backend is actually used.
+    import boto3
+    import botocore.config
+
+    return boto3.session.Session().client(
+        's3',
+        endpoint_url=endpoint_url,
+        config=botocore.config.Config(
+            max_pool_connections=max_pool_connections,
+        ),
+    )
+
+
+def _check_conditional_writes(client):
+    """Make sure botocore knows the parameters S3 leases are built on.
+
+    Older versions reject them as unknown parameters, which is confusing.
+    """
+    import botocore
+
+    model = client.meta.service_model
+    for operation, param in (
+            ('PutObject', 'IfNoneMatch'),
+            ('PutObject', 'IfMatch'),
+            ('DeleteObject', 'IfMatch'),
+    ):
+        if param not in model.operation_model(operation).input_shape.members:
+            # config imports this module, so it can't be imported up top.
+            from lazy_build import config
+            raise config.UsageError(
+                'single-flight with an S3 cache needs botocore 1.35.69 or '
+                f'newer (installed: {botocore.__version__})',
+            )
 
 
 class S3Backend(collections.namedtuple('S3Backend', (
     'bucket',
     'path',
+    'endpoint_url',
+    # Transfer settings; None means boto3's default.
+    'multipart_threshold',
+    'multipart_chunksize',
+    'max_concurrency',
+    'max_pool_connections',
 ))):
 
     __slots__ = ()
 
+    def __new__(
+            cls,
+            bucket,
+            path,
+            endpoint_url=None,
+            multipart_threshold=None,
+            multipart_chunksize=None,
+            max_concurrency=None,
+            max_pool_connections=None,
+    ):
+        return super().__new__(
+            cls,
+            bucket,
+            path,
+            endpoint_url,
+            multipart_threshold,
+            multipart_chunksize,
+            max_concurrency,
+            max_pool_connections,
+        )
+
+    @property
+    def _pool_size(self):
+        # Each concurrent transfer thread needs its own connection.
+        return self.max_pool_connections or max(10, self.max_concurrency or 0)
+
     @property
     def _s3(self):
-        return boto3.resource('s3')
+        return _s3_client(self.endpoint_url, self._pool_size)
+
+    @property
+    def _transfer_config(self):
+        import boto3.s3.transfer
+
+        return boto3.s3.transfer.TransferConfig(**{
+            name: getattr(self, name)
+            for name in (
+                'multipart_threshold',
+                'multipart_chunksize',
+                'max_concurrency',
+            )
+            if getattr(self, name) is not None
+        })
 
     def _key_for_ctx(self, ctx):
         return self.path.rstrip('/') + '/' + ctx.hash
@@ -30,48 +188,268 @@ class S3Backend(collections.namedtuple('S3Backend', (
         return f'{key}.tar', f'{key}.json'
 
     def artifact_details(self, ctx):
-        tarball, json = self._artifact_paths(ctx)
+        import botocore.exceptions
+
+        tarball, metadata = self._artifact_paths(ctx)
         try:
-            obj = self._s3.Object(self.bucket, tarball)
-            obj.load()
-            return ArtifactDetails(obj.content_length)
+            resp = self._s3.head_object(Bucket=self.bucket, Key=tarball)
         except botocore.exceptions.ClientError as ex:
             if ex.response['Error']['Code'] == '404':
                 return None
             else:
                 raise
+        else:
+            return ArtifactDetails(
+                size=resp['ContentLength'],
+                compression=resp['Metadata'].get('compression', 'none'),
+            )
+
+    def artifact_details_many(self, ctxs):
+        # Each lookup is a round trip, so they're made concurrently.
+        return _details_concurrently(self, ctxs, self._pool_size)
+
+    def tempdir(self):
+        return None
 
+    @contextlib.contextmanager
     def get_artifact(self, ctx, callback):
-        tarball, json = self._artifact_paths(ctx)
+        tarball, metadata = self._artifact_paths(ctx)
+        transfer_config = self._transfer_config
         fd, path = tempfile.mkstemp()
-        os.close(fd)
-        self._s3.meta.client.download_file(
+        try:
+            head = self._s3.head_object(Bucket=self.bucket, Key=tarball)
+            size = head['ContentLength']
+            if (
+                    size < transfer_config.multipart_threshold or
+                    transfer_config.max_request_concurrency < 2
+            ):
+                self._s3.download_file(
+                    self.bucket,
+                    tarball,
+                    path,
+                    Callback=callback,
+                    Config=transfer_config,
+                )
+            else:
+                self._download_ranges(
+                    tarball, fd, size, head['ETag'], callback,
+                    transfer_config,
+                )
+            yield path
+        finally:
+            os.close(fd)
+            os.remove(path)
+
+    def _download_ranges(self, key, fd, size, etag, callback, config):
+        """Download an object as concurrent byte-range GETs.
+
+        Each range is written straight to its place in the file, so there's
+        no reassembly step and no single writer thread to bottleneck on.
+        """
+        os.ftruncate(fd, size)
+
+        def fetch(start):
+            end = min(start + config.multipart_chunksize, size) - 1
+            body = self._s3.get_object(
+                Bucket=self.bucket,
+                Key=key,
+                Range=f'bytes={start}-{end}',
+                # Fail rather than mix two versions of the artifact.
+                IfMatch=etag,
+            )['Body']
+            offset = start
+            for data in iter(lambda: body.read(RANGE_READ_SIZE), b''):
+                util.pwrite(fd, data, offset)
+                offset += len(data)
+                callback(len(data))
+            if offset != end + 1:
+                raise IOError(
+                    f'Short read for {key} bytes {start}-{end}: '
+                    f'got {offset - start} bytes',
+                )
+
+        with concurrent.futures.ThreadPoolExecutor(
+                config.max_request_concurrency,
+        ) as executor:
+            for _ in executor.map(
+                    fetch, range(0, size, config.multipart_chunksize),
+            ):
+                pass
+
+    def stream_artifact(self, ctx, fileobj, callback):
+        tarball, metadata = self._artifact_paths(ctx)
+        self._s3.download_fileobj(
             self.bucket,
             tarball,
-            path,
+            fileobj,
             Callback=callback,
+            Config=self._transfer_config,
         )
-        return path
 
-    def store_artifact(self, ctx, path, callback):
-        tarball, json = self._artifact_paths(ctx)
-        self._s3.meta.client.upload_file(
+    def store_artifact(self, ctx, path, callback, compression='none'):
+        tarball, metadata = self._artifact_paths(ctx)
+        self._s3.upload_file(
             path,
             Key=tarball,
             Bucket=self.bucket,
             Callback=callback,
+            ExtraArgs={'Metadata': {'compression': compression}},
+            Config=self._transfer_config,
         )
 
+    def store_artifact_stream(
+            self, ctx, fileobj, callback, compression='none',
+    ):
+        tarball, metadata = self._artifact_paths(ctx)
+        # Uploads are multipart, with each part uploaded as soon as it has
+        # been read from the stream.
+        self._s3.upload_fileobj(
+            fileobj,
+            self.bucket,
+            tarball,
+            Callback=callback,
+            ExtraArgs={'Metadata': {'compression': compression}},
+            Config=self._transfer_config,
+        )
+
+    def store_file_manifest(self, ctx, manifest):
+        _store_file_manifest(self, ctx, manifest)
+
+    def file_manifest(self, ctx):
+        return _get_file_manifest(self, ctx)
+
+    def acquire_lease(self, ctx):
+        """Claim the build of ctx's artifact, returning a Lease or None.
+
+        The lease is an object created with a conditional PUT, so only one
+        job can create it. Leases which haven't been renewed within
+        LEASE_TTL are taken over.
+        """
+        import botocore.exceptions
+
+        _check_conditional_writes(self._s3)
+        key = self._key_for_ctx(ctx) + '.lock'
+        for _ in range(2):
+            try:
+                resp = self._s3.put_object(
+                    Bucket=self.bucket,
+                    Key=key,
+                    Body=_lease_owner().encode('UTF-8'),
+                    IfNoneMatch='*',
+                )
+            except botocore.exceptions.ClientError as ex:
+                code = ex.response['Error']['Code']
+                if code == 'ConditionalRequestConflict':
+                    # Someone else is creating it right now.
+                    return None
+                elif code != 'PreconditionFailed':
+                    raise
+            else:
+                return self._lease(key, resp['ETag'])
+
+            try:
+                head = self._s3.head_object(Bucket=self.bucket, Key=key)
+            except botocore.exceptions.ClientError as ex:
+                if ex.response['Error']['Code'] == '404':
+                    continue
+                raise
+            age = time.time() - head['LastModified'].timestamp()
+            if age < LEASE_TTL:
+                return None
+            # The holder stopped renewing it, so it's presumably dead. Only
+            # the version we looked at is removed, in case someone else has
+            # just taken it over.
+            try:
+                self._s3.delete_object(
+                    Bucket=self.bucket, Key=key, IfMatch=head['ETag'],
+                )
+            except botocore.exceptions.ClientError as ex:
+                if ex.response['Error']['Code'] not in (
+                        'PreconditionFailed', 'NoSuchKey',
+                ):
+                    raise
+        return None
+
+    def _lease(self, key, etag):
+        import botocore.exceptions
+
+        etags = [etag]
+
+        def renew():
+            try:
+                resp = self._s3.put_object(
+                    Bucket=self.bucket,
+                    Key=key,
+                    Body=_lease_owner().encode('UTF-8'),
+                    IfMatch=etags[-1],
+                )
+            except botocore.exceptions.ClientError as ex:
+                if ex.response['Error']['Code'] == 'PreconditionFailed':
+                    return False
+                raise
+            etags.append(resp['ETag'])
+            return True
+
+        def release():
+            try:
+                self._s3.delete_object(
+                    Bucket=self.bucket, Key=key, IfMatch=etags[-1],
+                )
+            except botocore.exceptions.ClientError as ex:
+                # Someone else took it over; it's theirs to remove.
+                if ex.response['Error']['Code'] not in (
+                        'PreconditionFailed', 'NoSuchKey',
+                ):
+                    raise
+
+        return Lease(renew, release)
+
     def invalidate_artifact(self, ctx):
         raise NotImplementedError()
 
 
+def _read_lock(path):
+    """Return (stat, owner) for the lock file at path, or (None, None)."""
+    try:
+        with open(path) as f:
+            return os.fstat(f.fileno()), f.read()
+    except FileNotFoundError:
+        return None, None
+
+
+def _remove_lock(path, matches):
+    """Remove the lock file at path if matches(stat, owner) is true of it.
+
+    The lock is moved aside before it's checked, so a lock which replaced
+    the one we meant to remove is never removed (just put back).
+    """
+    aside = tempfile.mktemp(
+        prefix='.' + os.path.basename(path) + '.',
+        dir=os.path.dirname(path),
+    )
+    try:
+        os.rename(path, aside)
+    except FileNotFoundError:
+        return
+    if not matches(*_read_lock(aside)):
+        # Put it back, unless yet another lock has been taken meanwhile.
+        with contextlib.suppress(FileExistsError):
+            os.link(aside, path)
+    os.remove(aside)
+
+
 class FilesystemBackend(collections.namedtuple('FilesystemBackend', (
     'path',
+    # If set, the least recently used artifacts are removed whenever the
+    # total size of the cache grows beyond this many bytes.
+    'max_size',
 ))):
 
     __slots__ = ()
 
+    def __new__(cls, path, max_size=None):
+        return super().__new__(cls, path, max_size)
+
     def _path_for_ctx(self, ctx):
         return self.path.rstrip('/') + '/' + ctx.hash
 
@@ -80,30 +458,691 @@ class FilesystemBackend(collections.namedtuple('FilesystemBackend', (
         return f'{key}.tar', f'{key}.json'
 
     def artifact_details(self, ctx):
-        tarball, json = self._artifact_paths(ctx)
+        tarball, metadata = self._artifact_paths(ctx)
         try:
-            return ArtifactDetails(os.path.getsize(tarball))
+            size = os.path.getsize(tarball)
         except FileNotFoundError:
             return None
 
+        # Artifacts from older versions have no metadata.
+        try:
+            with open(metadata) as f:
+                compression = json.load(f)['compression']
+        except FileNotFoundError:
+            compression = 'none'
+
+        return ArtifactDetails(size=size, compression=compression)
+
+    def artifact_details_many(self, ctxs):
+        return [self.artifact_details(ctx) for ctx in ctxs]
+
+    def tempdir(self):
+        # Packaging directly into the cache directory means storing the
+        # artifact is just a rename.
+        os.makedirs(self.path, exist_ok=True)
+        return self.path
+
+    @contextlib.contextmanager
     def get_artifact(self, ctx, callback):
-        # TODO: ideally for this backend we wouldn't bother writing the
-        # temporary file in the first place (currently we have to do this
-        # because the code deletes it after restore)
-        tarball, json = self._artifact_paths(ctx)
-        fd, path = tempfile.mkstemp()
-        with os.fdopen(fd, 'wb') as tf:
-            with open(tarball, 'rb') as f:
-                util.copyfileobj(f, tf, callback)
-        return path
+        # The cached file can be extracted directly; no need to copy it.
+        tarball, metadata = self._artifact_paths(ctx)
+        self._touch(tarball)
+        callback(os.path.getsize(tarball))
+        yield tarball
 
-    def store_artifact(self, ctx, path, callback):
-        tarball, json = self._artifact_paths(ctx)
+    def stream_artifact(self, ctx, fileobj, callback):
+        tarball, metadata = self._artifact_paths(ctx)
+        self._touch(tarball)
+        with open(tarball, 'rb') as f:
+            util.copyfileobj(f, fileobj, callback)
+
+    def _write_metadata(self, metadata, compression):
+        # The metadata must be in place before the tarball, since readers use
+        # the tarball's existence to decide whether the artifact exists.
+        os.makedirs(os.path.dirname(metadata), exist_ok=True)
+        with util.atomic_write(metadata) as f:
+            json.dump({'compression': compression}, f)
+
+    def store_artifact(self, ctx, path, callback, compression='none'):
+        tarball, metadata = self._artifact_paths(ctx)
+        self._write_metadata(metadata, compression)
+        if self._link_temp_file(path, tarball):
+            callback(os.path.getsize(tarball))
+        else:
+            with util.atomic_write(tarball, 'wb') as dest:
+                with open(path, 'rb') as src:
+                    util.copyfile(src, dest, callback)
+        self._touch(tarball)
+        self._evict(keep=tarball)
+
+    def _link_temp_file(self, path, tarball):
+        """Hard link a file packaged into tempdir() into place, if possible.
+
+        Only our own temporary files can be linked (and made readable by
+        others); anything else, like another cache's tarball, must be copied
+        so the two caches don't share (and touch or chmod) the same file. The
+        caller still owns and removes `path`.
+        """
+        if (
+                os.path.dirname(os.path.abspath(path)) !=
+                os.path.abspath(self.path) or
+                not os.path.basename(path).startswith('.')
+        ):
+            return False
+
+        os.chmod(path, 0o666 & ~util.UMASK)
+        tmp = tempfile.mktemp(
+            prefix='.' + os.path.basename(tarball),
+            dir=os.path.dirname(tarball),
+        )
+        try:
+            os.link(path, tmp)
+        except OSError as ex:
+            if ex.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            return False
+        os.rename(tmp, tarball)
+        return True
+
+    def store_artifact_stream(
+            self, ctx, fileobj, callback, compression='none',
+    ):
+        tarball, metadata = self._artifact_paths(ctx)
+        self._write_metadata(metadata, compression)
         with util.atomic_write(tarball, 'wb') as dest:
-            # TODO: ideally for this backend we wouldn't bother writing the
-            # temporary file in the first place
-            with open(path, 'rb') as src:
-                util.copyfileobj(src, dest, callback)
+            util.copyfileobj(fileobj, dest, callback)
+        self._evict(keep=tarball)
+
+    def _touch(self, tarball):
+        # mtime (rather than atime, which is often disabled) records when an
+        # artifact was last used. Only size-limited caches need it, so
+        # read-only shared caches keep working.
+        if self.max_size is not None:
+            os.utime(tarball)
+
+    def _evict(self, keep):
+        """Remove the least recently used artifacts until under max_size."""
+        if self.max_size is None:
+            return
+
+        artifacts = []
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if (
+                        entry.name.endswith('.tar') and
+                        not entry.name.startswith('.')
+                ):
+                    st = entry.stat()
+                    artifacts.append((st.st_mtime_ns, st.st_size, entry.path))
+
+        total = sum(size for _, size, _ in artifacts)
+        for _, size, path in sorted(artifacts):
+            if total <= self.max_size:
+                break
+            elif path == keep:
+                continue
+
+            # Remove the tarball first, since its existence is what marks the
+            # artifact as present.
+            for artifact_path in (path, path[:-len('.tar')] + '.json'):
+                try:
+                    os.remove(artifact_path)
+                except FileNotFoundError:
+                    pass  # probably evicted by someone else concurrently
+            total -= size
+
+    def store_file_manifest(self, ctx, manifest):
+        _store_file_manifest(self, ctx, manifest)
+
+    def file_manifest(self, ctx):
+        return _get_file_manifest(self, ctx)
+
+    def acquire_lease(self, ctx):
+        """Claim the build of ctx's artifact, returning a Lease or None.
+
+        The lease is a lock file created with O_EXCL, which is renewed by
+        touching it. Lock files which haven't been touched within LEASE_TTL
+        are taken over.
+        """
+        path = self._path_for_ctx(ctx) + '.lock'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                stale_st, stale_owner = _read_lock(path)
+                if stale_st is None:
+                    continue
+                elif time.time() - stale_st.st_mtime < LEASE_TTL:
+                    return None
+                # The holder stopped renewing it, so it's presumably dead.
+                # Someone else might be taking it over at the same time, so
+                # only remove it if it's still the lock we looked at.
+                _remove_lock(
+                    path,
+                    lambda st, owner: (
+                        (st.st_ino, st.st_mtime_ns, owner) ==
+                        (stale_st.st_ino, stale_st.st_mtime_ns, stale_owner)
+                    ),
+                )
+            else:
+                owner = _lease_owner()
+                with open(fd, 'w') as f:
+                    f.write(owner)
+                    ino = os.fstat(f.fileno()).st_ino
+                return Lease(
+                    lambda: self._renew_lock(path, ino, owner),
+                    lambda: self._release_lock(path, ino, owner),
+                )
+        return None
+
+    def _renew_lock(self, path, ino, owner):
+        st, current_owner = _read_lock(path)
+        if st is None or (st.st_ino, current_owner) != (ino, owner):
+            return False
+        os.utime(path)
+        return True
+
+    def _release_lock(self, path, ino, owner):
+        # If it was taken over, it's someone else's to remove.
+        _remove_lock(
+            path, lambda st, current_owner: (
+                (st.st_ino, current_owner) == (ino, owner)
+            ),
+        )
 
     def invalidate_artifact(self, ctx):
         raise NotImplementedError()
+
+
+def _details_concurrently(backend, ctxs, max_workers):
+    if len(ctxs) <= 1:
+        return [backend.artifact_details(ctx) for ctx in ctxs]
+    with concurrent.futures.ThreadPoolExecutor(
+            min(max_workers, len(ctxs)),
+    ) as executor:
+        return list(executor.map(backend.artifact_details, ctxs))
+
+
+def _no_progress(num_bytes):
+    pass
+
+
+class _TeeWriter:
+    """Writes everything to two file objects."""
+
+    def __init__(self, fileobj, copy):
+        self._fileobj = fileobj
+        self._copy = copy
+
+    def write(self, data):
+        self._copy.write(data)
+        return self._fileobj.write(data)
+
+
+class _TeeReader:
+    """Reads from a file object, writing a copy of everything read."""
+
+    def __init__(self, fileobj, copy):
+        self._fileobj = fileobj
+        self._copy = copy
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._copy.write(data)
+        return data
+
+
+class ChainBackend(collections.namedtuple('ChainBackend', ('backends',))):
+    """Several backends layered on top of each other, fastest first.
+
+    Lookups try each backend in turn, and artifacts found in a slower backend
+    are copied into all the faster ones on the way. New artifacts are stored
+    in every backend.
+    """
+
+    __slots__ = ()
+
+    def _find(self, ctx):
+        for i, backend in enumerate(self.backends):
+            details = backend.artifact_details(ctx)
+            if details is not None:
+                return i, details
+        else:
+            return None, None
+
+    def _find_existing(self, ctx):
+        i, details = self._find(ctx)
+        if i is None:
+            # e.g. evicted by another job since it was looked up
+            raise FileNotFoundError(
+                f'Artifact {ctx.hash} is no longer in the cache',
+            )
+        return i, details
+
+    def _populate(self, backends, ctx, path, compression):
+        for backend in backends:
+            backend.store_artifact(ctx, path, _no_progress, compression)
+
+    def artifact_details(self, ctx):
+        i, details = self._find(ctx)
+        return details
+
+    def artifact_details_many(self, ctxs):
+        results = [None] * len(ctxs)
+        missing = list(range(len(ctxs)))
+        for backend in self.backends:
+            if not missing:
+                break
+            found = backend.artifact_details_many([ctxs[i] for i in missing])
+            for i, details in zip(missing, found):
+                results[i] = details
+            missing = [i for i in missing if results[i] is None]
+        return results
+
+    def tempdir(self):
+        return self.backends[0].tempdir()
+
+    @contextlib.contextmanager
+    def get_artifact(self, ctx, callback):
+        i, details = self._find_existing(ctx)
+        with self.backends[i].get_artifact(ctx, callback) as path:
+            self._populate(self.backends[:i], ctx, path, details.compression)
+            yield path
+
+    def stream_artifact(self, ctx, fileobj, callback):
+        i, details = self._find_existing(ctx)
+        if i == 0:
+            self.backends[0].stream_artifact(ctx, fileobj, callback)
+            return
+
+        fd, path = tempfile.mkstemp(prefix='.lazy-build-', dir=self.tempdir())
+        try:
+            with open(fd, 'wb') as copy:
+                self.backends[i].stream_artifact(
+                    ctx, _TeeWriter(fileobj, copy), callback,
+                )
+            self._populate(self.backends[:i], ctx, path, details.compression)
+        finally:
+            os.remove(path)
+
+    def store_artifact(self, ctx, path, callback, compression='none'):
+        # Progress is only reported for the slowest (last) backend.
+        self._populate(self.backends[:-1], ctx, path, compression)
+        self.backends[-1].store_artifact(ctx, path, callback, compression)
+
+    def store_artifact_stream(
+            self, ctx, fileobj, callback, compression='none',
+    ):
+        fd, path = tempfile.mkstemp(prefix='.lazy-build-', dir=self.tempdir())
+        try:
+            with open(fd, 'wb') as copy:
+                self.backends[-1].store_artifact_stream(
+                    ctx, _TeeReader(fileobj, copy), callback, compression,
+                )
+            self._populate(self.backends[:-1], ctx, path, compression)
+        finally:
+            os.remove(path)
+
+    def store_file_manifest(self, ctx, manifest):
+        _store_file_manifest(self, ctx, manifest)
+
+    def file_manifest(self, ctx):
+        return _get_file_manifest(self, ctx)
+
+    def acquire_lease(self, ctx):
+        # The slowest backend is the one shared with other jobs.
+        return self.backends[-1].acquire_lease(ctx)
+
+    def invalidate_artifact(self, ctx):
+        raise NotImplementedError()
+
+
+# Stands in for a BuildContext when storing objects other than artifacts.
+_Key = collections.namedtuple('_Key', ('hash',))
+
+
+def _put_object(backend, key, data, codec, level, callback=_no_progress):
+    """Compress and store a small object in a backend, returning its size."""
+    buf = io.BytesIO()
+    with compression.compress(codec, buf, level) as f:
+        f.write(data)
+    size = buf.tell()
+    buf.seek(0)
+    backend.store_artifact_stream(key, buf, callback, codec)
+    return size
+
+
+def _get_object(backend, key, callback=_no_progress):
+    """Read an object stored with _put_object, or None if it's missing."""
+    details = backend.artifact_details(key)
+    if details is None:
+        return None
+    buf = io.BytesIO()
+    backend.stream_artifact(key, buf, callback)
+    buf.seek(0)
+    with compression.decompress(details.compression, buf) as f:
+        return f.read()
+
+
+def _file_manifest_key(ctx):
+    return _Key(f'{ctx.hash}-files')
+
+
+def _store_file_manifest(backend, ctx, manifest):
+    _put_object(
+        backend,
+        _file_manifest_key(ctx),
+        json.dumps(manifest).encode('UTF-8'),
+        'gzip',
+        None,
+    )
+
+
+def _get_file_manifest(backend, ctx):
+    data = _get_object(backend, _file_manifest_key(ctx))
+    if data is None:
+        return None
+    return json.loads(data.decode('UTF-8'))
+
+
+def _bounded_map(executor, fn, items, window):
+    """Like executor.map, but with at most `window` calls in flight."""
+    pending = collections.deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+# How many chunk manifests to keep in memory (see ChunkedBackend._manifest).
+# Manifests never change once stored, since artifacts are keyed by hash.
+MANIFEST_CACHE_SIZE = 4
+_manifests = collections.OrderedDict()
+_manifests_lock = threading.Lock()
+
+
+class ChunkedBackend(collections.namedtuple('ChunkedBackend', (
+    'backend',
+    # Chunks (and manifests) are compressed individually with this codec.
+    'compression',
+    'compression_level',
+    # How many chunks to transfer at once.
+    'max_concurrency',
+))):
+    """Stores artifacts in another backend as deduplicated chunks.
+
+    Each artifact is a manifest listing its tar members and the chunks holding
+    their contents (see chunking.py). Chunks are keyed by their digest and
+    shared between artifacts, so only chunks the backend doesn't already have
+    are uploaded, and a layered backend only downloads chunks missing from its
+    local cache.
+    """
+
+    __slots__ = ()
+
+    def __new__(
+            cls,
+            backend,
+            compression='none',
+            compression_level=None,
+            max_concurrency=8,
+    ):
+        return super().__new__(
+            cls, backend, compression, compression_level, max_concurrency,
+        )
+
+    def _manifest_key(self, ctx):
+        return _Key(f'{ctx.hash}-manifest')
+
+    def _manifest(self, ctx):
+        # Looking an artifact up, restoring it and reading its file manifest
+        # all need the manifest, which can be megabytes, so it's only
+        # downloaded once. Misses aren't remembered, since the artifact may
+        # be stored later.
+        key = (self.backend, ctx.hash)
+        with _manifests_lock:
+            if key in _manifests:
+                _manifests.move_to_end(key)
+                return _manifests[key]
+
+        data = _get_object(self.backend, self._manifest_key(ctx))
+        if data is None:
+            return None
+        manifest = json.loads(data.decode('UTF-8'))
+        with _manifests_lock:
+            _manifests[key] = manifest
+            while len(_manifests) > MANIFEST_CACHE_SIZE:
+                _manifests.popitem(last=False)
+        return manifest
+
+    def _chunk_key(self, digest):
+        return _Key(f'chunk-{digest}')
+
+    def artifact_details(self, ctx):
+        manifest = self._manifest(ctx)
+        if manifest is None:
+            return None
+        return ArtifactDetails(
+            size=sum(size for _, size in manifest['chunks']),
+            compression='none',
+        )
+
+    def artifact_details_many(self, ctxs):
+        return _details_concurrently(self, ctxs, self.max_concurrency)
+
+    def tempdir(self):
+        return self.backend.tempdir()
+
+    @contextlib.contextmanager
+    def get_artifact(self, ctx, callback):
+        fd, path = tempfile.mkstemp(prefix='.lazy-build-', dir=self.tempdir())
+        try:
+            with open(fd, 'wb') as f:
+                self.stream_artifact(ctx, f, callback)
+            yield path
+        finally:
+            os.remove(path)
+
+    def _fetch_chunk(self, chunk, callback):
+        digest, size = chunk
+        data = _get_object(self.backend, self._chunk_key(digest), callback)
+        if data is None:
+            raise FileNotFoundError(f'Missing chunk: {digest}')
+        elif hashlib.sha256(data).hexdigest() != digest:
+            raise IOError(f'Corrupt chunk: {digest}')
+        return data
+
+    def stream_artifact(self, ctx, fileobj, callback):
+        manifest = self._manifest(ctx)
+        if manifest is None:
+            # e.g. evicted by another job since it was looked up
+            raise FileNotFoundError(
+                f'Artifact {ctx.hash} is no longer in the cache',
+            )
+        with concurrent.futures.ThreadPoolExecutor(
+                self.max_concurrency,
+        ) as executor:
+            chunking.join_tarball(
+                manifest['members'],
+                _bounded_map(
+                    executor,
+                    lambda chunk: self._fetch_chunk(chunk, callback),
+                    manifest['chunks'],
+                    self.max_concurrency,
+                ),
+                fileobj,
+            )
+
+    def _store_chunk(self, data, callback):
+        digest = hashlib.sha256(data).hexdigest()
+        key = self._chunk_key(digest)
+        details = self.backend.artifact_details(key)
+        if details is not None:
+            return [digest, details.size]
+        size = _put_object(
+            self.backend,
+            key,
+            data,
+            self.compression,
+            self.compression_level,
+            callback,
+        )
+        return [digest, size]
+
+    def store_artifact(self, ctx, path, callback, compression='none'):
+        with open(path, 'rb') as f:
+            self.store_artifact_stream(ctx, f, callback, compression)
+
+    def store_artifact_stream(
+            self, ctx, fileobj, callback, compression='none',
+    ):
+        members = []
+        with concurrent.futures.ThreadPoolExecutor(
+                self.max_concurrency,
+        ) as executor:
+            chunks = list(_bounded_map(
+                executor,
+                lambda data: self._store_chunk(data, callback),
+                chunking.split_tarball(fileobj, members, compression),
+                self.max_concurrency,
+            ))
+
+        # The manifest goes last, since it marks the artifact as present.
+        manifest = {'members': members, 'chunks': chunks}
+        _put_object(
+            self.backend,
+            self._manifest_key(ctx),
+            json.dumps(manifest).encode('UTF-8'),
+            self.compression,
+            self.compression_level,
+        )
+
+    def store_file_manifest(self, ctx, manifest):
+        # The chunk manifest already describes every member.
+        pass
+
+    def file_manifest(self, ctx):
+        manifest = self._manifest(ctx)
+        if manifest is None:
+            return None
+        return {'algorithm': 'sha256', 'members': manifest['members']}
+
+    def acquire_lease(self, ctx):
+        return self.backend.acquire_lease(ctx)
+
+    def invalidate_artifact(self, ctx):
+        raise NotImplementedError()
+
+
+class NegativeCacheBackend(collections.namedtuple('NegativeCacheBackend', (
+    'backend',
+    # How many seconds a lookup which found nothing is remembered for.
+    'ttl',
+    # Where the misses are recorded; defaults to a file in the cache dir.
+    'path',
+))):
+    """Remembers recent misses from another backend.
+
+    Until an artifact is uploaded, every build looking for it pays for a
+    lookup which finds nothing. Misses are recorded locally for a short time
+    so repeated runs (e.g. a CI job checking many targets) can skip those
+    lookups. Artifacts stored through this backend are forgotten immediately;
+    ones uploaded elsewhere are found once the entry expires.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, backend, ttl, path=None):
+        if path is None:
+            path = os.path.join(util.cache_dir(), 'negative-lookups.json')
+        return super().__new__(cls, backend, ttl, path)
+
+    def _key(self, ctx):
+        # The same hash can be missing from one backend but not another.
+        key = json.dumps((repr(self.backend), ctx.hash))
+        return hashlib.sha256(key.encode('UTF-8')).hexdigest()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save(self, misses):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with util.atomic_write(self.path) as f:
+            json.dump(misses, f)
+
+    def artifact_details(self, ctx):
+        return self.artifact_details_many([ctx])[0]
+
+    def artifact_details_many(self, ctxs):
+        now = time.time()
+        misses = self._load()
+        known = [misses.get(self._key(ctx), 0) > now for ctx in ctxs]
+        found = iter(self.backend.artifact_details_many([
+            ctx for ctx, missing in zip(ctxs, known) if not missing
+        ]))
+        results = [None if missing else next(found) for missing in known]
+
+        new_misses = {
+            self._key(ctx): now + self.ttl
+            for ctx, missing, details in zip(ctxs, known, results)
+            if not missing and details is None
+        }
+        if new_misses:
+            # Writers can race, but losing an entry only costs a lookup.
+            misses = {key: t for key, t in misses.items() if t > now}
+            misses.update(new_misses)
+            self._save(misses)
+        return results
+
+    def _forget(self, ctx):
+        misses = self._load()
+        if misses.pop(self._key(ctx), None) is not None:
+            self._save(misses)
+
+    def tempdir(self):
+        return self.backend.tempdir()
+
+    def get_artifact(self, ctx, callback):
+        return self.backend.get_artifact(ctx, callback)
+
+    def stream_artifact(self, ctx, fileobj, callback):
+        self.backend.stream_artifact(ctx, fileobj, callback)
+
+    def store_artifact(self, ctx, path, callback, compression='none'):
+        self.backend.store_artifact(ctx, path, callback, compression)
+        self._forget(ctx)
+
+    def store_artifact_stream(
+            self, ctx, fileobj, callback, compression='none',
+    ):
+        self.backend.store_artifact_stream(ctx, fileobj, callback, compression)
+        self._forget(ctx)
+
+    def store_file_manifest(self, ctx, manifest):
+        self.backend.store_file_manifest(ctx, manifest)
+
+    def file_manifest(self, ctx):
+        return self.backend.file_manifest(ctx)
+
+    def acquire_lease(self, ctx):
+        # Either someone else is building it, so it should appear soon, or
+        # the caller is about to check it hasn't appeared since the miss was
+        # recorded; both need a real lookup.
+        self._forget(ctx)
+        return self.backend.acquire_lease(ctx)
+
+    def invalidate_artifact(self, ctx):
+        self.backend.invalidate_artifact(ctx)
@@ -0,0 +1,109 @@
+"""Splitting artifacts into content-defined chunks, and joining them back.
+
+A tarball is split into a list of members (the tar headers, plus a digest of
+each file's contents) and the concatenated contents of its files. The contents
+are cut into chunks after files whose digests happen to match a pattern, so
+chunk boundaries depend only on the files around them: adding a package to a
+virtualenv only changes the chunks next to it. Timestamps and other metadata
+live in the members, so rebuilding identical files still produces identical
+chunks.
+"""
+import hashlib
+import tarfile
+
+from lazy_build import compression
+from lazy_build import context
+
+
+# Chunks end after a file whose digest matches BOUNDARY_MASK (about 1 in 64
+# files) once they're at least CHUNK_MIN_SIZE, and are cut at CHUNK_MAX_SIZE.
+CHUNK_MIN_SIZE = 2**20
+CHUNK_MAX_SIZE = 16 * 2**20
+BOUNDARY_MASK = 0x3f
+
+READ_SIZE = 2**20
+
+
+def _split(tf, members):
+    chunk = bytearray()
+    for info in tf:
+        member = context.manifest_entry(info)
+        members.append(member)
+        if not info.isreg():
+            continue
+
+        # Large files always start a new chunk, so they're split at the same
+        # offsets every time.
+        large = info.size >= CHUNK_MAX_SIZE
+        if large and chunk:
+            yield bytes(chunk)
+            chunk = bytearray()
+
+        h = hashlib.sha256()
+        f = tf.extractfile(info)
+        for data in iter(lambda: f.read(READ_SIZE), b''):
+            h.update(data)
+            chunk += data
+            while len(chunk) >= CHUNK_MAX_SIZE:
+                yield bytes(chunk[:CHUNK_MAX_SIZE])
+                del chunk[:CHUNK_MAX_SIZE]
+        member['digest'] = h.hexdigest()
+
+        boundary = int(member['digest'][-8:], 16) & BOUNDARY_MASK == 0
+        if chunk and (large or (boundary and len(chunk) >= CHUNK_MIN_SIZE)):
+            yield bytes(chunk)
+            chunk = bytearray()
+    if chunk:
+        yield bytes(chunk)
+
+
+def split_tarball(fileobj, members, compression_name='none'):
+    """Split a (possibly compressed) tarball read from `fileobj`.
+
+    Appends a dict describing each member to `members`, and yields the file
+    contents as a series of chunks (bytes).
+    """
+    with compression.decompress(compression_name, fileobj) as decompressed:
+        with tarfile.open(fileobj=decompressed, mode='r|') as tf:
+            yield from _split(tf, members)
+
+
+class _ChunkReader:
+    """A file object reading from an iterable of chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = memoryview(b'')
+
+    def read(self, size):
+        out = bytearray()
+        while len(out) < size:
+            if not self._buf:
+                try:
+                    self._buf = memoryview(next(self._chunks))
+                except StopIteration:
+                    break
+            n = size - len(out)
+            out += self._buf[:n]
+            self._buf = self._buf[n:]
+        return bytes(out)
+
+
+def join_tarball(members, chunks, fileobj):
+    """Write the tarball described by `members` and `chunks` to `fileobj`."""
+    reader = _ChunkReader(chunks)
+    with tarfile.open(
+            fileobj=fileobj,
+            mode='w|',
+            format=tarfile.GNU_FORMAT,
+    ) as tf:
+        for member in members:
+            info = tarfile.TarInfo(member['name'])
+            info.type = member['type'].encode('ascii')
+            info.mode = member['mode']
+            info.mtime = member['mtime']
+            info.uid = member['uid']
+            info.gid = member['gid']
+            info.size = member['size']
+            info.linkname = member['linkname']
+            tf.addfile(info, reader if info.isreg() else None)
@@ -0,0 +1,146 @@
+"""Compression codecs for artifacts.
+
+zstd and lz4 need the optional `zstandard` and `lz4` packages; they're only
+imported when actually used.
+"""
+import collections
+import contextlib
+import importlib
+
+
+class Codec(collections.namedtuple('Codec', (
+    'name',
+    'module',
+    'writer',
+    'reader',
+))):
+    """A compression codec.
+
+    `writer(fileobj, level, threads)` and `reader(fileobj)` return file
+    objects wrapping `fileobj`; closing them must not close `fileobj`.
+    `level` may be None to use the codec's default.
+    """
+
+    __slots__ = ()
+
+    @property
+    def available(self):
+        try:
+            importlib.import_module(self.module)
+        except ImportError:
+            return False
+        else:
+            return True
+
+
+class _Unclosable:
+    """Wrap a file object, ignoring close()."""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        pass
+
+    def close(self):
+        pass
+
+
+def _gzip_writer(fileobj, level, threads):
+    import gzip
+    return gzip.GzipFile(
+        fileobj=fileobj,
+        mode='wb',
+        compresslevel=6 if level is None else level,
+        mtime=0,
+    )
+
+
+def _gzip_reader(fileobj):
+    import gzip
+    return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+
+def _bz2_writer(fileobj, level, threads):
+    import bz2
+    return bz2.BZ2File(fileobj, 'wb', compresslevel=level or 9)
+
+
+def _bz2_reader(fileobj):
+    import bz2
+    return bz2.BZ2File(fileobj, 'rb')
+
+
+def _xz_writer(fileobj, level, threads):
+    import lzma
+    return lzma.LZMAFile(fileobj, 'wb', preset=level)
+
+
+def _xz_reader(fileobj):
+    import lzma
+    return lzma.LZMAFile(fileobj, 'rb')
+
+
+def _zstd_writer(fileobj, level, threads):
+    import zstandard
+    return zstandard.ZstdCompressor(
+        level=3 if level is None else level,
+        threads=threads if threads > 1 else 0,
+    ).stream_writer(fileobj, closefd=False)
+
+
+def _zstd_reader(fileobj):
+    import zstandard
+    return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
+
+
+def _lz4_writer(fileobj, level, threads):
+    import lz4.frame
+    return lz4.frame.LZ4FrameFile(
+        fileobj,
+        'wb',
+        compression_level=level or 0,
+    )
+
+
+def _lz4_reader(fileobj):
+    import lz4.frame
+    return lz4.frame.LZ4FrameFile(fileobj, 'rb')
+
+
+CODECS = {
+    codec.name: codec
+    for codec in (
+        Codec(
+            'none',
+            'io',
+            lambda fileobj, level, threads: _Unclosable(fileobj),
+            _Unclosable,
+        ),
+        Codec('gzip', 'gzip', _gzip_writer, _gzip_reader),
+        Codec('bz2', 'bz2', _bz2_writer, _bz2_reader),
+        Codec('xz', 'lzma', _xz_writer, _xz_reader),
+        Codec('zstd', 'zstandard', _zstd_writer, _zstd_reader),
+        Codec('lz4', 'lz4.frame', _lz4_writer, _lz4_reader),
+    )
+}
+
+
+@contextlib.contextmanager
+def compress(name, fileobj, level=None, threads=1):
+    """Yield a file object which compresses into `fileobj`."""
+    with CODECS[name].writer(fileobj, level, threads) as f:
+        yield f
+
+
+@contextlib.contextmanager
+def decompress(name, fileobj):
+    """Yield a file object which decompresses from `fileobj`."""
+    with CODECS[name].reader(fileobj) as f:
+        yield f
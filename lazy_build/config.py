@@ -1,8 +1,11 @@
 import collections
 import json
+import os
 import re
 
 from lazy_build import cache
+from lazy_build import compression
+from lazy_build import context
 
 
 def read_config():
@@ -15,6 +18,105 @@ class UsageError(Exception):
     pass
 
 
+class Target(collections.namedtuple('Target', (
+    'name',
+    'context',
+    'command',
+    'ignore',
+    'output',
+    'after_download',
+    # names of targets whose outputs this one's command uses
+    'deps',
+))):
+
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls, name, target_conf):
+        return cls(
+            name=name,
+            context=frozenset(target_conf.get('context', ())),
+            command=tuple(target_conf['command']),
+            ignore=frozenset(target_conf.get('ignore', ())),
+            output=frozenset(target_conf['output']),
+            after_download=tuple(target_conf.get('after-download', ())),
+            deps=tuple(target_conf.get('deps', ())),
+        )
+
+
+def read_targets(conf, targets_files):
+    """Return the named targets from the config file or targets files.
+
+    Targets files look like the "targets" section of the config file.
+    """
+    if targets_files:
+        targets_conf = {}
+        for path in targets_files:
+            with open(path) as f:
+                targets_conf.update(json.load(f))
+    else:
+        targets_conf = conf.get('targets', {})
+    return {
+        name: Target.from_config(name, target_conf)
+        for name, target_conf in targets_conf.items()
+    }
+
+
+def order_targets(available, names):
+    """Return the named targets and everything they depend on.
+
+    Each target comes after all of its dependencies.
+    """
+    ordered = []
+    done = set()
+    path = []
+
+    def visit(name):
+        if name in done:
+            return
+        elif name in path:
+            cycle = path[path.index(name):] + [name]
+            raise UsageError(
+                'Dependency cycle: {}'.format(' -> '.join(cycle)),
+            )
+
+        path.append(name)
+        for dep in available[name].deps:
+            if dep not in available:
+                raise UsageError(
+                    f'Target {name} depends on unknown target: {dep}',
+                )
+            visit(dep)
+        path.pop()
+
+        done.add(name)
+        ordered.append(available[name])
+
+    for name in names:
+        visit(name)
+    return tuple(ordered)
+
+
+def _backend_from_config(cache_conf):
+    if cache_conf['source'] == 's3':
+        return cache.S3Backend(
+            bucket=cache_conf['bucket'],
+            path=cache_conf['path'],
+            endpoint_url=cache_conf.get('endpoint-url'),
+            multipart_threshold=cache_conf.get('multipart-threshold'),
+            multipart_chunksize=cache_conf.get('multipart-chunksize'),
+            max_concurrency=cache_conf.get('max-concurrency'),
+            max_pool_connections=cache_conf.get('max-pool-connections'),
+        )
+    elif cache_conf['source'] == 'filesystem':
+        return cache.FilesystemBackend(
+            path=os.path.expanduser(cache_conf['path']),
+            max_size=cache_conf.get('max-size'),
+        )
+    else:
+        raise AssertionError('Unknown cache source')
+
+
 class Config(collections.namedtuple('Config', (
     'action',
     'dry_run',
@@ -25,10 +127,50 @@ class Config(collections.namedtuple('Config', (
     'output',
     'backend',
     'after_download',
+    'jobs',
+    'hash_algorithm',
+    'compression',
+    'compression_level',
+    'streaming',
+    'stream_buffer_size',
+    # restore only changed files, using a manifest stored with the artifact
+    'delta_restore',
+    # for the batch action: the targets to build, and how many at once
+    'targets',
+    'parallel_targets',
+    # where to write a trace of each phase's timings, and a directory for
+    # per-phase cProfile stats (see trace.py)
+    'trace',
+    'profile',
+    # if set, jobs building the same artifact at once take turns: one builds
+    # while the others wait up to this many seconds for it to be uploaded
+    'single_flight',
 ))):
 
     __slots__ = ()
 
+    def for_target(self, target):
+        """Return the config for building a single target.
+
+        Outputs of the target's dependencies are left out of its context;
+        the dependencies' context hashes are used instead (see main.batch).
+        """
+        dep_outputs = frozenset(
+            '/' + os.path.relpath(os.path.realpath(output))
+            for dep in self.targets
+            if dep.name in target.deps
+            for output in dep.output
+        )
+        return self._replace(
+            action='build',
+            context=target.context,
+            command=target.command,
+            ignore=self.ignore | target.ignore | dep_outputs,
+            output=target.output,
+            after_download=target.after_download,
+            targets=(),
+        )
+
     @classmethod
     def from_args(cls, args):
         """Return a config based on arguments and the config file.
@@ -54,6 +196,8 @@ class Config(collections.namedtuple('Config', (
             'ignore': [],
             'output': [],
             'after-download': [],
+            'targets': [],
+            'targets-file': [],
             'command': [],
         }
         toggles = {
@@ -120,6 +264,20 @@ class Config(collections.namedtuple('Config', (
         if remove(flags, {'--dry-run'}):
             toggles['dry-run'] = True
 
+        jobs = None
+        for flag in sorted(flags):
+            parsed = re.match('(?:--jobs=|-j)([1-9][0-9]*)$', flag)
+            if parsed is not None:
+                flags.remove(flag)
+                jobs = int(parsed.group(1))
+
+        paths = {'trace': None, 'profile': None}
+        for flag in sorted(flags):
+            parsed = re.match('--(trace|profile)=(.+)$', flag)
+            if parsed is not None:
+                flags.remove(flag)
+                paths[parsed.group(1)] = parsed.group(2)
+
         if flags:
             raise UsageError(
                 'Unknown flags: {}'.format(', '.join(sorted(flags))),
@@ -133,17 +291,85 @@ class Config(collections.namedtuple('Config', (
         conf_ignore = conf.get('ignore') or ()
         conf_ignore = frozenset(conf_ignore)
 
-        if conf['cache']['source'] == 's3':
-            backend = cache.S3Backend(
-                bucket=conf['cache']['bucket'],
-                path=conf['cache']['path'],
-            )
-        elif conf['cache']['source'] == 'filesystem':
-            backend = cache.FilesystemBackend(
-                path=conf['cache']['path'],
+        # A list of caches is layered, with the fastest first.
+        if isinstance(conf['cache'], list):
+            cache_confs = conf['cache']
+            backend = cache.ChainBackend(
+                tuple(_backend_from_config(c) for c in cache_confs),
             )
         else:
-            raise AssertionError('Unknown cache source')
+            cache_confs = [conf['cache']]
+            backend = _backend_from_config(conf['cache'])
+
+        # Every backend stores the same file, so there's only one codec. It's
+        # chosen by the slowest (last) cache, where it matters most.
+        cache_conf = cache_confs[-1]
+
+        hash_algorithm = conf.get('hash-algorithm', context.HASH_ALGORITHM)
+        if hash_algorithm not in context.HASH_ALGORITHMS:
+            raise UsageError(
+                f'Unknown hash algorithm: {hash_algorithm}\n'
+                'Available algorithms: {}'.format(
+                    ', '.join(sorted(context.HASH_ALGORITHMS)),
+                ),
+            )
+
+        codec = cache_conf.get('compression', 'none')
+        if codec not in compression.CODECS:
+            raise UsageError(
+                f'Unknown compression codec: {codec}\n'
+                'Available codecs: {}'.format(
+                    ', '.join(sorted(compression.CODECS)),
+                ),
+            )
+        elif not compression.CODECS[codec].available:
+            raise UsageError(
+                f'The {codec} codec requires the '
+                f'{compression.CODECS[codec].module} module to be installed.',
+            )
+
+        compression_level = cache_conf.get('compression-level')
+        if conf.get('chunking', False):
+            if cache_conf.get('max-size') is not None:
+                # Eviction doesn't know which chunks make up which artifact,
+                # so it could remove chunks of one it keeps, and the last
+                # cache has nowhere else to get them from.
+                raise UsageError(
+                    "Chunking can't be used when the last cache has a "
+                    'max-size.',
+                )
+            backend = cache.ChunkedBackend(
+                backend,
+                compression=codec,
+                compression_level=compression_level,
+                max_concurrency=cache_conf.get('max-concurrency', 8),
+            )
+            # Chunks are compressed individually, so the artifact itself is
+            # handed to the backend uncompressed.
+            codec, compression_level = 'none', None
+
+        single_flight = conf.get('single-flight', False)
+        if single_flight is True:
+            single_flight = 30 * 60
+        elif not single_flight:
+            single_flight = None
+
+        negative_cache_ttl = conf.get('negative-cache-ttl')
+        if negative_cache_ttl:
+            backend = cache.NegativeCacheBackend(backend, negative_cache_ttl)
+
+        targets = ()
+        if action == 'batch':
+            available = read_targets(conf, options['targets-file'])
+            names = options['targets'] or sorted(available)
+            unknown = sorted(set(names) - set(available))
+            if unknown:
+                raise UsageError(
+                    'Unknown targets: {}'.format(', '.join(unknown)),
+                )
+            elif not names:
+                raise UsageError('There are no targets to build')
+            targets = order_targets(available, names)
 
         return cls(
             action=action,
@@ -155,4 +381,16 @@ class Config(collections.namedtuple('Config', (
             output=frozenset(options['output']),
             backend=backend,
             after_download=tuple(options['after-download']),
+            jobs=jobs or conf.get('jobs') or os.cpu_count() or 1,
+            hash_algorithm=hash_algorithm,
+            compression=codec,
+            compression_level=compression_level,
+            streaming=conf.get('streaming', False),
+            stream_buffer_size=conf.get('stream-buffer-size', 64 * 2**20),
+            delta_restore=conf.get('delta-restore', False),
+            targets=targets,
+            parallel_targets=conf.get('parallel-targets', 4),
+            trace=paths['trace'],
+            profile=paths['profile'],
+            single_flight=single_flight,
         )
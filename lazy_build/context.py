@@ -1,32 +1,98 @@
 import collections
-import fnmatch
+import concurrent.futures
 import hashlib
-import itertools
 import json
 import os
 import os.path
+import re
 import shutil
-import subprocess
+import stat
+import tarfile
 import tempfile
 
+from lazy_build import compression
 
-def hash(data):
-    return hashlib.sha256(data).hexdigest()
+
+# The top-level context hash (which becomes the artifact key) always uses this
+# algorithm; the per-file digests can use a faster one if configured.
+HASH_ALGORITHM = 'sha256'
+
+HASH_ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'sha512': hashlib.sha512,
+    'blake2b': hashlib.blake2b,
+    'blake2s': hashlib.blake2s,
+}
+
+try:
+    import blake3
+except ImportError:  # pragma: no cover
+    pass
+else:  # pragma: no cover
+    HASH_ALGORITHMS['blake3'] = blake3.blake3
+
+try:
+    import xxhash
+except ImportError:  # pragma: no cover
+    pass
+else:  # pragma: no cover
+    HASH_ALGORITHMS['xxh64'] = xxhash.xxh64
+    HASH_ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+
+# Files larger than this are hashed in chunks of this size, so hashing a
+# multi-gigabyte file doesn't need more than this much memory.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash(data, algorithm=HASH_ALGORITHM):
+    return HASH_ALGORITHMS[algorithm](data).hexdigest()
+
+
+def hash_file(f, algorithm=HASH_ALGORITHM):
+    """Hash an unbuffered binary file object with bounded memory use."""
+    if os.fstat(f.fileno()).st_size <= HASH_CHUNK_SIZE:
+        return hash(f.read(), algorithm)
+
+    h = HASH_ALGORITHMS[algorithm]()
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        h.update(view[:n])
+    return h.hexdigest()
 
 
 class BuildContext(collections.namedtuple('BuildContext', (
     'command',
     'files',
+    'algorithm',
+    # context hashes of the targets this one depends on, by name
+    'deps',
 ))):
 
     __slots__ = ()
 
+    def __new__(cls, command, files, algorithm, deps=None):
+        return super().__new__(cls, command, files, algorithm, deps or {})
+
     @property
     def hash(self):
-        return hash(json.dumps(
-            (self.command, self.files),
-            sort_keys=True,
-        ).encode('utf8'))
+        # (Without dependencies, the hash is the same as it always was.)
+        if self.deps:
+            key = (self.command, self.files, self.deps)
+        else:
+            key = (self.command, self.files)
+        digest = hash(json.dumps(key, sort_keys=True).encode('utf8'))
+
+        # Contexts hashed with different per-file algorithms can never match,
+        # so keep their artifacts in separate namespaces. (The default has no
+        # prefix so that existing artifacts stay valid.)
+        if self.algorithm == HASH_ALGORITHM:
+            return digest
+        else:
+            return f'{self.algorithm}-{digest}'
 
 
 class FileContext(collections.namedtuple('FileContext', (
@@ -37,91 +103,531 @@ class FileContext(collections.namedtuple('FileContext', (
     __slots__ = ()
 
     @classmethod
-    def from_path(cls, path):
-        assert os.path.lexists(path), path
+    def from_path(cls, path, algorithm=HASH_ALGORITHM, is_link=None):
+        if is_link is None:
+            assert os.path.lexists(path), path
+            is_link = os.path.islink(path)
 
-        if os.path.islink(path):
+        if is_link:
             return cls(
                 'link',
-                hash(os.readlink(path).encode('utf8', 'surrogateescape')),
+                hash(
+                    os.readlink(path).encode('utf8', 'surrogateescape'),
+                    algorithm,
+                ),
             )
         else:
-            with open(path, 'rb') as f:
-                return cls('file', hash(f.read()))
+            with open(path, 'rb', buffering=0) as f:
+                return cls('file', hash_file(f, algorithm))
+
+
+def _translate(pattern):
+    """Translate a gitignore-style glob into a regular expression.
+
+    Unlike fnmatch, wildcards never match a slash (except for "**").
+    """
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if pattern[i:i + 1] == '*':
+                i += 1
+                if pattern[i:i + 1] == '/':
+                    i += 1
+                    res.append('(?:.*/)?')
+                else:
+                    res.append('.*')
+            else:
+                res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i
+            if pattern[j:j + 1] == '!':
+                j += 1
+            if pattern[j:j + 1] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j == -1:
+                res.append('\\[')
+            else:
+                chars = pattern[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if chars[0] == '!':
+                    chars = '^' + chars[1:]
+                elif chars[0] in '^[':
+                    chars = '\\' + chars
+                res.append('[' + chars + ']')
+        elif c == '\\' and i < n:
+            res.append(re.escape(pattern[i]))
+            i += 1
+        else:
+            res.append(re.escape(c))
+    return ''.join(res)
+
+
+def _compile_patterns(patterns):
+    if not patterns:
+        return None
+    else:
+        return re.compile('|'.join(
+            '(?:{})'.format(pattern) for pattern in sorted(patterns)
+        ))
+
+
+class IgnoreMatcher:
+    """gitignore-like pattern matching.
+
+    Patterns are compiled up front into a couple of combined regular
+    expressions: one matched against just the final path component (for the
+    common case of patterns without slashes), and one searched for in the
+    whole path.
+
+    A pattern matches a path if it matches any trailing run of the path's
+    components (e.g. "b/c" matches "a/b/c"), or the whole path if the pattern
+    starts with a slash. A trailing slash makes a pattern match directories
+    only, and a leading "!" re-includes paths matched by other patterns.
+    Since patterns are an unordered set, negations always win; as with git,
+    a path can't be re-included if one of its parent directories is ignored.
+    """
 
+    def __init__(self, patterns):
+        # (include, exclude) x (name patterns, path patterns)
+        compiled = (set(), set()), (set(), set())
+        for pattern in patterns:
+            negate = pattern.startswith('!')
+            if negate:
+                pattern = pattern[1:]
 
-def should_ignore(patterns, path):
+            # Directories are matched with a trailing slash appended.
+            suffix = '/' if pattern.endswith('/') else '/?'
+            pattern = pattern.rstrip('/')
+
+            if not pattern:
+                continue
+            elif pattern.startswith('/'):
+                regex = '^' + _translate(pattern.lstrip('/')) + suffix + '$'
+                compiled[negate][1].add(regex)
+            elif '/' in pattern:
+                regex = '(?:^|/)' + _translate(pattern) + suffix + '$'
+                compiled[negate][1].add(regex)
+            else:
+                compiled[negate][0].add(_translate(pattern) + suffix)
+
+        self._include, self._exclude = (
+            tuple(_compile_patterns(regexes) for regexes in group)
+            for group in compiled
+        )
+
+    @staticmethod
+    def _search(regexes, path, name):
+        names, paths = regexes
+        return (
+            (names is not None and names.fullmatch(name) is not None) or
+            (paths is not None and paths.search(path) is not None)
+        )
+
+    def matches(self, path, is_dir=False):
+        """Return whether the path itself (ignoring its parents) matches."""
+        name = path.rpartition('/')[2]
+        if is_dir:
+            path += '/'
+            name += '/'
+        return (
+            self._search(self._include, path, name) and
+            not self._search(self._exclude, path, name)
+        )
+
+    def __call__(self, path, is_dir=False):
+        """Return whether the path or any of its parent directories match."""
+        parts = path.split('/')
+        return any(
+            self.matches('/'.join(parts[:i]), is_dir=True)
+            for i in range(1, len(parts))
+        ) or self.matches(path, is_dir)
+
+
+def should_ignore(patterns, path, is_dir=False):
     """gitignore-like pattern matching"""
-    path = '/' + path
-
-    # We need to get all "substring" paths, e.g. for a/b/c we need:
-    # a; a/b; a/b/c; b; b/c; c
-    components = path.split('/')
-    paths = {
-        '/'.join(components[i:j + 1])
-        for i in range(len(components))
-        for j in range(len(components))
-    }
+    return IgnoreMatcher(patterns)(path, is_dir)
 
-    return any(
-        fnmatch.fnmatch(path, pattern)
-        for path, pattern in itertools.product(paths, patterns)
-    )
 
+def find_files(paths, matcher):
+    """Yield (path, is_link) for each file under the given paths.
 
-def build_context(conf):
-    ctx = {}
-    fringe = {
-        os.path.relpath(os.path.realpath(path)) for path in conf.context
-    }
-    explored = set()
+    Directories are walked with os.scandir so that we get file types from the
+    directory entries instead of statting each path, and ignored directories
+    are pruned before we ever list them.
+    """
+    roots = {os.path.relpath(os.path.realpath(path)) for path in paths}
+    fringe = []
+    for path in sorted(roots):
+        is_link = os.path.islink(path)
+        is_dir = not is_link and os.path.isdir(path)
+        if matcher(path, is_dir):
+            continue
+        elif is_dir:
+            fringe.append(path)
+        else:
+            yield path, is_link
 
+    explored = set()
     while len(fringe) > 0:
         path = fringe.pop()
+        if path in explored:
+            continue
         explored.add(path)
 
-        if should_ignore(conf.ignore, path):
-            continue
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if path == '.':
+                    child = entry.name
+                else:
+                    child = path + '/' + entry.name
 
-        if os.path.isdir(path) and not os.path.islink(path):
-            for child in os.listdir(path):
-                child = os.path.relpath(os.path.join(path, child))
-                fringe.add(child)
-        else:
-            ctx[path] = FileContext.from_path(path)
+                # Parents have already been checked, so we only need to look
+                # at the entry itself.
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if matcher.matches(child, is_dir):
+                    continue
+                elif is_dir:
+                    fringe.append(child)
+                else:
+                    yield child, entry.is_symlink()
 
-    return BuildContext(command=conf.command, files=ctx)
 
+def build_contexts(confs, hash_cache=None):
+    """Build the contexts for several configs at once.
 
-def package_artifact(conf):
-    fd, tmp = tempfile.mkstemp()
-    os.close(fd)
+    Files shared between contexts are only hashed once, and all of the files
+    are hashed by a single pool of workers.
+    """
+    algorithm = confs[0].hash_algorithm
+    jobs = max(conf.jobs for conf in confs)
+    assert all(conf.hash_algorithm == algorithm for conf in confs)
 
-    paths = set()
-    for output_path in conf.output:
-        if os.path.isdir(output_path):
-            for path, _, filenames in os.walk(output_path):
-                for filename in filenames:
-                    paths.add(os.path.join(path, filename))
-        else:
-            paths.add(output_path)
-
-    subprocess.run(
-        ('tar', '-cf', tmp, '--files-from', '-'),
-        input=b'\n'.join(
-            path.encode('utf8', 'surrogateescape') for path in paths
-        ),
-        check=True,
-    )
+    conf_paths = [
+        dict(find_files(conf.context, IgnoreMatcher(conf.ignore)))
+        for conf in confs
+    ]
+    paths = {}
+    for conf_path in conf_paths:
+        paths.update(conf_path)
+
+    if hash_cache is not None:
+        assert hash_cache.algorithm == algorithm
+        file_context = hash_cache.file_context
+    else:
+        def file_context(path, is_link):
+            return FileContext.from_path(path, algorithm, is_link)
+
+    # Hashing is mostly I/O and hashlib (which releases the GIL), so threads
+    # scale well here. Results are keyed by path, so the order in which they
+    # complete can't affect the final hash.
+    if jobs > 1 and len(paths) > 1:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            file_contexts = dict(zip(
+                paths,
+                executor.map(file_context, paths, paths.values()),
+            ))
+    else:
+        file_contexts = {
+            path: file_context(path, is_link)
+            for path, is_link in paths.items()
+        }
+
+    return [
+        BuildContext(
+            command=conf.command,
+            files={path: file_contexts[path] for path in conf_path},
+            algorithm=algorithm,
+        )
+        for conf, conf_path in zip(confs, conf_paths)
+    ]
+
+
+def build_context(conf, hash_cache=None):
+    ctx, = build_contexts([conf], hash_cache)
+    return ctx
+
+
+def manifest_entry(info, digest=None):
+    """Describe a tar member in a file manifest.
+
+    A manifest lists an artifact's members (in the order they appear in the
+    tarball) with the digests of their contents, so restoring can skip files
+    which are already up to date.
+    """
+    return {
+        'name': info.name,
+        'type': info.type.decode('ascii'),
+        'mode': info.mode,
+        'mtime': info.mtime,
+        'uid': info.uid,
+        'gid': info.gid,
+        'size': info.size if info.isreg() else 0,
+        'linkname': info.linkname,
+        'digest': digest,
+    }
+
+
+class _HashingReader:
+    """Wrap a file object, hashing everything read from it."""
+
+    def __init__(self, fileobj, algorithm):
+        self._fileobj = fileobj
+        self.hash = HASH_ALGORITHMS[algorithm]()
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+
+def _add_to_tarball(tf, path, manifest=None):
+    """Add a path (recursively) to a tarball.
+
+    This is like TarFile.add, but walks with os.scandir and skips the
+    per-file user and group name lookups. If a manifest is given, an entry is
+    added to it for each member.
+    """
+    st = os.lstat(path)
+    info = tarfile.TarInfo(path)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.mtime = st.st_mtime
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    digest = None
+
+    if stat.S_ISREG(st.st_mode):
+        info.size = st.st_size
+        with open(path, 'rb') as f:
+            if manifest is None:
+                tf.addfile(info, f)
+            else:
+                reader = _HashingReader(f, manifest['algorithm'])
+                tf.addfile(info, reader)
+                digest = reader.hash.hexdigest()
+    elif stat.S_ISLNK(st.st_mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(path)
+        tf.addfile(info)
+    elif stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+        tf.addfile(info)
+    else:
+        raise ValueError(f'Unable to package special file: {path}')
+
+    if manifest is not None:
+        manifest['members'].append(manifest_entry(info, digest))
+
+    if info.isdir():
+        with os.scandir(path) as entries:
+            children = sorted(entry.name for entry in entries)
+        for child in children:
+            _add_to_tarball(tf, os.path.join(path, child), manifest)
+
+
+def new_manifest(conf):
+    return {'algorithm': conf.hash_algorithm, 'members': []}
+
+
+def write_artifact(conf, fileobj, manifest=None):
+    """Write a compressed tarball of the build outputs to a file object.
+
+    The file object doesn't need to be seekable, so this can be uploaded as
+    it's written. Symlinks, permissions, and empty directories are all
+    preserved. If a manifest (from new_manifest) is given, it's filled in
+    with the artifact's members. Returns the number of members.
+    """
+    with compression.compress(
+            conf.compression,
+            fileobj,
+            conf.compression_level,
+            conf.jobs,
+    ) as compressed:
+        with tarfile.open(
+                fileobj=compressed,
+                mode='w|',
+                format=tarfile.GNU_FORMAT,
+        ) as tf:
+            for output_path in sorted(conf.output):
+                _add_to_tarball(tf, output_path, manifest)
+            return len(tf.members)
+
+
+def package_artifact(conf, dir=None, manifest=None):
+    fd, tmp = tempfile.mkstemp(prefix='.lazy-build-', dir=dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_artifact(conf, f, manifest)
+    except BaseException:
+        os.remove(tmp)
+        raise
     return tmp
 
 
-def extract_artifact(conf, artifact):
+def read_artifact(conf, fileobj, compression_name='none'):
+    """Extract a (possibly compressed) tarball from a file object.
+
+    The file object doesn't need to be seekable, so this can extract while
+    the artifact is still downloading. Returns the number of members.
+    """
+    with compression.decompress(compression_name, fileobj) as decompressed:
+        with tarfile.open(fileobj=decompressed, mode='r|') as tf:
+            if hasattr(tarfile, 'tar_filter'):  # pragma: no cover (py312+)
+                # Same protections as GNU tar: no absolute paths or paths
+                # escaping the current directory.
+                tf.extractall(filter='tar')
+            else:  # pragma: no cover (<py312)
+                tf.extractall()
+            return len(tf.members)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def remove_outputs(conf):
     for output_path in conf.output:
         if os.path.lexists(output_path):
-            if os.path.isdir(output_path) and not os.path.islink(output_path):
-                shutil.rmtree(output_path)
-            else:
-                os.remove(output_path)
+            _remove(output_path)
 
-    subprocess.run(('tar', '-xf', artifact), check=True)
+
+def _remove_stale(path, members):
+    """Remove anything under path which doesn't match the manifest's type."""
+    member = members.get(path)
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+
+    if member is None or _entry_type(member) != _stat_type(st):
+        _remove(path)
+    elif stat.S_ISDIR(st.st_mode):
+        with os.scandir(path) as entries:
+            children = [entry.name for entry in entries]
+        for child in children:
+            _remove_stale(os.path.join(path, child), members)
+
+
+def _entry_type(member):
+    type_ = member['type'].encode('ascii')
+    return tarfile.REGTYPE if type_ == tarfile.AREGTYPE else type_
+
+
+def _stat_type(st):
+    if stat.S_ISREG(st.st_mode):
+        return tarfile.REGTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        return tarfile.SYMTYPE
+    elif stat.S_ISDIR(st.st_mode):
+        return tarfile.DIRTYPE
+    else:
+        return None
+
+
+def _is_unchanged(member, algorithm, hash_cache):
+    """Return whether the file on disk already matches a manifest entry.
+
+    _remove_stale has already removed anything of the wrong type.
+    """
+    path = member['name']
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return False
+
+    type_ = _entry_type(member)
+    if type_ == tarfile.DIRTYPE:
+        return True
+    elif type_ == tarfile.SYMTYPE:
+        return os.readlink(path) == member['linkname']
+    elif type_ == tarfile.REGTYPE and st.st_size == member['size']:
+        if hash_cache is not None and hash_cache.algorithm == algorithm:
+            file_ctx = hash_cache.file_context(path, False)
+        else:
+            file_ctx = FileContext.from_path(path, algorithm, False)
+        return file_ctx.content_hash == member['digest']
+    else:
+        return False
+
+
+def _extract(tf, info, set_attrs=True):
+    if hasattr(tarfile, 'tar_filter'):  # pragma: no cover (py312+)
+        tf.extract(info, set_attrs=set_attrs, filter='tar')
+    else:  # pragma: no cover (<py312)
+        tf.extract(info, set_attrs=set_attrs)
+
+
+def restore_artifact(
+        conf, fileobj, manifest, compression_name='none', hash_cache=None,
+):
+    """Update the outputs to match an artifact, using its manifest.
+
+    Unlike read_artifact, only files which differ from the artifact are
+    written; files which are already up to date (according to their digests
+    in the manifest) are left alone. Returns the number of members written.
+    """
+    members = {member['name']: member for member in manifest['members']}
+    for output_path in conf.output:
+        _remove_stale(output_path, members)
+
+    def is_unchanged(member):
+        return _is_unchanged(member, manifest['algorithm'], hash_cache)
+
+    if conf.jobs > 1 and len(members) > 1:
+        with concurrent.futures.ThreadPoolExecutor(conf.jobs) as executor:
+            unchanged = executor.map(is_unchanged, members.values())
+    else:
+        unchanged = map(is_unchanged, members.values())
+    unchanged = {
+        name
+        for name, is_same in zip(members, list(unchanged))
+        if is_same
+    }
+
+    written = 0
+    dirs = []
+    with compression.decompress(compression_name, fileobj) as decompressed:
+        with tarfile.open(fileobj=decompressed, mode='r|') as tf:
+            for info in tf:
+                if info.isdir():
+                    # Like extractall, set directory permissions at the end
+                    # in case they're read-only.
+                    dirs.append(info)
+                    if info.name not in unchanged:
+                        written += 1
+                        _extract(tf, info, set_attrs=False)
+                elif info.name in unchanged:
+                    if not info.issym():
+                        os.chmod(info.name, info.mode)
+                else:
+                    written += 1
+                    if os.path.lexists(info.name):
+                        _remove(info.name)
+                    _extract(tf, info)
+
+    for info in reversed(dirs):
+        os.chmod(info.name, info.mode)
+        os.utime(info.name, (info.mtime, info.mtime))
+    return written
+
+
+def extract_artifact(
+        conf, artifact, compression_name='none', manifest=None,
+        hash_cache=None,
+):
+    with open(artifact, 'rb') as f:
+        if manifest is None:
+            remove_outputs(conf)
+            return read_artifact(conf, f, compression_name)
+        else:
+            return restore_artifact(
+                conf, f, manifest, compression_name, hash_cache,
+            )
@@ -0,0 +1,113 @@
+"""Persistent index of file hashes keyed by stat information.
+
+This works a lot like git's index: we remember the stat information of every
+file we hash, and on later runs only re-hash files whose stat information has
+changed since then.
+"""
+import json
+import os
+import os.path
+import stat
+import threading
+
+import lazy_build
+from lazy_build import context
+from lazy_build import util
+
+
+def index_path():
+    """Return the path to the index for the current project."""
+    return os.path.join(
+        util.cache_dir(),
+        'index',
+        context.hash(os.path.realpath('.').encode('utf8', 'surrogateescape')),
+    ) + '.json'
+
+
+def _stat_key(st):
+    return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+
+class HashCache:
+
+    def __init__(self, path, algorithm, entries=None, timestamp=None):
+        self.path = path
+        self.algorithm = algorithm
+        self.entries = entries or {}
+        # mtime of the index file when it was loaded; entries for files
+        # modified at or after this point are "racily clean" and can't be
+        # trusted (the file could have changed again within the same
+        # timestamp granularity after we hashed it).
+        self.timestamp = timestamp
+        self.hits = 0
+        self.misses = 0
+        # paths looked up in this run, which are known to still exist
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, algorithm=context.HASH_ALGORITHM):
+        try:
+            with open(path) as f:
+                timestamp = os.fstat(f.fileno()).st_mtime_ns
+                data = json.load(f)
+        except (OSError, ValueError):
+            # Missing, corrupt or unreadable: start from scratch.
+            return cls(path, algorithm)
+
+        if (
+                data.get('version') != lazy_build.__version__ or
+                data.get('algorithm') != algorithm
+        ):
+            return cls(path, algorithm)
+        else:
+            return cls(path, algorithm, data['entries'], timestamp)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Other threads may still be adding entries.
+        with util.atomic_write(self.path) as f, self.lock:
+            # Drop files which have been deleted so the index doesn't grow
+            # forever.  Files we didn't look up may belong to another config
+            # in this project, so they're kept as long as they exist.
+            self.entries = {
+                path: entry for path, entry in self.entries.items()
+                if path in self.seen or os.path.lexists(path)
+            }
+            json.dump(
+                {
+                    'version': lazy_build.__version__,
+                    'algorithm': self.algorithm,
+                    'entries': self.entries,
+                },
+                f,
+            )
+
+    def _is_racy(self, key):
+        return self.timestamp is None or key[2] >= self.timestamp
+
+    def file_context(self, path, is_link=None):
+        if is_link:
+            # Reading a link is as cheap as statting it.
+            return context.FileContext.from_path(path, self.algorithm, True)
+
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            return context.FileContext.from_path(path, self.algorithm, True)
+
+        key = _stat_key(st)
+        entry = self.entries.get(path)
+        if entry is not None and entry[:-1] == key and not self._is_racy(key):
+            with self.lock:
+                self.hits += 1
+                self.seen.add(path)
+            return context.FileContext('file', entry[-1])
+        else:
+            file_ctx = context.FileContext.from_path(
+                path, self.algorithm, False,
+            )
+            with self.lock:
+                self.misses += 1
+                self.seen.add(path)
+                self.entries[path] = key + [file_ctx.content_hash]
+            return file_ctx
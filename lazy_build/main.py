@@ -1,72 +1,368 @@
+import concurrent.futures
+import contextlib
 import json
 import os
 import shlex
 import subprocess
 import sys
+import time
 
 from lazy_build import color
 from lazy_build import config
 from lazy_build import context
+from lazy_build import hashcache
 from lazy_build import progressbar
+from lazy_build import stamp
+from lazy_build import trace
+from lazy_build import util
 
 
-def log(line, **kwargs):
-    kwargs.setdefault('file', sys.stderr)
-    kwargs.setdefault('flush', True)
-    print('{}'.format(line), **kwargs)
+def log(line, end='\n'):
+    # Goes through the progress renderer, so it isn't mixed up with any
+    # progress bars being drawn.
+    progressbar.write('{}{}'.format(line, end))
+
+
+def save_hash_cache(hash_cache):
+    # The index only saves work next time, so failing to write it (e.g. on a
+    # CI runner with a read-only home directory) shouldn't fail the build.
+    try:
+        hash_cache.save()
+    except OSError as ex:
+        log(color.red(f'Warning: could not save the hash index: {ex}'))
 
 
 def build(conf):
-    ctx = context.build_context(conf)
+    hash_cache = hashcache.HashCache.load(
+        hashcache.index_path(),
+        conf.hash_algorithm,
+    )
+    with trace.span('hash context') as span:
+        ctx = context.build_context(conf, hash_cache)
+        save_hash_cache(hash_cache)
+        span.update(
+            files=len(ctx.files),
+            hash_cache_hits=hash_cache.hits,
+            hash_cache_misses=hash_cache.misses,
+        )
 
     if conf.verbose:
         log('Generated build context with hash {}'.format(ctx.hash))
+        log('Hash cache: {} hits, {} misses'.format(
+            hash_cache.hits, hash_cache.misses,
+        ))
         log('Individual files:')
         log(json.dumps(ctx.files, indent=True, sort_keys=True))
 
+    with trace.span('check stamp') as span:
+        span['current'] = current = stamp.is_current(conf, ctx)
+    if current:
+        log(color.bg_gray('Outputs are already up to date.'))
+        return
+
+    with trace.span('lookup') as span:
+        artifact = conf.backend.artifact_details(ctx)
+        span['found'] = artifact is not None
+    build_target(conf, ctx, artifact, hash_cache)
+
+
+def write_stamp(conf, ctx, prefix=''):
+    # Like the hash index, the stamp only saves work next time.
+    try:
+        stamp.write(conf, ctx)
+    except OSError as ex:
+        log(color.red(f'{prefix}Warning: could not write the stamp: {ex}'))
+
+
+def build_target(conf, ctx, artifact, hash_cache=None, name=None):
+    prefix = '' if name is None else f'{name}: '
+    with contextlib.ExitStack() as stack:
+        if artifact is None and conf.single_flight is not None:
+            artifact, lease = claim_build(conf, ctx, prefix)
+            if lease is not None:
+                stack.enter_context(lease)
+
+        with trace.span(
+                'restore' if artifact is not None else 'build',
+                profile=False,
+                target=name,
+                hash=ctx.hash,
+        ):
+            if artifact is not None:
+                log(color.bg_gray(
+                    prefix + 'Found remote build artifact, downloading.',
+                ))
+                build_from_artifact(conf, ctx, artifact, hash_cache, name)
+            else:
+                log(color.bg_gray(
+                    prefix +
+                    'Found no remote build artifact, building locally.',
+                ))
+                build_from_command(conf, ctx, name)
+            write_stamp(conf, ctx, prefix)
+
+
+# How often (in seconds) to check whether another job has finished building.
+POLL_INTERVAL = 5
+
+
+def _try_claim(conf, ctx):
+    lease = conf.backend.acquire_lease(ctx)
+    if lease is None:
+        return None, None
+    # The artifact might have been uploaded (and the lease released) since
+    # we last looked.
     artifact = conf.backend.artifact_details(ctx)
     if artifact is not None:
-        log(color.bg_gray('Found remote build artifact, downloading.'))
-        return build_from_artifact(conf, ctx, artifact)
+        lease.release()
+        return artifact, None
+    return None, lease
+
+
+def claim_build(conf, ctx, prefix=''):
+    """Claim the build of ctx, or wait for the job which already has.
+
+    Returns (artifact details, lease). The artifact details are set if
+    another job built it; otherwise the lease is ours to build it under. The
+    lease is None if we gave up waiting after conf.single_flight seconds, in
+    which case we build it anyway.
+    """
+    artifact, lease = _try_claim(conf, ctx)
+    if artifact is not None or lease is not None:
+        return artifact, lease
+
+    log(color.bg_gray(
+        prefix + 'Another job is building this artifact, waiting for it...',
+    ))
+    with trace.span('wait for build') as span:
+        deadline = time.monotonic() + conf.single_flight
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(POLL_INTERVAL, remaining))
+
+            artifact = conf.backend.artifact_details(ctx)
+            if artifact is None:
+                # If the other job failed or died, its lease is released (or
+                # expires) and we take over.
+                artifact, lease = _try_claim(conf, ctx)
+            if artifact is not None or lease is not None:
+                span['took_over'] = lease is not None
+                return artifact, lease
+        span['timed_out'] = True
+
+    log(color.yellow(
+        prefix + 'Gave up waiting for the other job after '
+        f'{conf.single_flight} seconds.',
+    ))
+    return None, None
+
+
+def build_from_artifact(conf, ctx, artifact, hash_cache=None, name=None):
+    manifest = None
+    if conf.delta_restore:
+        with trace.span('fetch file manifest') as span:
+            manifest = conf.backend.file_manifest(ctx)
+            span['found'] = manifest is not None
+        if manifest is None and conf.verbose:
+            log('No file manifest, falling back to full extraction.')
+
+    if conf.streaming:
+        log(color.yellow('Downloading and extracting artifact...'))
+        if manifest is None:
+            context.remove_outputs(conf)
+
+            def extract(f):
+                return context.read_artifact(conf, f, artifact.compression)
+        else:
+            def extract(f):
+                return context.restore_artifact(
+                    conf, f, manifest, artifact.compression, hash_cache,
+                )
+
+        with trace.span('download and extract') as span:
+            with progressbar.Progress(artifact.size, name) as callback:
+                files = util.pipeline(
+                    lambda f: conf.backend.stream_artifact(ctx, f, callback),
+                    extract,
+                    conf.stream_buffer_size,
+                )
+            span.update(bytes=callback.so_far, files=files)
     else:
-        log(color.bg_gray('Found no remote build artifact, building locally.'))
-        return build_from_command(conf, ctx)
+        log(color.yellow('Downloading artifact...'))
+        with contextlib.ExitStack() as stack:
+            with trace.span('download') as span:
+                with progressbar.Progress(artifact.size, name) as callback:
+                    path = stack.enter_context(
+                        conf.backend.get_artifact(ctx, callback),
+                    )
+                span['bytes'] = artifact.size
+            log(color.yellow('Extracting artifact...'), end=' ')
+            with trace.span('extract') as span:
+                span['files'] = context.extract_artifact(
+                    conf, path, artifact.compression, manifest, hash_cache,
+                )
+            log(color.yellow('done!'))
 
+    if manifest is not None and hash_cache is not None:
+        save_hash_cache(hash_cache)
 
-def build_from_artifact(conf, ctx, artifact):
-    log(color.yellow('Downloading artifact...'))
-    with progressbar.Progress(artifact.size) as callback:
-        artifact = conf.backend.get_artifact(ctx, callback)
-    try:
-        log(color.yellow('Extracting artifact...'), end=' ')
-        context.extract_artifact(conf, artifact)
-        log(color.yellow('done!'))
-    finally:
-        os.remove(artifact)
     if conf.after_download:
         log(color.yellow('Running after-download script...'))
         log(color.yellow(
             '$ ' + ' '.join(shlex.quote(arg) for arg in conf.after_download)
         ))
-        subprocess.check_call(conf.after_download)
+        with trace.span('after-download'):
+            subprocess.check_call(conf.after_download)
         log(color.yellow('Done!'))
 
 
-def build_from_command(conf, ctx):
+def build_from_command(conf, ctx, name=None):
     log(color.yellow('$ ' + ' '.join(shlex.quote(arg) for arg in ctx.command)))
-    subprocess.check_call(ctx.command)
-    log(color.yellow('Packaging artifact...'), end=' ')
-    path = context.package_artifact(conf)
-    log(color.yellow('done!'))
-    try:
-        log(color.yellow('Uploading artifact to shared cache...'))
+    with trace.span('command'):
+        subprocess.check_call(ctx.command)
 
-        total_bytes = os.stat(path).st_size
-        with progressbar.Progress(total_bytes) as callback:
-            conf.backend.store_artifact(ctx, path, callback)
+    manifest = context.new_manifest(conf) if conf.delta_restore else None
+    if conf.streaming:
+        # Packaging happens concurrently with the upload.
+        log(color.yellow('Uploading artifact to shared cache...'))
+        with trace.span('package and upload') as span:
+            files = []
+            # We don't know the final size until packaging is done.
+            with progressbar.Progress(None, name) as callback:
+                util.pipeline(
+                    lambda f: files.append(
+                        context.write_artifact(conf, f, manifest),
+                    ),
+                    lambda f: conf.backend.store_artifact_stream(
+                        ctx, f, callback, conf.compression,
+                    ),
+                    conf.stream_buffer_size,
+                )
+            span.update(bytes=callback.so_far, files=files[0])
+        if manifest is not None:
+            with trace.span('store file manifest'):
+                conf.backend.store_file_manifest(ctx, manifest)
+        log(color.yellow('done!'))
+    else:
+        log(color.yellow('Packaging artifact...'), end=' ')
+        with trace.span('package') as span:
+            path = context.package_artifact(
+                conf, conf.backend.tempdir(), manifest,
+            )
+            span['bytes'] = os.stat(path).st_size
         log(color.yellow('done!'))
-    finally:
-        os.remove(path)
+        try:
+            # The manifest goes first, so it's there as soon as the artifact
+            # is.
+            if manifest is not None:
+                with trace.span('store file manifest'):
+                    conf.backend.store_file_manifest(ctx, manifest)
+            log(color.yellow('Uploading artifact to shared cache...'))
+
+            total_bytes = os.stat(path).st_size
+            with trace.span('upload', bytes=total_bytes):
+                with progressbar.Progress(total_bytes, name) as callback:
+                    conf.backend.store_artifact(
+                        ctx, path, callback, conf.compression,
+                    )
+            log(color.yellow('done!'))
+        finally:
+            os.remove(path)
+
+
+def batch(conf):
+    """Build several targets, sharing as much work as possible.
+
+    Each target is built as soon as all of its dependencies have been, with
+    up to conf.parallel_targets being built at once.
+    """
+    hash_cache = hashcache.HashCache.load(
+        hashcache.index_path(),
+        conf.hash_algorithm,
+    )
+    confs = {target.name: conf.for_target(target) for target in conf.targets}
+    with trace.span('hash contexts') as span:
+        base_ctxs = context.build_contexts(list(confs.values()), hash_cache)
+        save_hash_cache(hash_cache)
+        span.update(
+            targets=len(base_ctxs),
+            files=len({path for ctx in base_ctxs for path in ctx.files}),
+            hash_cache_hits=hash_cache.hits,
+            hash_cache_misses=hash_cache.misses,
+        )
+
+    # Targets are in dependency order, so their dependencies' hashes are
+    # always known by the time we get to them.
+    ctxs = {}
+    for target, ctx in zip(conf.targets, base_ctxs):
+        ctxs[target.name] = ctx._replace(deps={
+            dep: ctxs[dep].hash for dep in target.deps
+        })
+
+    pending = {}
+    for target in conf.targets:
+        ctx = ctxs[target.name]
+        if conf.verbose:
+            log(f'Target {target.name} has context hash {ctx.hash}')
+        if stamp.is_current(confs[target.name], ctx):
+            log(color.bg_gray(
+                f'{target.name}: outputs are already up to date.',
+            ))
+        else:
+            pending[target.name] = target
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(
+            conf.parallel_targets,
+    ) as executor:
+        # Hashes don't depend on the dependencies' outputs, so every lookup
+        # can happen up front.
+        with trace.span('lookup', targets=len(pending)) as span:
+            artifacts = dict(zip(pending, conf.backend.artifact_details_many(
+                [ctxs[name] for name in pending],
+            )))
+            span['found'] = sum(1 for a in artifacts.values() if a is not None)
+
+        running = {}
+        while pending or running:
+            for name, target in list(pending.items()):
+                unfinished = set(pending) | set(running.values())
+                failed_deps = [dep for dep in target.deps if dep in failed]
+                if failed_deps:
+                    log(color.red(
+                        f'{name}: skipped, since {failed_deps[0]} failed',
+                    ))
+                    failed.append(name)
+                    del pending[name]
+                elif not unfinished.intersection(target.deps):
+                    future = executor.submit(
+                        build_target,
+                        confs[name],
+                        ctxs[name],
+                        artifacts[name],
+                        hash_cache,
+                        name,
+                    )
+                    running[future] = name
+                    del pending[name]
+
+            done, _ = concurrent.futures.wait(
+                running,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except Exception as ex:
+                    log(color.red(f'{name}: failed: {ex}'))
+                    failed.append(name)
+
+    if failed:
+        log(color.red('Failed targets: {}'.format(', '.join(failed))))
+        return 1
 
 
 def invalidate(conf):
@@ -74,6 +370,7 @@ def invalidate(conf):
 
 
 ACTIONS = {
+    'batch': batch,
     'build': build,
     'invalidate': invalidate,
 }
@@ -81,4 +378,5 @@ ACTIONS = {
 
 def main(argv=None):
     conf = config.Config.from_args(argv or sys.argv[1:])
-    return ACTIONS[conf.action](conf)
+    with trace.tracing(conf.trace, conf.profile):
+        return ACTIONS[conf.action](conf)
@@ -1,3 +1,4 @@
+import collections
 import shutil
 import sys
 import threading
@@ -17,17 +18,38 @@ def best_unit(num):
         return ('B ', 1)
 
 
-def progressbar(cur, total, speed, precision=1, file=sys.stderr):
+def progressbar(
+        cur, total, speed, precision=1, file=sys.stderr, label=None,
+):
     """Draw a progress bar.
 
     It looks like this:
     [=======>        ] 10.1MB / 30.2MB |   5.2 MB/s
+
+    If the total is unknown (None), only the progress so far is shown:
+    10.1MB |   5.2 MB/s
+
+    A label, if given, is shown in front: "venv: [====>   ] ..."
     """
     if not file.isatty():
         return ''
 
+    prefix = '' if label is None else f'{label}: '
+
     precision_fmt = '{{:.{}f}}'.format(precision)
-    percent = cur / total
+
+    if total is None:
+        cur_unit = best_unit(cur)
+        speed_unit = best_unit(speed)
+        return '\r{}{} | {}/s'.format(
+            prefix,
+            precision_fmt.format(cur / cur_unit[1]) + cur_unit[0],
+            precision_fmt.format(speed / speed_unit[1]) + speed_unit[0],
+        )
+
+    # Nothing to transfer (e.g. an artifact of empty files) is as good as
+    # done.
+    percent = cur / total if total else 1
 
     progress_unit = best_unit(total)
     cur /= progress_unit[1]
@@ -42,7 +64,7 @@ def progressbar(cur, total, speed, precision=1, file=sys.stderr):
     # Do the actual drawing!
     width = shutil.get_terminal_size().columns
 
-    width -= len('[>]  /  | /s')
+    width -= len('[>]  /  | /s') + len(prefix)
     width -= len(total) * 2
     # Technically the speed could suddenly become more than 3 digits (unlike
     # the total, which is fixed) and cause the progress bar to move, but that's
@@ -61,50 +83,162 @@ def progressbar(cur, total, speed, precision=1, file=sys.stderr):
         total=total,
         speed=speed.rjust(speed_width)
     )
-    return '\r' + line
+    return '\r' + prefix + line
+
+
+# How often progress bars are redrawn, and how far back (in seconds) speeds
+# are averaged.
+INTERVAL = 0.1
+SPEED_WINDOW = 5
 
 
 class Progress:
+    """The progress of one transfer, drawn as a bar while in a with block.
 
-    def __init__(self, total_bytes):
-        self.history = []
-        self.so_far = 0
+    Call it with the number of bytes transferred each time more are. Calls
+    only add to a counter, so they're cheap enough to make for every chunk;
+    the bar is drawn in the background by a Renderer.
+    """
+
+    def __init__(self, total_bytes, label=None, renderer=None):
         self.total_bytes = total_bytes
+        self.label = label
+        self.renderer = renderer or _renderer
+        self.so_far = 0
+        self.speed = 0
         self.lock = threading.Lock()
+        # (time, bytes so far) as of each redraw over the last SPEED_WINDOW
+        # seconds, oldest first.
+        self.samples = collections.deque()
 
     def __enter__(self):
+        self.renderer.add(self)
         return self
 
     def __exit__(self, type_, value, traceback):
-        if sys.stderr.isatty():
-            print(file=sys.stderr, flush=True)
-        else:
-            pass  # pragma: no cover
+        self.renderer.remove(self)
 
     def __call__(self, cur_bytes):
         with self.lock:
             self.so_far += cur_bytes
 
-            now = time.time()
-            self.history.append((now, self.so_far))
-
-            if len(self.history) > 1:
-                first = self.history[0]
-                speed = (self.so_far - first[1]) / (now - first[0])
-            else:
-                speed = 0
-
-            while len(self.history) > 0 and now - self.history[0][0] > 5:
-                del self.history[0]
-
-            print(
-                progressbar(
-                    self.so_far,
-                    self.total_bytes,
-                    speed,
-                    file=sys.stderr,
-                ),
-                file=sys.stderr,
-                flush=True,
-                end='',
-            )
+    def sample(self, now):
+        """Record the progress so far, and update the speed."""
+        so_far = self.so_far
+        self.samples.append((now, so_far))
+        first_time, first_bytes = self.samples[0]
+        if now > first_time:
+            self.speed = (so_far - first_bytes) / (now - first_time)
+        while now - self.samples[0][0] > SPEED_WINDOW:
+            self.samples.popleft()
+
+
+class Renderer:
+    """Draws the active progress bars on stderr from a background thread.
+
+    Each bar gets a line of its own, so concurrent transfers are shown
+    together. Other output should go through write(), so that it appears
+    above the bars rather than mixed up with them.
+    """
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.bars = []
+        self.lock = threading.Lock()
+        # how many lines of bars are currently on the screen
+        self._lines = 0
+        # the thread which last wrote a line without finishing it
+        self._partial = None
+        self._stop = None
+        self._thread = None
+
+    def _clear(self):
+        if not self._lines:
+            return ''
+        up = f'\x1b[{self._lines - 1}A' if self._lines > 1 else ''
+        self._lines = 0
+        return up + '\r\x1b[J'
+
+    def _line(self, progress):
+        line = progressbar(
+            progress.so_far,
+            progress.total_bytes,
+            progress.speed,
+            file=sys.stderr,
+            label=progress.label,
+        )
+        return line.lstrip('\r')
+
+    def _draw(self, finished=None):
+        """Redraw the bars, leaving `finished` above them for good."""
+        out = self._clear()
+        if finished is not None:
+            out += self._line(finished) + '\n'
+        out += '\n'.join(self._line(progress) for progress in self.bars)
+        self._lines = len(self.bars)
+        sys.stderr.write(out)
+        sys.stderr.flush()
+
+    def tick(self):
+        with self.lock:
+            if self.bars:
+                now = time.monotonic()
+                for progress in self.bars:
+                    progress.sample(now)
+                self._draw()
+
+    def _run(self, stop):
+        while not stop.wait(self.interval):
+            self.tick()
+
+    def add(self, progress):
+        if not sys.stderr.isatty():
+            return
+        with self.lock:
+            progress.sample(time.monotonic())
+            self.bars.append(progress)
+            self._draw()
+            if self._thread is None:
+                self._stop = threading.Event()
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._stop,), daemon=True,
+                )
+                self._thread.start()
+
+    def remove(self, progress):
+        thread = None
+        with self.lock:
+            if progress not in self.bars:
+                return
+            self.bars.remove(progress)
+            progress.sample(time.monotonic())
+            self._draw(finished=progress)
+            if not self.bars:
+                self._stop.set()
+                thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def write(self, text):
+        with self.lock:
+            out = self._clear()
+            # Never continue a line another thread left unfinished.
+            thread = threading.get_ident()
+            if self._partial not in (None, thread):
+                out += '\n'
+            out += text
+            if self.bars and not text.endswith('\n'):
+                out += '\n'
+            self._partial = None if out.endswith('\n') else thread
+            sys.stderr.write(out)
+            if self.bars:
+                self._draw()
+            sys.stderr.flush()
+
+
+_renderer = Renderer()
+
+
+def write(text):
+    """Write text to stderr, above any progress bars."""
+    _renderer.write(text)
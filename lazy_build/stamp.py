@@ -0,0 +1,101 @@
+"""Local stamps recording which artifact the outputs currently hold.
+
+After a successful build or restore we record the context hash along with a
+fingerprint of the outputs' stat information. If both still match on the next
+run, the outputs are already up to date and there's nothing to do: no need to
+even contact the cache backend.
+"""
+import json
+import os
+import os.path
+import stat
+
+import lazy_build
+from lazy_build import context
+from lazy_build import util
+
+
+def stamp_path(conf):
+    """Return the path to the stamp for this project and set of outputs."""
+    key = json.dumps((os.path.realpath('.'), sorted(conf.output)))
+    return os.path.join(
+        util.cache_dir(),
+        'stamps',
+        context.hash(key.encode('utf8', 'surrogateescape')),
+    ) + '.json'
+
+
+def _walk(path, entries):
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        entries.append([path, None])
+        return
+
+    entries.append([
+        path,
+        st.st_mode,
+        st.st_ino,
+        st.st_size,
+        st.st_mtime_ns,
+        st.st_ctime_ns,
+    ])
+    if stat.S_ISDIR(st.st_mode):
+        with os.scandir(path) as children:
+            names = sorted(child.name for child in children)
+        for name in names:
+            _walk(os.path.join(path, name), entries)
+
+
+def fingerprint(conf):
+    """Return (digest, newest timestamp) of the outputs' stat information.
+
+    ctime is included since, unlike mtime, it can't be set back by tools
+    which preserve timestamps.
+    """
+    entries = []
+    for output_path in sorted(conf.output):
+        _walk(output_path, entries)
+    newest = max(
+        (max(entry[4], entry[5]) for entry in entries if entry[1] is not None),
+        default=0,
+    )
+    data = json.dumps(entries).encode('utf8', 'surrogateescape')
+    return context.hash(data), newest
+
+
+def is_current(conf, ctx):
+    """Return whether the outputs still hold the artifact for ctx."""
+    path = stamp_path(conf)
+    try:
+        with open(path) as f:
+            timestamp = os.fstat(f.fileno()).st_mtime_ns
+            data = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if (
+            data.get('version') != lazy_build.__version__ or
+            data.get('hash') != ctx.hash
+    ):
+        return False
+
+    digest, newest = fingerprint(conf)
+    # Like the hash index, outputs changed at or after the time the stamp was
+    # written could have changed again without it being noticeable.
+    return digest == data.get('outputs') and newest < timestamp
+
+
+def write(conf, ctx):
+    path = stamp_path(conf)
+    digest, _ = fingerprint(conf)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with util.atomic_write(path) as f:
+        json.dump(
+            {
+                'version': lazy_build.__version__,
+                'hash': ctx.hash,
+                'outputs': digest,
+            },
+            f,
+        )
@@ -0,0 +1,129 @@
+"""Timing spans for the phases of a build.
+
+With --trace=FILE, each phase (hashing, lookup, download, extraction, the
+command, packaging, upload, ...) is recorded as a span in Chrome's trace event
+format, which chrome://tracing and https://ui.perfetto.dev can display. Spans
+carry arguments like byte and file counts.
+
+With --profile=DIR, each phase is also run under cProfile, and its stats are
+dumped to DIR/<n>-<phase>.prof for use with pstats or snakeviz. Only one span
+is profiled at a time: phases running while another is being profiled (e.g.
+concurrent targets in a batch) aren't profiled separately.
+"""
+import contextlib
+import cProfile
+import json
+import os
+import re
+import threading
+import time
+
+
+class Tracer:
+
+    def __init__(self, profile_dir=None):
+        self.events = []
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._profiling = False
+        self._profiles = 0
+
+    def _now(self):
+        # Trace timestamps are in microseconds.
+        return (time.perf_counter() - self._start) * 1e6
+
+    def _start_profile(self):
+        with self.lock:
+            if self.profile_dir is None or self._profiling:
+                return None
+            self._profiling = True
+            self._profiles += 1
+            n = self._profiles
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return n, profiler
+
+    def _stop_profile(self, profile, name):
+        n, profiler = profile
+        profiler.disable()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        slug = re.sub('[^a-z0-9]+', '-', name.lower()).strip('-')
+        profiler.dump_stats(
+            os.path.join(self.profile_dir, f'{n:03d}-{slug}.prof'),
+        )
+        with self.lock:
+            self._profiling = False
+
+    @contextlib.contextmanager
+    def span(self, name, profile=True, **args):
+        """Record a span around the body of the with statement.
+
+        Yields the span's arguments, so counts which are only known at the
+        end can be added.
+        """
+        profiler = self._start_profile() if profile else None
+        start = self._now()
+        try:
+            yield args
+        finally:
+            end = self._now()
+            if profiler is not None:
+                self._stop_profile(profiler, name)
+            with self.lock:
+                self.events.append({
+                    'name': name,
+                    'cat': 'lazy-build',
+                    'ph': 'X',
+                    'ts': start,
+                    'dur': end - start,
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                    'args': args,
+                })
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(
+                {'traceEvents': self.events, 'displayTimeUnit': 'ms'},
+                f,
+                indent=1,
+            )
+
+
+# The tracer for the current run; None if tracing is disabled.
+_tracer = None
+
+
+@contextlib.contextmanager
+def span(name, profile=True, **args):
+    """Record a span with the active tracer (if any); see Tracer.span.
+
+    `profile=False` is for spans which contain other phases, so that those
+    get profiled individually.
+    """
+    if _tracer is None:
+        yield args
+    else:
+        with _tracer.span(name, profile, **args) as span_args:
+            yield span_args
+
+
+@contextlib.contextmanager
+def tracing(path=None, profile_dir=None):
+    """Enable tracing for the body of the with statement.
+
+    The trace is written to `path` at the end (even if the body fails).
+    """
+    global _tracer
+    if path is None and profile_dir is None:
+        yield
+        return
+
+    _tracer = Tracer(profile_dir)
+    try:
+        yield
+    finally:
+        tracer, _tracer = _tracer, None
+        if path is not None:
+            tracer.write(path)
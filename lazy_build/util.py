@@ -1,7 +1,10 @@
+import collections
 import contextlib
+import errno
 import os
 import os.path
 import tempfile
+import threading
 
 
 @contextlib.contextmanager
@@ -20,6 +23,71 @@ def atomic_write(path, mode='w'):
         os.rename(tmp, path)
 
 
+def cache_dir():
+    """Return the directory for lazy-build's local (per-user) caches."""
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'lazy-build',
+    )
+
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Read once at import time, since reading it means briefly changing it (which
+# isn't safe once other threads might be creating files).
+UMASK = _get_umask()
+
+
+def copyfile(src, dest, callback):
+    """Copy from one regular file object to another.
+
+    The copy happens in the kernel if possible, via copy_file_range (which
+    can reflink on filesystems that support it) or sendfile. If neither works
+    for these files, falls back to copyfileobj.
+    """
+    dest.flush()
+    src_fd, dest_fd = src.fileno(), dest.fileno()
+    offset = src.tell()
+    start = offset
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    try:
+        while True:
+            if copy_file_range is not None:
+                n = copy_file_range(src_fd, dest_fd, 2**30, offset)
+            else:  # pragma: no cover (<py38)
+                n = os.sendfile(dest_fd, src_fd, offset, 2**30)
+            if n == 0:
+                break
+            offset += n
+            callback(n)
+    except OSError as ex:
+        if offset == start and ex.errno in (
+                errno.EXDEV,
+                errno.ENOSYS,
+                errno.EINVAL,
+                errno.EOPNOTSUPP,
+                errno.EBADF,
+        ):
+            copyfileobj(src, dest, callback)
+        else:
+            raise
+    else:
+        src.seek(offset)
+
+
+def pwrite(fd, data, offset):
+    """Write all of data to fd at offset, without moving the file offset."""
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
 def copyfileobj(src, dest, callback):
     """Copy from one file object to another.
 
@@ -31,3 +99,119 @@ def copyfileobj(src, dest, callback):
             break
         callback(len(buf))
         dest.write(buf)
+
+
+class Pipe:
+    """A bounded, in-memory pipe for passing bytes between two threads.
+
+    The writer blocks once `max_size` bytes are buffered, so memory use is
+    capped no matter how far apart the two sides are. The writing side calls
+    close() when done (optionally with an exception, which is then raised in
+    the reader); the reading side calls abort() if it gives up early, which
+    makes further writes raise BrokenPipeError.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._chunks = collections.deque()
+        self._size = 0
+        self._closed = False
+        self._error = None
+        self._aborted = False
+        self._cond = threading.Condition()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def write(self, data):
+        data = bytes(data)
+        if not data:
+            # An empty chunk would look like EOF to the reader.
+            return 0
+        with self._cond:
+            while self._size >= self.max_size and not self._aborted:
+                self._cond.wait()
+            if self._aborted:
+                raise BrokenPipeError('Reader went away')
+            self._chunks.append(data)
+            self._size += len(data)
+            self._cond.notify_all()
+        return len(data)
+
+    def read(self, size=-1):
+        with self._cond:
+            while not self._chunks and not self._closed:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+
+            if size < 0 or size >= self._size:
+                data = b''.join(self._chunks)
+                self._chunks.clear()
+            else:
+                parts = []
+                needed = size
+                while needed > 0:
+                    chunk = self._chunks.popleft()
+                    if len(chunk) > needed:
+                        self._chunks.appendleft(chunk[needed:])
+                        chunk = chunk[:needed]
+                    parts.append(chunk)
+                    needed -= len(chunk)
+                data = b''.join(parts)
+
+            self._size -= len(data)
+            self._cond.notify_all()
+            return data
+
+    def close(self, error=None):
+        with self._cond:
+            self._closed = True
+            self._error = error
+            self._cond.notify_all()
+
+    def abort(self):
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+
+
+def pipeline(producer, consumer, max_size):
+    """Run two functions concurrently, connected by a Pipe.
+
+    `producer` is called with the pipe in a background thread and should
+    write to it; `consumer` is called with the pipe in this thread and should
+    read from it. Exceptions from either side are raised here, and the
+    consumer's return value is returned.
+    """
+    pipe = Pipe(max_size)
+
+    def produce():
+        try:
+            producer(pipe)
+        except BaseException as ex:
+            pipe.close(ex)
+        else:
+            pipe.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        result = consumer(pipe)
+        # The consumer might not need everything (e.g. tar padding at the
+        # end); drain it so the producer can finish. This also raises the
+        # producer's error even if the consumer ignored it.
+        while pipe.read(1024 * 1024):
+            pass
+    except BaseException:
+        pipe.abort()
+        raise
+    finally:
+        thread.join()
+    return result
@@ -1,44 +1,97 @@
 import collections
+import datetime
+import errno
+import hashlib
+import io
+import json
 import os
+import tarfile
+import tempfile
+import time
 from unittest import mock
 
+import boto3.s3.transfer
+import boto3.session
 import botocore.exceptions
+import botocore.session
 import pytest
 
 from lazy_build import cache
+from lazy_build import config
+from lazy_build import util
 
 
-class FakeS3:
+S3_MODEL = botocore.session.get_session().get_service_model('s3')
 
-    meta = mock.Mock()
+
+class FakeS3Client:
 
     def __init__(self):
+        self.meta = mock.Mock(service_model=S3_MODEL)
+        self.download_file = mock.Mock()
+        self.download_fileobj = mock.Mock()
+        self.upload_file = mock.Mock()
+        self.upload_fileobj = mock.Mock()
+        self.ranges = []
         self._buckets = collections.defaultdict(dict)
+        self._metadata = collections.defaultdict(dict)
+        self._etags = {}
+        self._modified = {}
 
-    def Object(self, bucket, key):
-        return FakeS3Object(self._buckets[bucket], key)
-
+    def head_object(self, Bucket, Key):
+        if Key in self._buckets[Bucket]:
+            return {
+                'ContentLength': len(self._buckets[Bucket][Key]),
+                'ETag': self._etags.get(Key, '"etag"'),
+                'LastModified': self._modified.get(
+                    Key, datetime.datetime.now(datetime.timezone.utc),
+                ),
+                'Metadata': self._metadata[Bucket].get(Key, {}),
+            }
+        else:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': '404'}},
+                'HeadObject',
+            )
 
-class FakeS3Object:
+    def _check(self, Bucket, Key, IfMatch, IfNoneMatch=None):
+        exists = Key in self._buckets[Bucket]
+        if (
+                (IfNoneMatch == '*' and exists) or
+                (IfMatch is not None and self._etags.get(Key) != IfMatch)
+        ):
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'PreconditionFailed'}},
+                'PutObject',
+            )
 
-    def __init__(self, bucket, key):
-        self._bucket = bucket
-        self._key = key
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        self._check(Bucket, Key, IfMatch, IfNoneMatch)
+        self._buckets[Bucket][Key] = Body
+        self._etags[Key] = '"{}"'.format(len(self._etags))
+        self._modified[Key] = datetime.datetime.now(datetime.timezone.utc)
+        return {'ETag': self._etags[Key]}
 
-    def load(self):
-        if self._key in self._bucket:
-            self.content_length = len(self._bucket[self._key])
-        else:
+    def delete_object(self, Bucket, Key, IfMatch=None):
+        if Key not in self._buckets[Bucket]:
             raise botocore.exceptions.ClientError(
-                {'Error': {'Code': '404'}},
-                None,
+                {'Error': {'Code': 'NoSuchKey'}},
+                'DeleteObject',
             )
+        self._check(Bucket, Key, IfMatch)
+        del self._buckets[Bucket][Key]
+
+    def get_object(self, Bucket, Key, Range, IfMatch):
+        assert IfMatch == '"etag"'
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        self.ranges.append((start, end))
+        return {'Body': io.BytesIO(self._buckets[Bucket][Key][start:end + 1])}
 
 
 @pytest.fixture
 def s3_backend():
     backend = cache.S3Backend(bucket='my-cool-bucket', path='artifacts')
-    with mock.patch.object(cache.boto3, 'resource', return_value=FakeS3()):
+    with mock.patch.object(cache, '_s3_client', return_value=FakeS3Client()):
         yield backend
 
 
@@ -46,7 +99,7 @@ def test_s3_artifact_details_exists(s3_backend):
     s3_backend._s3._buckets['my-cool-bucket']['artifacts/my-hash.tar'] = b'hi'
     assert (
         s3_backend.artifact_details(mock.Mock(hash='my-hash')) ==
-        cache.ArtifactDetails(size=2)
+        cache.ArtifactDetails(size=2, compression='none')
     )
 
 
@@ -57,18 +110,116 @@ def test_s3_artifact_details_does_not_exist(s3_backend):
     )
 
 
+def test_s3_artifact_details_many(s3_backend):
+    s3_backend._s3._buckets['my-cool-bucket']['artifacts/b.tar'] = b'hi'
+    ctxs = [mock.Mock(hash=hash) for hash in ('a', 'b', 'c')]
+    assert s3_backend.artifact_details_many(ctxs) == [
+        None, cache.ArtifactDetails(size=2, compression='none'), None,
+    ]
+
+
+def test_s3_artifact_details_many_single(s3_backend):
+    s3_backend._s3._buckets['my-cool-bucket']['artifacts/a.tar'] = b'hi'
+    assert s3_backend.artifact_details_many([mock.Mock(hash='a')]) == [
+        cache.ArtifactDetails(size=2, compression='none'),
+    ]
+
+
 def test_s3_artifact_get_artifact(s3_backend):
     s3_backend._s3._buckets['my-cool-bucket']['artifacts/my-hash.tar'] = b'hi'
     callback = mock.Mock()
-    path = s3_backend.get_artifact(mock.Mock(hash='my-hash'), callback)
-    assert path.startswith('/tmp/')
-    s3_backend._s3.meta.client.download_file.assert_called_once_with(
+    with s3_backend.get_artifact(mock.Mock(hash='my-hash'), callback) as path:
+        assert path.startswith('/tmp/')
+        s3_backend._s3.download_file.assert_called_once_with(
+            'my-cool-bucket',
+            'artifacts/my-hash.tar',
+            path,
+            Callback=callback,
+            Config=mock.ANY,
+        )
+    assert not os.path.exists(path)
+
+
+def test_s3_get_artifact_ranged(s3_backend):
+    s3_backend = s3_backend._replace(
+        multipart_threshold=8,
+        multipart_chunksize=3,
+        max_concurrency=4,
+    )
+    data = b'0123456789'
+    s3_backend._s3._buckets['my-cool-bucket']['artifacts/my-hash.tar'] = data
+    callback = mock.Mock()
+    with mock.patch.object(cache, 'RANGE_READ_SIZE', 2):
+        with s3_backend.get_artifact(
+                mock.Mock(hash='my-hash'), callback,
+        ) as path:
+            with open(path, 'rb') as f:
+                assert f.read() == data
+    assert sorted(s3_backend._s3.ranges) == [(0, 2), (3, 5), (6, 8), (9, 9)]
+    assert sum(call[0][0] for call in callback.call_args_list) == len(data)
+    assert not s3_backend._s3.download_file.called
+
+
+def test_s3_get_artifact_ranged_short_read(s3_backend):
+    s3_backend = s3_backend._replace(
+        multipart_threshold=8,
+        multipart_chunksize=4,
+        max_concurrency=4,
+    )
+    fake = s3_backend._s3
+    fake._buckets['my-cool-bucket']['artifacts/my-hash.tar'] = b'0123456789'
+    get_object = fake.get_object
+
+    def truncated(**kwargs):
+        resp = get_object(**kwargs)
+        resp['Body'] = io.BytesIO(resp['Body'].read()[:-1])
+        return resp
+
+    fake.get_object = truncated
+    with pytest.raises(IOError):
+        with s3_backend.get_artifact(mock.Mock(hash='my-hash'), mock.Mock()):
+            raise AssertionError('unreachable')
+
+
+def test_s3_get_artifact_single_stream_without_concurrency(s3_backend):
+    s3_backend = s3_backend._replace(multipart_threshold=1, max_concurrency=1)
+    s3_backend._s3._buckets['my-cool-bucket']['artifacts/my-hash.tar'] = b'hi'
+    with s3_backend.get_artifact(mock.Mock(hash='my-hash'), mock.Mock()):
+        assert s3_backend._s3.download_file.called
+    assert s3_backend._s3.ranges == []
+
+
+def test_s3_tempdir(s3_backend):
+    assert s3_backend.tempdir() is None
+
+
+def test_s3_stream_artifact(s3_backend):
+    callback = mock.Mock()
+    fileobj = mock.Mock()
+    s3_backend.stream_artifact(mock.Mock(hash='my-hash'), fileobj, callback)
+    s3_backend._s3.download_fileobj.assert_called_once_with(
+        'my-cool-bucket',
+        'artifacts/my-hash.tar',
+        fileobj,
+        Callback=callback,
+        Config=mock.ANY,
+    )
+
+
+def test_s3_store_artifact_stream(s3_backend):
+    callback = mock.Mock()
+    fileobj = mock.Mock()
+    s3_backend.store_artifact_stream(
+        mock.Mock(hash='my-hash'), fileobj, callback, 'gzip',
+    )
+    s3_backend._s3.upload_fileobj.assert_called_once_with(
+        fileobj,
         'my-cool-bucket',
         'artifacts/my-hash.tar',
-        mock.ANY,
         Callback=callback,
+        ExtraArgs={'Metadata': {'compression': 'gzip'}},
+        Config=mock.ANY,
     )
-    os.remove(path)
 
 
 def test_s3_artifact_store_artifact(s3_backend):
@@ -76,9 +227,1027 @@ def test_s3_artifact_store_artifact(s3_backend):
     s3_backend.store_artifact(
         mock.Mock(hash='my-hash'), '/my/path', callback,
     )
-    s3_backend._s3.meta.client.upload_file.assert_called_once_with(
+    s3_backend._s3.upload_file.assert_called_once_with(
         '/my/path',
         Bucket='my-cool-bucket',
         Key='artifacts/my-hash.tar',
         Callback=callback,
+        ExtraArgs={'Metadata': {'compression': 'none'}},
+        Config=mock.ANY,
+    )
+
+
+def test_s3_artifact_details_compression(s3_backend):
+    s3_backend._s3._buckets['my-cool-bucket']['artifacts/my-hash.tar'] = b'hi'
+    s3_backend._s3._metadata['my-cool-bucket']['artifacts/my-hash.tar'] = {
+        'compression': 'zstd',
+    }
+    assert (
+        s3_backend.artifact_details(mock.Mock(hash='my-hash')) ==
+        cache.ArtifactDetails(size=2, compression='zstd')
+    )
+
+
+def test_s3_artifact_details_other_error(s3_backend):
+    s3_backend._s3.head_object = mock.Mock(
+        side_effect=botocore.exceptions.ClientError(
+            {'Error': {'Code': '403'}},
+            'HeadObject',
+        ),
+    )
+    with pytest.raises(botocore.exceptions.ClientError):
+        s3_backend.artifact_details(mock.Mock(hash='my-hash'))
+
+
+def test_s3_client_is_reused():
+    cache._s3_client.cache_clear()
+    backend = cache.S3Backend(bucket='my-cool-bucket', path='artifacts')
+    with mock.patch.object(boto3.session, 'Session') as session:
+        assert backend._s3 is backend._s3
+    assert session.call_count == 1
+    cache._s3_client.cache_clear()
+
+
+def test_s3_transfer_config_defaults():
+    backend = cache.S3Backend(bucket='my-cool-bucket', path='artifacts')
+    default = boto3.s3.transfer.TransferConfig()
+    transfer_config = backend._transfer_config
+    assert transfer_config.multipart_threshold == default.multipart_threshold
+    assert transfer_config.max_request_concurrency == (
+        default.max_request_concurrency
+    )
+
+
+def test_s3_transfer_config():
+    backend = cache.S3Backend(
+        bucket='my-cool-bucket',
+        path='artifacts',
+        multipart_threshold=16 * 2**20,
+        multipart_chunksize=32 * 2**20,
+        max_concurrency=20,
+    )
+    transfer_config = backend._transfer_config
+    assert transfer_config.multipart_threshold == 16 * 2**20
+    assert transfer_config.multipart_chunksize == 32 * 2**20
+    assert transfer_config.max_request_concurrency == 20
+
+
+@pytest.mark.parametrize(('kwargs', 'expected'), (
+    ({}, 10),
+    ({'max_concurrency': 32}, 32),
+    ({'max_concurrency': 32, 'max_pool_connections': 4}, 4),
+))
+def test_s3_pool_size(kwargs, expected):
+    backend = cache.S3Backend(
+        bucket='my-cool-bucket',
+        path='artifacts',
+        endpoint_url='http://localhost:5000',
+        **kwargs
     )
+    with mock.patch.object(cache, '_s3_client') as client:
+        backend._s3
+    client.assert_called_once_with('http://localhost:5000', expected)
+
+
+@pytest.fixture
+def fs_backend(tmpdir):
+    return cache.FilesystemBackend(
+        path=tmpdir.join('cache').ensure_dir().strpath,
+    )
+
+
+def _temp_artifact(backend, content):
+    """Package an artifact into the backend's tempdir(), like main does."""
+    fd, path = tempfile.mkstemp(prefix='.lazy-build-', dir=backend.tempdir())
+    with open(fd, 'w') as f:
+        f.write(content)
+    return path
+
+
+def test_fs_store_and_get_artifact(fs_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    assert fs_backend.artifact_details(ctx) is None
+
+    artifact = _temp_artifact(fs_backend, 'hello')
+    callback = mock.Mock()
+    fs_backend.store_artifact(ctx, artifact, callback, 'gzip')
+    assert fs_backend.artifact_details(ctx) == cache.ArtifactDetails(
+        size=5, compression='gzip',
+    )
+    callback.assert_called_once_with(5)
+
+    # Artifacts are readable by others sharing the cache.
+    tarball = tmpdir.join('cache', 'my-hash.tar')
+    assert tarball.stat().mode & 0o777 == 0o666 & ~util.UMASK
+    # Our own temporary file is linked into place, not copied.
+    assert tarball.stat().ino == os.stat(artifact).st_ino
+
+    # The cached file is handed out directly, and not removed afterwards.
+    callback = mock.Mock()
+    with fs_backend.get_artifact(ctx, callback) as path:
+        assert path == tarball.strpath
+    callback.assert_called_once_with(5)
+    assert tarball.read() == 'hello'
+
+
+def test_fs_store_artifact_copies_other_files(fs_backend, tmpdir):
+    tmpdir.join('artifact').write('hello')
+    tmpdir.join('artifact').chmod(0o600)
+    callback = mock.Mock()
+    fs_backend.store_artifact(
+        mock.Mock(hash='my-hash'), tmpdir.join('artifact').strpath, callback,
+    )
+    tarball = tmpdir.join('cache', 'my-hash.tar')
+    assert tarball.read() == 'hello'
+    assert tarball.stat().ino != tmpdir.join('artifact').stat().ino
+    # Someone else's file is left alone.
+    assert tmpdir.join('artifact').stat().mode & 0o777 == 0o600
+    callback.assert_called_once_with(5)
+
+
+def test_fs_store_artifact_link_unsupported(fs_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    artifact = _temp_artifact(fs_backend, 'hello')
+    callback = mock.Mock()
+    with mock.patch.object(
+            cache.os, 'link', side_effect=OSError(errno.EPERM, 'nope'),
+    ):
+        fs_backend.store_artifact(ctx, artifact, callback)
+    tarball = tmpdir.join('cache', 'my-hash.tar')
+    assert tarball.read() == 'hello'
+    assert tarball.stat().ino != os.stat(artifact).st_ino
+    callback.assert_called_once_with(5)
+
+
+def test_fs_store_artifact_link_error(fs_backend, tmpdir):
+    artifact = _temp_artifact(fs_backend, 'hello')
+    with mock.patch.object(
+            cache.os, 'link', side_effect=OSError(errno.EIO, 'nope'),
+    ):
+        with pytest.raises(OSError):
+            fs_backend.store_artifact(
+                mock.Mock(hash='my-hash'), artifact, mock.Mock(),
+            )
+
+
+def test_fs_stream_artifact(fs_backend, tmpdir):
+    tmpdir.join('cache', 'my-hash.tar').write('hello')
+    callback = mock.Mock()
+    out = io.BytesIO()
+    fs_backend.stream_artifact(mock.Mock(hash='my-hash'), out, callback)
+    assert out.getvalue() == b'hello'
+    callback.assert_called_once_with(5)
+
+
+def test_fs_store_artifact_stream(fs_backend):
+    ctx = mock.Mock(hash='my-hash')
+    callback = mock.Mock()
+    fs_backend.store_artifact_stream(
+        ctx, io.BytesIO(b'hello'), callback, 'zstd',
+    )
+    assert fs_backend.artifact_details(ctx) == cache.ArtifactDetails(
+        size=5, compression='zstd',
+    )
+    callback.assert_called_once_with(5)
+
+
+def test_fs_artifact_details_without_metadata(fs_backend, tmpdir):
+    tmpdir.join('cache', 'my-hash.tar').write('hi')
+    assert fs_backend.artifact_details(mock.Mock(hash='my-hash')) == (
+        cache.ArtifactDetails(size=2, compression='none')
+    )
+
+
+def _store(backend, tmpdir, hash, content):
+    tmpdir.join('artifact').write(content)
+    backend.store_artifact(
+        mock.Mock(hash=hash), tmpdir.join('artifact').strpath, mock.Mock(),
+    )
+    tmpdir.join('artifact').remove()
+
+
+def test_fs_artifact_details_many(fs_backend, tmpdir):
+    _store(fs_backend, tmpdir, 'b', 'hello')
+    ctxs = [mock.Mock(hash=hash) for hash in ('a', 'b')]
+    assert fs_backend.artifact_details_many(ctxs) == [
+        None, cache.ArtifactDetails(size=5, compression='none'),
+    ]
+
+
+def test_fs_store_artifact_creates_directory(tmpdir):
+    backend = cache.FilesystemBackend(path=tmpdir.join('a', 'b').strpath)
+    _store(backend, tmpdir, 'my-hash', 'hello')
+    assert tmpdir.join('a', 'b', 'my-hash.tar').read() == 'hello'
+
+
+def test_fs_evicts_least_recently_used(tmpdir):
+    backend = cache.FilesystemBackend(
+        path=tmpdir.join('cache').strpath,
+        max_size=10,
+    )
+    _store(backend, tmpdir, 'a', '1234')
+    _store(backend, tmpdir, 'b', '1234')
+    # Make the artifacts' ages unambiguous, then use `a`.
+    os.utime(tmpdir.join('cache', 'a.tar').strpath, (1, 1))
+    os.utime(tmpdir.join('cache', 'b.tar').strpath, (2, 2))
+    with backend.get_artifact(mock.Mock(hash='a'), mock.Mock()):
+        pass
+
+    _store(backend, tmpdir, 'c', '1234')
+    assert sorted(p.basename for p in tmpdir.join('cache').listdir()) == [
+        'a.json', 'a.tar', 'c.json', 'c.tar',
+    ]
+
+
+def test_fs_evicts_concurrently(tmpdir):
+    backend = cache.FilesystemBackend(
+        path=tmpdir.join('cache').strpath,
+        max_size=4,
+    )
+    _store(backend, tmpdir, 'a', '1234')
+    real_remove = os.remove
+
+    def remove_after_someone_else(path):
+        real_remove(path)
+        real_remove(path)
+
+    with mock.patch.object(cache.os, 'remove', remove_after_someone_else):
+        backend.store_artifact_stream(
+            mock.Mock(hash='b'), io.BytesIO(b'1234'), mock.Mock(),
+        )
+    assert sorted(p.basename for p in tmpdir.join('cache').listdir()) == [
+        'b.json', 'b.tar',
+    ]
+
+
+def test_fs_never_evicts_new_artifact(tmpdir):
+    backend = cache.FilesystemBackend(
+        path=tmpdir.join('cache').strpath,
+        max_size=2,
+    )
+    _store(backend, tmpdir, 'a', '1234')
+    backend.store_artifact_stream(
+        mock.Mock(hash='b'), io.BytesIO(b'12345'), mock.Mock(),
+    )
+    assert sorted(p.basename for p in tmpdir.join('cache').listdir()) == [
+        'b.json', 'b.tar',
+    ]
+
+
+def test_fs_unlimited_does_not_touch(fs_backend, tmpdir):
+    tmpdir.join('cache', 'my-hash.tar').write('hi')
+    os.utime(tmpdir.join('cache', 'my-hash.tar').strpath, (1, 1))
+    with fs_backend.get_artifact(mock.Mock(hash='my-hash'), mock.Mock()):
+        pass
+    assert tmpdir.join('cache', 'my-hash.tar').mtime() == 1
+
+
+@pytest.fixture
+def chain_backend(tmpdir):
+    return cache.ChainBackend((
+        cache.FilesystemBackend(path=tmpdir.join('local').strpath),
+        cache.FilesystemBackend(path=tmpdir.join('shared').strpath),
+    ))
+
+
+def test_chain_artifact_details(chain_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    assert chain_backend.artifact_details(ctx) is None
+    _store(chain_backend.backends[1], tmpdir, 'my-hash', 'hello')
+    assert chain_backend.artifact_details(ctx) == cache.ArtifactDetails(
+        size=5, compression='none',
+    )
+
+
+def test_chain_artifact_details_many(chain_backend, tmpdir):
+    _store(chain_backend.backends[0], tmpdir, 'a', 'hi')
+    _store(chain_backend.backends[0], tmpdir, 'b', 'hi')
+    _store(chain_backend.backends[1], tmpdir, 'b', 'hello')
+    _store(chain_backend.backends[1], tmpdir, 'c', 'hello')
+    ctxs = [mock.Mock(hash=hash) for hash in ('a', 'b', 'c', 'd')]
+    # The fastest backend holding each artifact wins.
+    assert chain_backend.artifact_details_many(ctxs) == [
+        cache.ArtifactDetails(size=2, compression='none'),
+        cache.ArtifactDetails(size=2, compression='none'),
+        cache.ArtifactDetails(size=5, compression='none'),
+        None,
+    ]
+
+
+def test_chain_artifact_details_many_stops_once_all_found(
+        chain_backend, tmpdir,
+):
+    _store(chain_backend.backends[0], tmpdir, 'a', 'hi')
+    slow = mock.Mock()
+    chain_backend = chain_backend._replace(
+        backends=(chain_backend.backends[0], slow),
+    )
+    assert chain_backend.artifact_details_many([mock.Mock(hash='a')]) == [
+        cache.ArtifactDetails(size=2, compression='none'),
+    ]
+    assert not slow.artifact_details_many.called
+
+
+def test_chain_tempdir(chain_backend, tmpdir):
+    assert chain_backend.tempdir() == tmpdir.join('local').strpath
+
+
+def test_chain_get_artifact_populates_faster_backends(chain_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    tmpdir.join('artifact').write('hello')
+    chain_backend.backends[1].store_artifact(
+        ctx, tmpdir.join('artifact').strpath, mock.Mock(), 'gzip',
+    )
+
+    callback = mock.Mock()
+    with chain_backend.get_artifact(ctx, callback) as path:
+        assert path == tmpdir.join('shared', 'my-hash.tar').strpath
+    callback.assert_called_once_with(5)
+    assert chain_backend.backends[0].artifact_details(ctx) == (
+        cache.ArtifactDetails(size=5, compression='gzip')
+    )
+
+    # Next time, the local copy is used.
+    with chain_backend.get_artifact(ctx, callback) as path:
+        assert path == tmpdir.join('local', 'my-hash.tar').strpath
+
+
+def test_chain_get_artifact_copies_between_filesystem_tiers(
+        chain_backend, tmpdir,
+):
+    ctx = mock.Mock(hash='my-hash')
+    _store(chain_backend.backends[1], tmpdir, 'my-hash', 'hello')
+    shared = tmpdir.join('shared', 'my-hash.tar')
+    shared.chmod(0o644)
+
+    with mock.patch.object(util, 'UMASK', 0o077):
+        with chain_backend.get_artifact(ctx, mock.Mock()):
+            pass
+    local = tmpdir.join('local', 'my-hash.tar')
+    assert local.read() == 'hello'
+    # The shared cache's file isn't changed, or shared with the local cache.
+    assert shared.stat().mode & 0o777 == 0o644
+    assert shared.stat().nlink == local.stat().nlink == 1
+
+
+def test_chain_stream_artifact_populates_faster_backends(
+        chain_backend, tmpdir,
+):
+    ctx = mock.Mock(hash='my-hash')
+    chain_backend.backends[1].store_artifact_stream(
+        ctx, io.BytesIO(b'hello'), mock.Mock(),
+    )
+
+    for _ in range(2):
+        out = io.BytesIO()
+        callback = mock.Mock()
+        chain_backend.stream_artifact(ctx, out, callback)
+        assert out.getvalue() == b'hello'
+        callback.assert_called_once_with(5)
+    assert tmpdir.join('local', 'my-hash.tar').read() == 'hello'
+    # The temporary copy is cleaned up.
+    assert sorted(p.basename for p in tmpdir.join('local').listdir()) == [
+        'my-hash.json', 'my-hash.tar',
+    ]
+
+
+def test_chain_artifact_vanished(chain_backend):
+    ctx = mock.Mock(hash='my-hash')
+    with pytest.raises(FileNotFoundError) as excinfo:
+        with chain_backend.get_artifact(ctx, mock.Mock()):
+            raise AssertionError('unreachable')
+    assert str(excinfo.value) == 'Artifact my-hash is no longer in the cache'
+    with pytest.raises(FileNotFoundError):
+        chain_backend.stream_artifact(ctx, io.BytesIO(), mock.Mock())
+
+
+def test_chain_store_artifact(chain_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    tmpdir.join('artifact').write('hello')
+    callback = mock.Mock()
+    chain_backend.store_artifact(
+        ctx, tmpdir.join('artifact').strpath, callback, 'xz',
+    )
+    # Progress is only reported once.
+    callback.assert_called_once_with(5)
+    for backend in chain_backend.backends:
+        assert backend.artifact_details(ctx) == cache.ArtifactDetails(
+            size=5, compression='xz',
+        )
+
+
+def test_chain_store_artifact_stream(chain_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    callback = mock.Mock()
+    chain_backend.store_artifact_stream(
+        ctx, io.BytesIO(b'hello'), callback, 'xz',
+    )
+    callback.assert_called_once_with(5)
+    for name in ('local', 'shared'):
+        assert tmpdir.join(name, 'my-hash.tar').read() == 'hello'
+    assert len(tmpdir.join('local').listdir()) == 2
+
+
+def test_tee_reader():
+    copy = io.BytesIO()
+    reader = cache._TeeReader(io.BytesIO(b'hello'), copy)
+    assert reader.readable()
+    assert not reader.seekable()
+    assert reader.read(2) + reader.read() == b'hello'
+    assert copy.getvalue() == b'hello'
+
+
+def _tarball(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w|') as tf:
+        for name, content in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tf.addfile(info, io.BytesIO(content))
+    buf.seek(0)
+    return buf
+
+
+def _untar(fileobj):
+    with tarfile.open(fileobj=fileobj, mode='r|') as tf:
+        return {
+            info.name: tf.extractfile(info).read()
+            for info in tf
+        }
+
+
+@pytest.fixture
+def chunked_backend(fs_backend):
+    with mock.patch.object(cache.chunking, 'CHUNK_MIN_SIZE', 1):
+        with mock.patch.object(cache.chunking, 'BOUNDARY_MASK', 0):
+            yield cache.ChunkedBackend(fs_backend, compression='gzip')
+
+
+def test_chunked_store_and_get_artifact(chunked_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    assert chunked_backend.artifact_details(ctx) is None
+
+    files = {'a': b'hello', 'b': b'world'}
+    chunked_backend.store_artifact_stream(
+        ctx, _tarball(files), mock.Mock(),
+    )
+    details = chunked_backend.artifact_details(ctx)
+    assert details.compression == 'none'
+
+    callback = mock.Mock()
+    with chunked_backend.get_artifact(ctx, callback) as path:
+        with open(path, 'rb') as f:
+            assert _untar(f) == files
+    assert not os.path.exists(path)
+    assert sum(c[0][0] for c in callback.call_args_list) == details.size
+
+
+def test_chunked_bounded_concurrency(chunked_backend):
+    # More chunks than transfers allowed at once.
+    chunked_backend = chunked_backend._replace(max_concurrency=2)
+    ctx = mock.Mock(hash='my-hash')
+    files = {name: name.encode() * 10 for name in 'abcde'}
+    chunked_backend.store_artifact_stream(ctx, _tarball(files), mock.Mock())
+    assert len(chunked_backend._manifest(ctx)['chunks']) == 5
+    out = io.BytesIO()
+    chunked_backend.stream_artifact(ctx, out, mock.Mock())
+    out.seek(0)
+    assert _untar(out) == files
+
+
+def test_chunked_store_artifact_from_path(chunked_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    tmpdir.join('artifact').write_binary(_tarball({'a': b'hi'}).getvalue())
+    chunked_backend.store_artifact(
+        ctx, tmpdir.join('artifact').strpath, mock.Mock(),
+    )
+    out = io.BytesIO()
+    chunked_backend.stream_artifact(ctx, out, mock.Mock())
+    out.seek(0)
+    assert _untar(out) == {'a': b'hi'}
+
+
+def test_chunked_deduplicates(chunked_backend, tmpdir):
+    chunked_backend.store_artifact_stream(
+        mock.Mock(hash='one'),
+        _tarball({'a': b'hello', 'b': b'world'}),
+        mock.Mock(),
+    )
+    callback = mock.Mock()
+    chunked_backend.store_artifact_stream(
+        mock.Mock(hash='two'),
+        _tarball({'a': b'hello', 'b': b'world', 'c': b'new'}),
+        callback,
+    )
+    # Only the new chunk was uploaded.
+    assert callback.call_count == 1
+    chunks = tmpdir.join('cache').listdir('chunk-*.tar')
+    assert len(chunks) == 3
+
+
+def test_chunked_missing_chunk(chunked_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    chunked_backend.store_artifact_stream(
+        ctx, _tarball({'a': b'hello'}), mock.Mock(),
+    )
+    for path in tmpdir.join('cache').listdir('chunk-*.tar'):
+        path.remove()
+    with pytest.raises(FileNotFoundError):
+        chunked_backend.stream_artifact(ctx, io.BytesIO(), mock.Mock())
+
+
+def test_chunked_artifact_vanished(chunked_backend):
+    with pytest.raises(FileNotFoundError) as excinfo:
+        chunked_backend.stream_artifact(
+            mock.Mock(hash='my-hash'), io.BytesIO(), mock.Mock(),
+        )
+    assert str(excinfo.value) == 'Artifact my-hash is no longer in the cache'
+
+
+def test_chunked_corrupt_chunk(tmpdir):
+    fs_backend = cache.FilesystemBackend(path=tmpdir.strpath)
+    backend = cache.ChunkedBackend(fs_backend)
+    ctx = mock.Mock(hash='my-hash')
+    backend.store_artifact_stream(ctx, _tarball({'a': b'hello'}), mock.Mock())
+    chunk, = tmpdir.listdir('chunk-*.tar')
+    chunk.write_binary(b'jello')
+    with pytest.raises(IOError):
+        backend.stream_artifact(ctx, io.BytesIO(), mock.Mock())
+
+
+def test_chunked_artifact_details_many(chunked_backend):
+    ctx = mock.Mock(hash='my-hash')
+    chunked_backend.store_artifact_stream(
+        ctx, _tarball({'a': b'hello'}), mock.Mock(),
+    )
+    details = chunked_backend.artifact_details_many(
+        [ctx, mock.Mock(hash='other')],
+    )
+    assert details == [chunked_backend.artifact_details(ctx), None]
+
+
+def test_chunked_tempdir(chunked_backend, fs_backend):
+    assert chunked_backend.tempdir() == fs_backend.path
+
+
+def test_file_manifest(fs_backend):
+    ctx = mock.Mock(hash='my-hash')
+    assert fs_backend.file_manifest(ctx) is None
+    manifest = {'algorithm': 'sha256', 'members': [{'name': 'a'}]}
+    fs_backend.store_file_manifest(ctx, manifest)
+    assert fs_backend.file_manifest(ctx) == manifest
+
+
+def test_s3_file_manifest(s3_backend):
+    fake = s3_backend._s3
+    objects = fake._buckets['my-cool-bucket']
+
+    def upload_fileobj(fileobj, Bucket, Key, ExtraArgs, **kwargs):
+        objects[Key] = fileobj.read()
+        fake._metadata[Bucket][Key] = ExtraArgs['Metadata']
+
+    def download_fileobj(Bucket, Key, fileobj, **kwargs):
+        fileobj.write(objects[Key])
+
+    fake.upload_fileobj.side_effect = upload_fileobj
+    fake.download_fileobj.side_effect = download_fileobj
+
+    ctx = mock.Mock(hash='my-hash')
+    assert s3_backend.file_manifest(ctx) is None
+    manifest = {'algorithm': 'sha256', 'members': [{'name': 'a'}]}
+    s3_backend.store_file_manifest(ctx, manifest)
+    assert 'artifacts/my-hash-files.tar' in objects
+    assert s3_backend.file_manifest(ctx) == manifest
+
+
+def test_chain_file_manifest(chain_backend):
+    ctx = mock.Mock(hash='my-hash')
+    assert chain_backend.file_manifest(ctx) is None
+    manifest = {'algorithm': 'sha256', 'members': []}
+    chain_backend.store_file_manifest(ctx, manifest)
+    for backend in chain_backend.backends:
+        assert backend.file_manifest(ctx) == manifest
+    assert chain_backend.file_manifest(ctx) == manifest
+
+
+def test_chunked_file_manifest(chunked_backend):
+    ctx = mock.Mock(hash='my-hash')
+    assert chunked_backend.file_manifest(ctx) is None
+    chunked_backend.store_artifact_stream(
+        ctx, _tarball({'a': b'hello'}), mock.Mock(),
+    )
+    chunked_backend.store_file_manifest(ctx, {'members': 'ignored'})
+    manifest = chunked_backend.file_manifest(ctx)
+    assert manifest['algorithm'] == 'sha256'
+    member, = manifest['members']
+    assert member['name'] == 'a'
+    assert member['digest'] == hashlib.sha256(b'hello').hexdigest()
+
+
+def test_chunked_downloads_manifest_once(chunked_backend):
+    ctx = mock.Mock(hash='my-hash')
+    chunked_backend.store_artifact_stream(
+        ctx, _tarball({'a': b'hello'}), mock.Mock(),
+    )
+    with mock.patch.object(
+            cache, '_get_object', wraps=cache._get_object,
+    ) as get_object:
+        assert chunked_backend.artifact_details(ctx) is not None
+        chunked_backend.stream_artifact(ctx, io.BytesIO(), mock.Mock())
+        assert chunked_backend.file_manifest(ctx) is not None
+    manifest_gets = [
+        call for call in get_object.call_args_list
+        if call[0][1].hash == 'my-hash-manifest'
+    ]
+    assert len(manifest_gets) == 1
+
+
+def test_chunked_manifest_cache_size(chunked_backend):
+    ctxs = [mock.Mock(hash=str(i)) for i in range(3)]
+    for ctx in ctxs:
+        chunked_backend.store_artifact_stream(
+            ctx, _tarball({'a': ctx.hash.encode()}), mock.Mock(),
+        )
+    with mock.patch.object(cache, 'MANIFEST_CACHE_SIZE', 2):
+        for ctx in ctxs + ctxs[-1:]:
+            chunked_backend.artifact_details(ctx)
+    assert list(cache._manifests) == [
+        (chunked_backend.backend, '1'), (chunked_backend.backend, '2'),
+    ]
+
+
+@pytest.fixture
+def negative_backend(fs_backend, tmpdir):
+    return cache.NegativeCacheBackend(
+        fs_backend, ttl=60, path=tmpdir.join('misses.json').strpath,
+    )
+
+
+def test_negative_cache_remembers_misses(negative_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    assert negative_backend.artifact_details(ctx) is None
+
+    # Uploaded by someone else: not noticed until the entry expires.
+    _store(negative_backend.backend, tmpdir, 'my-hash', 'hello')
+    with mock.patch.object(
+            cache.FilesystemBackend, 'artifact_details_many',
+    ) as details_many:
+        assert negative_backend.artifact_details(ctx) is None
+    details_many.assert_called_once_with([])
+
+    with mock.patch.object(cache.time, 'time', return_value=time.time() + 61):
+        assert negative_backend.artifact_details(ctx) == (
+            cache.ArtifactDetails(size=5, compression='none')
+        )
+
+
+def test_negative_cache_many(negative_backend, tmpdir):
+    _store(negative_backend.backend, tmpdir, 'b', 'hello')
+    ctxs = [mock.Mock(hash=hash) for hash in ('a', 'b', 'c')]
+    expected = [None, cache.ArtifactDetails(size=5, compression='none'), None]
+    assert negative_backend.artifact_details_many(ctxs) == expected
+    assert len(json.loads(tmpdir.join('misses.json').read())) == 2
+    assert negative_backend.artifact_details_many(ctxs) == expected
+
+
+def test_negative_cache_forgets_stored_artifacts(negative_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    assert negative_backend.artifact_details(ctx) is None
+    negative_backend.store_artifact_stream(ctx, io.BytesIO(b'hi'), mock.Mock())
+    assert negative_backend.artifact_details(ctx) == (
+        cache.ArtifactDetails(size=2, compression='none')
+    )
+    assert json.loads(tmpdir.join('misses.json').read()) == {}
+
+
+def test_negative_cache_forgets_stored_files(negative_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    assert negative_backend.artifact_details(ctx) is None
+    tmpdir.join('artifact').write('hello')
+    negative_backend.store_artifact(
+        ctx, tmpdir.join('artifact').strpath, mock.Mock(), 'gzip',
+    )
+    assert negative_backend.artifact_details(ctx) == (
+        cache.ArtifactDetails(size=5, compression='gzip')
+    )
+    assert json.loads(tmpdir.join('misses.json').read()) == {}
+
+
+def test_negative_cache_passes_through(negative_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    assert negative_backend.tempdir() == tmpdir.join('cache').strpath
+    negative_backend.store_artifact_stream(ctx, io.BytesIO(b'hi'), mock.Mock())
+
+    callback = mock.Mock()
+    with negative_backend.get_artifact(ctx, callback) as path:
+        assert path == tmpdir.join('cache', 'my-hash.tar').strpath
+    callback.assert_called_once_with(2)
+    out = io.BytesIO()
+    negative_backend.stream_artifact(ctx, out, mock.Mock())
+    assert out.getvalue() == b'hi'
+
+    manifest = {'algorithm': 'sha256', 'members': []}
+    negative_backend.store_file_manifest(ctx, manifest)
+    assert negative_backend.file_manifest(ctx) == manifest
+    assert negative_backend.backend.file_manifest(ctx) == manifest
+
+    with pytest.raises(NotImplementedError):
+        negative_backend.invalidate_artifact(ctx)
+
+
+def test_negative_cache_keyed_by_backend(negative_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    assert negative_backend.artifact_details(ctx) is None
+    other = cache.FilesystemBackend(path=tmpdir.join('other').strpath)
+    _store(other, tmpdir, 'my-hash', 'hello')
+    assert negative_backend._replace(backend=other).artifact_details(ctx)
+
+
+def test_negative_cache_corrupt_file(negative_backend, tmpdir):
+    tmpdir.join('misses.json').write('{')
+    assert negative_backend.artifact_details(mock.Mock(hash='a')) is None
+    assert len(json.loads(tmpdir.join('misses.json').read())) == 1
+
+
+def test_lease_renews_until_released():
+    renew = mock.Mock(return_value=True)
+    release = mock.Mock()
+    with cache.Lease(renew, release, interval=0.001):
+        while renew.call_count < 3:
+            time.sleep(0.001)
+    assert release.call_count == 1
+    count = renew.call_count
+    time.sleep(0.01)
+    assert renew.call_count == count
+
+
+def test_lease_stops_renewing_once_lost():
+    renew = mock.Mock(side_effect=[OSError(), True, False])
+    lease = cache.Lease(renew, mock.Mock(), interval=0.001)
+    lease._thread.join()
+    assert renew.call_count == 3
+    lease.release()
+
+
+def test_fs_lease(fs_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    lock = tmpdir.join('cache', 'my-hash.lock')
+    with fs_backend.acquire_lease(ctx):
+        assert json.loads(lock.read())['pid'] == os.getpid()
+        assert fs_backend.acquire_lease(ctx) is None
+    assert not lock.exists()
+    with fs_backend.acquire_lease(ctx):
+        pass
+
+
+def test_fs_lease_renew(fs_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    lock = tmpdir.join('cache', 'my-hash.lock')
+    with mock.patch.object(cache, 'LEASE_RENEW_INTERVAL', 0.001):
+        with fs_backend.acquire_lease(ctx):
+            lock.setmtime(0)
+            while lock.mtime() == 0:
+                time.sleep(0.001)
+
+
+def test_fs_lease_takes_over_expired_lease(fs_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    lock = tmpdir.join('cache', 'my-hash.lock')
+    lock.write('{}')
+    lock.setmtime(time.time() - cache.LEASE_TTL - 1)
+    with fs_backend.acquire_lease(ctx):
+        assert json.loads(lock.read())['pid'] == os.getpid()
+
+
+def test_fs_lease_concurrent_takeovers(fs_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    lock = tmpdir.join('cache', 'my-hash.lock')
+    lock.write('{}')
+    lock.setmtime(time.time() - cache.LEASE_TTL - 1)
+
+    # Another job takes over the stale lock just after we've looked at it.
+    real_open = open
+    other_leases = []
+
+    def open_then_take_over(path, *args, **kwargs):
+        f = real_open(path, *args, **kwargs)
+        if path == str(lock) and not other_leases:
+            other_leases.append(None)
+            other_leases[0] = fs_backend.acquire_lease(ctx)
+        return f
+
+    with mock.patch('builtins.open', open_then_take_over):
+        assert fs_backend.acquire_lease(ctx) is None
+    other_lease, = other_leases
+    assert other_lease is not None
+
+    # Their lock is left alone, and is still theirs.
+    assert json.loads(lock.read())['pid'] == os.getpid()
+    assert tmpdir.join('cache').listdir('.my-hash.lock.*') == []
+    assert other_lease._renew() is True
+    other_lease.release()
+    assert not lock.exists()
+
+
+def test_fs_lease_lost(fs_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    lock = tmpdir.join('cache', 'my-hash.lock')
+    lease = fs_backend.acquire_lease(ctx)
+    # Taken over by someone else after expiring.
+    lock.remove()
+    lock.write('{"pid": 1}')
+    lock.setmtime(0)
+    assert lease._renew() is False
+    lease.release()
+    assert lock.read() == '{"pid": 1}'
+    assert lock.mtime() == 0
+    # Or removed altogether.
+    lock.remove()
+    assert lease._renew() is False
+    lease.release()
+    assert not lock.exists()
+
+
+def test_fs_lease_lock_vanishes(fs_backend, tmpdir):
+    # The lock keeps disappearing before we can look at it.
+    with mock.patch.object(cache.os, 'open', side_effect=FileExistsError):
+        assert fs_backend.acquire_lease(mock.Mock(hash='my-hash')) is None
+
+
+def test_remove_lock_replaced_twice(tmpdir):
+    lock = tmpdir.join('my-hash.lock')
+    lock.write('first')
+    real_rename = os.rename
+
+    def rename_then_replace(src, dest):
+        real_rename(src, dest)
+        lock.write('third')
+
+    with mock.patch.object(cache.os, 'rename', rename_then_replace):
+        cache._remove_lock(str(lock), lambda st, owner: owner == 'second')
+    assert lock.read() == 'third'
+    assert tmpdir.listdir() == [lock]
+
+
+def _client_error(code):
+    return botocore.exceptions.ClientError({'Error': {'Code': code}}, 'Op')
+
+
+def _stale_s3_lock(fake):
+    fake.put_object(
+        Bucket='my-cool-bucket', Key='artifacts/my-hash.lock', Body=b'{}',
+    )
+    fake._modified['artifacts/my-hash.lock'] -= datetime.timedelta(
+        seconds=cache.LEASE_TTL + 1,
+    )
+
+
+def test_s3_lease(s3_backend):
+    ctx = mock.Mock(hash='my-hash')
+    objects = s3_backend._s3._buckets['my-cool-bucket']
+    with mock.patch.object(cache, 'LEASE_RENEW_INTERVAL', 0.001):
+        with s3_backend.acquire_lease(ctx):
+            body = json.loads(objects['artifacts/my-hash.lock'].decode())
+            assert body['pid'] == os.getpid()
+            assert s3_backend.acquire_lease(ctx) is None
+            etag = s3_backend._s3._etags['artifacts/my-hash.lock']
+            # Renewing replaces the object.
+            while s3_backend._s3._etags['artifacts/my-hash.lock'] == etag:
+                time.sleep(0.001)
+    assert 'artifacts/my-hash.lock' not in objects
+
+
+def test_s3_lease_old_botocore(s3_backend):
+    # e.g. botocore < 1.35.69, which doesn't know about conditional writes
+    with mock.patch.object(
+            S3_MODEL, 'operation_model',
+            return_value=mock.Mock(input_shape=mock.Mock(members={})),
+    ):
+        with pytest.raises(config.UsageError) as excinfo:
+            s3_backend.acquire_lease(mock.Mock(hash='my-hash'))
+    assert str(excinfo.value).startswith(
+        'single-flight with an S3 cache needs botocore 1.35.69 or newer',
+    )
+    assert s3_backend._s3._buckets['my-cool-bucket'] == {}
+
+
+def test_s3_lease_takes_over_expired_lease(s3_backend):
+    _stale_s3_lock(s3_backend._s3)
+    lease = s3_backend.acquire_lease(mock.Mock(hash='my-hash'))
+    assert lease is not None
+    lease.release()
+
+
+def test_s3_lease_conflict(s3_backend):
+    # S3 reports a conflict when someone else's conditional PUT is underway.
+    with mock.patch.object(
+            s3_backend._s3, 'put_object',
+            side_effect=_client_error('ConditionalRequestConflict'),
+    ):
+        assert s3_backend.acquire_lease(mock.Mock(hash='my-hash')) is None
+
+
+def test_s3_lease_put_error(s3_backend):
+    with mock.patch.object(
+            s3_backend._s3, 'put_object',
+            side_effect=_client_error('AccessDenied'),
+    ):
+        with pytest.raises(botocore.exceptions.ClientError):
+            s3_backend.acquire_lease(mock.Mock(hash='my-hash'))
+
+
+def test_s3_lease_released_while_looking(s3_backend):
+    fake = s3_backend._s3
+    objects = fake._buckets['my-cool-bucket']
+    objects['artifacts/my-hash.lock'] = b'{}'
+    head_object = fake.head_object
+
+    def release_then_head(Bucket, Key):
+        del objects[Key]
+        return head_object(Bucket, Key)
+
+    with mock.patch.object(fake, 'head_object', release_then_head):
+        lease = s3_backend.acquire_lease(mock.Mock(hash='my-hash'))
+    assert lease is not None
+    lease.release()
+    assert 'artifacts/my-hash.lock' not in objects
+
+
+def test_s3_lease_head_error(s3_backend):
+    s3_backend._s3._buckets['my-cool-bucket']['artifacts/my-hash.lock'] = b''
+    with mock.patch.object(
+            s3_backend._s3, 'head_object',
+            side_effect=_client_error('AccessDenied'),
+    ):
+        with pytest.raises(botocore.exceptions.ClientError):
+            s3_backend.acquire_lease(mock.Mock(hash='my-hash'))
+
+
+@pytest.mark.parametrize('code', ('PreconditionFailed', 'NoSuchKey'))
+def test_s3_lease_takeover_lost(s3_backend, code):
+    # Someone else renews or takes over the stale lock before we remove it.
+    _stale_s3_lock(s3_backend._s3)
+    with mock.patch.object(
+            s3_backend._s3, 'delete_object', side_effect=_client_error(code),
+    ) as delete_object:
+        assert s3_backend.acquire_lease(mock.Mock(hash='my-hash')) is None
+    assert delete_object.call_count == 2
+
+
+def test_s3_lease_takeover_error(s3_backend):
+    _stale_s3_lock(s3_backend._s3)
+    with mock.patch.object(
+            s3_backend._s3, 'delete_object',
+            side_effect=_client_error('AccessDenied'),
+    ):
+        with pytest.raises(botocore.exceptions.ClientError):
+            s3_backend.acquire_lease(mock.Mock(hash='my-hash'))
+
+
+def test_s3_lease_lost(s3_backend):
+    fake = s3_backend._s3
+    objects = fake._buckets['my-cool-bucket']
+    lease = s3_backend._lease('artifacts/my-hash.lock', '"stale"')
+    fake.put_object(
+        Bucket='my-cool-bucket', Key='artifacts/my-hash.lock', Body=b'',
+    )
+    # Someone else holds it now, so it's neither renewed nor removed.
+    assert lease._renew() is False
+    lease.release()
+    assert 'artifacts/my-hash.lock' in objects
+    # Or it's gone altogether.
+    del objects['artifacts/my-hash.lock']
+    lease.release()
+    assert 'artifacts/my-hash.lock' not in objects
+
+
+def test_chain_lease_uses_slowest_backend(chain_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    with chain_backend.acquire_lease(ctx):
+        assert tmpdir.join('shared', 'my-hash.lock').exists()
+        assert not tmpdir.join('local', 'my-hash.lock').exists()
+
+
+def test_chunked_lease(chunked_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    with chunked_backend.acquire_lease(ctx):
+        assert chunked_backend.acquire_lease(ctx) is None
+
+
+def test_negative_cache_lease_forgets_miss(negative_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    assert negative_backend.artifact_details(ctx) is None
+    # Someone else builds it before we get the lease.
+    _store(negative_backend.backend, tmpdir, 'my-hash', 'hello')
+    with negative_backend.acquire_lease(ctx):
+        assert negative_backend.artifact_details(ctx) is not None
+
+
+def test_negative_cache_lease_held_forgets_miss(negative_backend, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    assert negative_backend.artifact_details(ctx) is None
+    with negative_backend.backend.acquire_lease(ctx):
+        # Someone else is building it, so it'll be looked up again.
+        assert negative_backend.acquire_lease(ctx) is None
+        _store(negative_backend.backend, tmpdir, 'my-hash', 'hello')
+        assert negative_backend.artifact_details(ctx) is not None
@@ -0,0 +1,128 @@
+import io
+import os
+import tarfile
+from unittest import mock
+
+import pytest
+
+from lazy_build import chunking
+from lazy_build import context
+
+
+@pytest.fixture
+def small_chunks():
+    with mock.patch.object(chunking, 'CHUNK_MIN_SIZE', 10):
+        with mock.patch.object(chunking, 'CHUNK_MAX_SIZE', 100):
+            with mock.patch.object(chunking, 'BOUNDARY_MASK', 0x1):
+                yield
+
+
+def make_tree(tmpdir, files):
+    tmpdir.join('out').ensure_dir()
+    for name, content in files.items():
+        tmpdir.join('out', name).write_binary(content, ensure=True)
+    tmpdir.join('out', 'link').mksymlinkto('a')
+    tmpdir.join('out', 'empty').ensure_dir()
+
+
+def tarball(tmpdir):
+    buf = io.BytesIO()
+    with tmpdir.as_cwd():
+        with tarfile.open(fileobj=buf, mode='w|') as tf:
+            context._add_to_tarball(tf, 'out')
+    buf.seek(0)
+    return buf
+
+
+def split(tmpdir):
+    members = []
+    chunks = list(chunking.split_tarball(tarball(tmpdir), members))
+    return members, chunks
+
+
+# Deterministic contents, so chunk boundaries are the same on every run.
+FILES = {
+    f'file{i}': (context.hash(str(i).encode()) * 2)[:20 + i].encode()
+    for i in range(20)
+}
+
+
+def test_split_and_join_round_trip(small_chunks, tmpdir):
+    make_tree(tmpdir, dict(FILES, big=os.urandom(350)))
+    members, chunks = split(tmpdir)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 100 for chunk in chunks)
+
+    buf = io.BytesIO()
+    chunking.join_tarball(members, chunks, buf)
+    buf.seek(0)
+    out = tmpdir.join('restored').ensure_dir()
+    with out.as_cwd():
+        with tarfile.open(fileobj=buf, mode='r|') as tf:
+            tf.extractall()
+
+    for name, content in FILES.items():
+        assert out.join('out', name).read_binary() == content
+    assert out.join('out', 'link').readlink() == 'a'
+    assert out.join('out', 'empty').isdir()
+    original = {m['name']: m for m in members}
+    assert out.join('out', 'file1').mtime() == int(
+        original['out/file1']['mtime'],
+    )
+
+
+def test_members(tmpdir):
+    make_tree(tmpdir, {'a': b'hello'})
+    members, chunks = split(tmpdir)
+    by_name = {m['name']: m for m in members}
+    assert by_name['out/a']['size'] == 5
+    assert by_name['out/a']['digest'] == context.hash(b'hello')
+    assert by_name['out/link']['type'] == tarfile.SYMTYPE.decode()
+    assert by_name['out/link']['linkname'] == 'a'
+    assert by_name['out/empty']['digest'] is None
+    assert chunks == [b'hello']
+
+
+def test_chunks_ignore_metadata(small_chunks, tmpdir):
+    make_tree(tmpdir, FILES)
+    members1, chunks1 = split(tmpdir)
+    for path in tmpdir.join('out').visit():
+        os.utime(path.strpath, (1, 1), follow_symlinks=False)
+    members2, chunks2 = split(tmpdir)
+    assert members1 != members2
+    assert chunks1 == chunks2
+
+
+def test_chunks_are_stable_around_changes(small_chunks, tmpdir):
+    make_tree(tmpdir, FILES)
+    members, before = split(tmpdir)
+    # file10 sorts in the middle of the tree.
+    tmpdir.join('out', 'file10').write_binary(b'changed')
+    members, after = split(tmpdir)
+    assert len(set(before) & set(after)) >= len(before) - 3
+
+
+def test_large_files_start_new_chunks(small_chunks, tmpdir):
+    big = os.urandom(250)
+    make_tree(tmpdir, {'a': b'x' * 15, 'b': big})
+    members, chunks = split(tmpdir)
+    assert chunks == [b'x' * 15, big[:100], big[100:200], big[200:]]
+
+
+def test_chunk_reader():
+    reader = chunking._ChunkReader([b'ab', b'', b'cde'])
+    assert reader.read(3) == b'abc'
+    assert reader.read(10) == b'de'
+    assert reader.read(10) == b''
+
+
+def test_split_compressed(tmpdir):
+    make_tree(tmpdir, {'a': b'hello'})
+    buf = io.BytesIO()
+    with tmpdir.as_cwd():
+        conf = mock.Mock(compression='gzip', compression_level=None, jobs=1)
+        conf.output = {'out'}
+        context.write_artifact(conf, buf)
+    buf.seek(0)
+    members = []
+    assert list(chunking.split_tarball(buf, members, 'gzip')) == [b'hello']
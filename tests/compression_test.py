@@ -0,0 +1,43 @@
+import io
+
+import pytest
+
+from lazy_build import compression
+
+
+@pytest.fixture(params=sorted(compression.CODECS))
+def codec(request):
+    pytest.importorskip(compression.CODECS[request.param].module)
+    return request.param
+
+
+@pytest.mark.parametrize('level', (None, 1))
+def test_round_trip(codec, level):
+    data = b'hello world\n' * 10000
+    f = io.BytesIO()
+    with compression.compress(codec, f, level, threads=2) as compressed:
+        compressed.write(data)
+    assert not f.closed
+    if codec != 'none':
+        assert len(f.getvalue()) < len(data)
+
+    f.seek(0)
+    with compression.decompress(codec, f) as decompressed:
+        assert decompressed.read() == data
+    assert not f.closed
+
+
+def test_none_ignores_close():
+    f = io.BytesIO()
+    with compression.compress('none', f) as compressed:
+        compressed.write(b'hi')
+        compressed.close()
+    assert not f.closed
+    assert f.getvalue() == b'hi'
+
+
+def test_available():
+    assert compression.CODECS['gzip'].available is True
+    assert compression.Codec('nope', 'not_a_module', None, None).available is (
+        False
+    )
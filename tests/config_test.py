@@ -1,9 +1,13 @@
 import json
+import os
 from unittest import mock
 
 import pytest
 
+from lazy_build import cache
+from lazy_build import compression
 from lazy_build import config
+from lazy_build import util
 
 
 @pytest.fixture
@@ -26,6 +30,7 @@ def with_config_file(tmpdir):
         (
             '--verbose',
             '--dry-run',
+            '--jobs=4',
             'build',
             'context=', 'requirements.txt', 'setup.py',
             'ignore=', '*.py[co]', '*.swp',
@@ -43,6 +48,18 @@ def with_config_file(tmpdir):
             output={'venv', 'node_modules'},
             backend=mock.ANY,
             after_download=('python', '-m', 'virtualenv_tools'),
+            jobs=4,
+            hash_algorithm='sha256',
+            compression='none',
+            compression_level=None,
+            streaming=False,
+            stream_buffer_size=64 * 2**20,
+            delta_restore=False,
+            targets=(),
+            parallel_targets=4,
+            trace=None,
+            profile=None,
+            single_flight=None,
         ),
     ),
     (
@@ -57,6 +74,18 @@ def with_config_file(tmpdir):
             output=set(),
             backend=mock.ANY,
             after_download=(),
+            jobs=os.cpu_count() or 1,
+            hash_algorithm='sha256',
+            compression='none',
+            compression_level=None,
+            streaming=False,
+            stream_buffer_size=64 * 2**20,
+            delta_restore=False,
+            targets=(),
+            parallel_targets=4,
+            trace=None,
+            profile=None,
+            single_flight=None,
         ),
     ),
     (
@@ -71,6 +100,18 @@ def with_config_file(tmpdir):
             output=set(),
             backend=mock.ANY,
             after_download=(),
+            jobs=os.cpu_count() or 1,
+            hash_algorithm='sha256',
+            compression='none',
+            compression_level=None,
+            streaming=False,
+            stream_buffer_size=64 * 2**20,
+            delta_restore=False,
+            targets=(),
+            parallel_targets=4,
+            trace=None,
+            profile=None,
+            single_flight=None,
         ),
     ),
 ))
@@ -78,6 +119,227 @@ def test_from_args(with_config_file, args, expected):
     assert config.Config.from_args(args) == expected
 
 
+@pytest.mark.parametrize('flag', ('-j3', '--jobs=3'))
+def test_from_args_jobs_flag(with_config_file, flag):
+    assert config.Config.from_args((flag, 'build')).jobs == 3
+
+
+def test_from_args_jobs_from_config_file(with_config_file, tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'jobs': 2,
+    }))
+    assert config.Config.from_args(('build',)).jobs == 2
+    assert config.Config.from_args(('--jobs=5', 'build')).jobs == 5
+
+
+def test_from_args_trace_flags(with_config_file):
+    conf = config.Config.from_args(
+        ('--trace=trace.json', '--profile=prof', 'build'),
+    )
+    assert (conf.trace, conf.profile) == ('trace.json', 'prof')
+
+
+@pytest.mark.parametrize(('value', 'expected'), (
+    (False, None),
+    (True, 1800),
+    (60, 60),
+))
+def test_from_args_single_flight(with_config_file, tmpdir, value, expected):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'single-flight': value,
+    }))
+    assert config.Config.from_args(('build',)).single_flight == expected
+
+
+def test_from_args_hash_algorithm(with_config_file, tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'hash-algorithm': 'blake2b',
+    }))
+    assert config.Config.from_args(('build',)).hash_algorithm == 'blake2b'
+
+
+def test_from_args_unknown_hash_algorithm(with_config_file, tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'hash-algorithm': 'crc32',
+    }))
+    with pytest.raises(config.UsageError) as exc_info:
+        config.Config.from_args(('build',))
+    message, = exc_info.value.args
+    assert message.startswith(
+        'Unknown hash algorithm: crc32\n'
+        'Available algorithms: blake2b, blake2s, ',
+    )
+
+
+def test_from_args_compression(with_config_file, tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {
+            'source': 'filesystem',
+            'path': 'cache',
+            'compression': 'gzip',
+            'compression-level': 1,
+        },
+    }))
+    conf = config.Config.from_args(('build',))
+    assert (conf.compression, conf.compression_level) == ('gzip', 1)
+
+
+def test_from_args_s3_transfer_settings(with_config_file, tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {
+            'source': 's3',
+            'bucket': 'my-cool-bucket',
+            'path': 'some/path',
+            'endpoint-url': 'http://localhost:9000',
+            'multipart-threshold': 8 * 2**20,
+            'multipart-chunksize': 16 * 2**20,
+            'max-concurrency': 20,
+            'max-pool-connections': 30,
+        },
+    }))
+    conf = config.Config.from_args(('build',))
+    assert conf.backend == cache.S3Backend(
+        bucket='my-cool-bucket',
+        path='some/path',
+        endpoint_url='http://localhost:9000',
+        multipart_threshold=8 * 2**20,
+        multipart_chunksize=16 * 2**20,
+        max_concurrency=20,
+        max_pool_connections=30,
+    )
+
+
+def test_from_args_cache_chain(with_config_file, tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': [
+            {
+                'source': 'filesystem',
+                'path': '~/lazy-build-cache',
+                'max-size': 2**30,
+            },
+            {
+                'source': 's3',
+                'bucket': 'my-cool-bucket',
+                'path': 'some/path',
+                'compression': 'gzip',
+            },
+        ],
+    }))
+    with mock.patch.dict(os.environ, {'HOME': '/home/me'}):
+        conf = config.Config.from_args(('build',))
+    assert conf.backend == cache.ChainBackend((
+        cache.FilesystemBackend(
+            path='/home/me/lazy-build-cache',
+            max_size=2**30,
+        ),
+        cache.S3Backend(bucket='my-cool-bucket', path='some/path'),
+    ))
+    assert conf.compression == 'gzip'
+
+
+def test_from_args_chunking(with_config_file, tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {
+            'source': 'filesystem',
+            'path': 'cache',
+            'compression': 'gzip',
+            'compression-level': 1,
+        },
+        'chunking': True,
+    }))
+    conf = config.Config.from_args(('build',))
+    assert conf.backend == cache.ChunkedBackend(
+        cache.FilesystemBackend(path='cache'),
+        compression='gzip',
+        compression_level=1,
+    )
+    assert (conf.compression, conf.compression_level) == ('none', None)
+
+
+@pytest.mark.parametrize('caches', (
+    {'source': 'filesystem', 'path': 'cache', 'max-size': 2**30},
+    [
+        {'source': 's3', 'bucket': 'my-cool-bucket', 'path': 'some/path'},
+        {'source': 'filesystem', 'path': 'cache', 'max-size': 2**30},
+    ],
+))
+def test_from_args_chunking_evicting_cache(with_config_file, tmpdir, caches):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': caches,
+        'chunking': True,
+    }))
+    with pytest.raises(config.UsageError) as exc_info:
+        config.Config.from_args(('build',))
+    assert exc_info.value.args == (
+        "Chunking can't be used when the last cache has a max-size.",
+    )
+
+
+def test_from_args_chunking_local_evicting_cache(with_config_file, tmpdir):
+    # Chunks evicted from a cache in front are fetched from the next one.
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': [
+            {'source': 'filesystem', 'path': 'cache', 'max-size': 2**30},
+            {'source': 's3', 'bucket': 'my-cool-bucket', 'path': 'some/path'},
+        ],
+        'chunking': True,
+    }))
+    conf = config.Config.from_args(('build',))
+    assert isinstance(conf.backend, cache.ChunkedBackend)
+
+
+def test_from_args_negative_cache_ttl(with_config_file, tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'negative-cache-ttl': 60,
+    }))
+    conf = config.Config.from_args(('build',))
+    assert conf.backend == cache.NegativeCacheBackend(
+        cache.FilesystemBackend(path='cache'),
+        ttl=60,
+        path=os.path.join(util.cache_dir(), 'negative-lookups.json'),
+    )
+
+
+def test_from_args_unknown_compression(with_config_file, tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {
+            'source': 'filesystem',
+            'path': 'cache',
+            'compression': 'zip',
+        },
+    }))
+    with pytest.raises(config.UsageError) as exc_info:
+        config.Config.from_args(('build',))
+    assert exc_info.value.args == (
+        'Unknown compression codec: zip\n'
+        'Available codecs: bz2, gzip, lz4, none, xz, zstd',
+    )
+
+
+def test_from_args_unavailable_compression(with_config_file, tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {
+            'source': 'filesystem',
+            'path': 'cache',
+            'compression': 'zstd',
+        },
+    }))
+    with mock.patch.object(
+            compression.Codec, 'available', new_callable=mock.PropertyMock,
+            return_value=False,
+    ):
+        with pytest.raises(config.UsageError) as exc_info:
+            config.Config.from_args(('build',))
+    assert exc_info.value.args == (
+        'The zstd codec requires the zstandard module to be installed.',
+    )
+
+
 def test_from_args_multiple_actions(with_config_file):
     with pytest.raises(config.UsageError) as exc_info:
         config.Config.from_args(('build', 'invalidate'))
@@ -109,11 +371,152 @@ def test_from_args_unknown_second_option(with_config_file):
 
 def test_from_args_bogus_flag(with_config_file):
     with pytest.raises(config.UsageError) as exc_info:
-        config.Config.from_args(('build', '--yolo', '--wuddup'))
-    assert exc_info.value.args == ('Unknown flags: --wuddup, --yolo',)
+        config.Config.from_args(('build', '--yolo', '--wuddup', '--jobs=0'))
+    assert exc_info.value.args == (
+        'Unknown flags: --jobs=0, --wuddup, --yolo',
+    )
 
 
 def test_from_args_no_action(with_config_file):
     with pytest.raises(config.UsageError) as exc_info:
         config.Config.from_args(())
     assert exc_info.value.args == ('You must provide an action',)
+
+
+@pytest.fixture
+def with_targets(with_config_file, tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'ignore': ['*.pyc'],
+        'targets': {
+            'venv': {
+                'context': ['requirements.txt'],
+                'output': ['venv'],
+                'command': ['make', 'venv'],
+                'after-download': ['fix-venv'],
+            },
+            'node': {
+                'context': ['package.json'],
+                'ignore': ['*.log'],
+                'output': ['node_modules'],
+                'command': ['npm', 'install'],
+            },
+        },
+        'parallel-targets': 2,
+    }))
+
+
+def test_from_args_batch(with_targets):
+    conf = config.Config.from_args(('batch',))
+    assert conf.parallel_targets == 2
+    assert conf.targets == (
+        config.Target(
+            name='node',
+            context=frozenset({'package.json'}),
+            command=('npm', 'install'),
+            ignore=frozenset({'*.log'}),
+            output=frozenset({'node_modules'}),
+            after_download=(),
+            deps=(),
+        ),
+        config.Target(
+            name='venv',
+            context=frozenset({'requirements.txt'}),
+            command=('make', 'venv'),
+            ignore=frozenset(),
+            output=frozenset({'venv'}),
+            after_download=('fix-venv',),
+            deps=(),
+        ),
+    )
+
+    node = conf.for_target(conf.targets[0])
+    assert node.action == 'build'
+    assert node.context == {'package.json'}
+    assert node.ignore == {'*.pyc', '*.log'}
+    assert node.command == ('npm', 'install')
+    assert node.targets == ()
+
+
+def test_from_args_batch_selected_targets(with_targets):
+    conf = config.Config.from_args(('batch', 'targets=', 'venv'))
+    assert [target.name for target in conf.targets] == ['venv']
+
+
+def test_from_args_batch_unknown_targets(with_targets):
+    with pytest.raises(config.UsageError) as exc_info:
+        config.Config.from_args(('batch', 'targets=', 'venv', 'nope'))
+    assert exc_info.value.args == ('Unknown targets: nope',)
+
+
+def test_from_args_batch_targets_file(with_targets, tmpdir):
+    tmpdir.join('targets.json').write(json.dumps({
+        'docs': {'output': ['html'], 'command': ['make', 'docs']},
+    }))
+    conf = config.Config.from_args(
+        ('batch', 'targets-file=', 'targets.json'),
+    )
+    assert [target.name for target in conf.targets] == ['docs']
+
+
+def test_from_args_batch_no_targets(with_config_file):
+    with pytest.raises(config.UsageError) as exc_info:
+        config.Config.from_args(('batch',))
+    assert exc_info.value.args == ('There are no targets to build',)
+
+
+def _targets(**deps):
+    return {
+        name: config.Target.from_config(name, {
+            'output': [name + '-out'],
+            'command': ['true'],
+            'deps': target_deps,
+        })
+        for name, target_deps in deps.items()
+    }
+
+
+def test_order_targets():
+    available = _targets(app=['lib', 'gen'], lib=['gen'], gen=[], docs=[])
+    ordered = config.order_targets(available, ['app', 'docs'])
+    assert [target.name for target in ordered] == ['gen', 'lib', 'app', 'docs']
+
+
+def test_order_targets_only_needed():
+    available = _targets(app=['gen'], gen=[], docs=[])
+    ordered = config.order_targets(available, ['app'])
+    assert [target.name for target in ordered] == ['gen', 'app']
+
+
+def test_order_targets_unknown_dep():
+    with pytest.raises(config.UsageError) as exc_info:
+        config.order_targets(_targets(app=['nope']), ['app'])
+    assert exc_info.value.args == (
+        'Target app depends on unknown target: nope',
+    )
+
+
+def test_order_targets_cycle():
+    available = _targets(a=['b'], b=['c'], c=['a'])
+    with pytest.raises(config.UsageError) as exc_info:
+        config.order_targets(available, ['a'])
+    assert exc_info.value.args == ('Dependency cycle: a -> b -> c -> a',)
+
+
+def test_for_target_ignores_dependency_outputs(with_targets, tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'targets': {
+            'gen': {'output': ['gen/py'], 'command': ['make', 'gen']},
+            'app': {
+                'context': ['.'],
+                'output': ['app'],
+                'command': ['make', 'app'],
+                'deps': ['gen'],
+            },
+        },
+    }))
+    conf = config.Config.from_args(('batch', 'targets=', 'app'))
+    gen, app = conf.targets
+    assert conf.for_target(app).ignore == {'/gen/py'}
+    assert conf.for_target(gen).ignore == frozenset()
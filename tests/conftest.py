@@ -1,9 +1,25 @@
+import collections
+
 import pytest
 
 from lazy_build import cache
 from lazy_build import config
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir_factory, monkeypatch):
+    """Keep local caches (e.g. the hash index) out of the real home dir."""
+    path = tmpdir_factory.mktemp('xdg-cache')
+    monkeypatch.setenv('XDG_CACHE_HOME', path.strpath)
+    return path.join('lazy-build')
+
+
+@pytest.fixture(autouse=True)
+def manifest_cache(monkeypatch):
+    """Forget chunk manifests remembered by other tests."""
+    monkeypatch.setattr(cache, '_manifests', collections.OrderedDict())
+
+
 @pytest.fixture
 def simple_config():
     return config.Config(
@@ -16,4 +32,16 @@ def simple_config():
         output={'venv'},
         backend=cache.FilesystemBackend(path='cache'),
         after_download=(),
+        jobs=1,
+        hash_algorithm='sha256',
+        compression='none',
+        compression_level=None,
+        streaming=False,
+        stream_buffer_size=2**20,
+        delta_restore=False,
+        targets=(),
+        parallel_targets=4,
+        trace=None,
+        profile=None,
+        single_flight=None,
     )
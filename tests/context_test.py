@@ -2,12 +2,38 @@ import io
 import json
 import os
 import tarfile
+from unittest import mock
 
 import pytest
 
 from lazy_build import context
 
 
+@pytest.mark.parametrize('size', (0, 1, 7, 8, 9, 100))
+@pytest.mark.parametrize('algorithm', ('sha256', 'blake2b'))
+def test_hash_file_chunked(tmpdir, size, algorithm):
+    data = os.urandom(size)
+    tmpdir.join('f').write(data, mode='wb')
+    with mock.patch.object(context, 'HASH_CHUNK_SIZE', 8):
+        with open(tmpdir.join('f').strpath, 'rb', buffering=0) as f:
+            assert (
+                context.hash_file(f, algorithm) ==
+                context.hash(data, algorithm)
+            )
+
+
+def test_file_context_from_path(tmpdir):
+    tmpdir.join('f').write('hi')
+    tmpdir.join('l').mksymlinkto('f')
+    # Whether it's a link is worked out if not given.
+    assert context.FileContext.from_path(tmpdir.join('f').strpath) == (
+        context.FileContext('file', context.hash(b'hi'))
+    )
+    assert context.FileContext.from_path(tmpdir.join('l').strpath) == (
+        context.FileContext('link', context.hash(b'f'))
+    )
+
+
 @pytest.mark.parametrize(('patterns', 'path'), (
     ({'/venv'}, 'venv'),
     ({'venv'}, 'venv'),
@@ -17,6 +43,21 @@ from lazy_build import context
     ({'*.swp'}, 'something.swp'),
     ({'*.swp'}, 'hello/there/something.swp'),
     ({'.*.sw[a-z]'}, 'my/.thing.txt.swo'),
+    ({'*.py[co]'}, 'a/b.pyc'),
+    ({'file[!a-z]'}, 'file1'),
+    ({'a[[]b'}, 'a[b'),
+    ({'a[^]b'}, 'a^b'),
+    ({'a[]]b'}, 'a]b'),
+    ({'a[!]]b'}, 'a1b'),
+    ({'a[b'}, 'a[b'),
+    ({'a?c'}, 'abc'),
+    ({'\\*'}, '*'),
+    ({'venv/'}, 'venv/bin/python'),
+    ({'/a/**/d'}, 'a/d'),
+    ({'/a/**/d'}, 'a/b/c/d'),
+    ({'a/**'}, 'x/a/b/c'),
+    ({'*.log', '!important.log'}, 'logs/debug.log'),
+    ({'logs/', '!logs/important.log'}, 'logs/important.log'),
 ))
 def test_should_ignore_true(patterns, path):
     assert context.should_ignore(patterns, path) is True
@@ -26,11 +67,34 @@ def test_should_ignore_true(patterns, path):
     ({'/venv'}, 'this/is/some/venv'),
     ({'a/venv'}, 'this/is/some/venv'),
     ({'venv'}, 'venv2'),
+    ({'a*c'}, 'ab/c'),
+    ({'a?c'}, 'a/c'),
+    ({'file[!a-z]'}, 'filea'),
+    ({'a[!]]b'}, 'a]b'),
+    ({'\\*'}, 'a'),
+    ({'venv/'}, 'venv'),
+    ({'/a/**/d'}, 'x/a/d'),
+    ({'*.log', '!important.log'}, 'logs/important.log'),
+    ({'!venv'}, 'venv'),
+    ({'/'}, 'venv'),
+    (set(), 'venv'),
 ))
 def test_should_ignore_false(patterns, path):
     assert context.should_ignore(patterns, path) is False
 
 
+def test_should_ignore_directory_only():
+    assert context.should_ignore({'venv/'}, 'venv', is_dir=True) is True
+    assert context.should_ignore({'venv/'}, 'venv', is_dir=False) is False
+
+
+def test_ignore_matcher_matches_ignores_parents():
+    matcher = context.IgnoreMatcher({'venv'})
+    assert matcher('venv/bin') is True
+    assert matcher.matches('venv/bin') is False
+    assert matcher.matches('venv', is_dir=True) is True
+
+
 def test_build_context_simple(simple_config, tmpdir):
     tmpdir.chdir()
     conf = simple_config._replace(
@@ -53,12 +117,124 @@ def test_build_context_simple(simple_config, tmpdir):
             'f': context.FileContext('link', context.hash(b'/etc/passwd')),
         },
         command=('command',),
+        algorithm='sha256',
     )
     assert ctx.hash == context.hash(
         json.dumps((('command',), ctx.files), sort_keys=True).encode('utf8'),
     )
 
 
+def test_find_files(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('a').write('foo')
+    tmpdir.join('b/c').write('bar', ensure=True)
+    tmpdir.join('b/d').mksymlinkto('c')
+    tmpdir.join('e').mksymlinkto('b')
+    tmpdir.join('node_modules/x/y').write('baz', ensure=True)
+    tmpdir.join('z.pyc').write('')
+
+    scanned = []
+    real_scandir = os.scandir
+
+    def scandir(path):
+        scanned.append(path)
+        return real_scandir(path)
+
+    with mock.patch.object(context.os, 'scandir', scandir):
+        files = set(context.find_files(
+            {'.', 'b', 'a', 'z.pyc'},
+            context.IgnoreMatcher({'node_modules', '*.pyc'}),
+        ))
+
+    assert files == {
+        ('a', False),
+        ('b/c', False),
+        ('b/d', True),
+        ('e', True),
+    }
+    # Ignored directories are never listed, and each directory is only
+    # listed once even if it's reachable from multiple roots.
+    assert sorted(scanned) == ['.', 'b']
+
+
+def test_build_context_deps():
+    ctx = context.BuildContext(('command',), {}, 'sha256')
+    assert ctx.deps == {}
+    # Contexts without dependencies hash as they always have.
+    assert ctx.hash == context.hash(
+        json.dumps((('command',), {})).encode('utf8'),
+    )
+    with_deps = ctx._replace(deps={'gen': 'abc'})
+    assert with_deps.hash != ctx.hash
+    assert with_deps.hash != ctx._replace(deps={'gen': 'def'}).hash
+
+
+@pytest.mark.parametrize('jobs', (1, 4))
+def test_build_contexts_shares_hashing(simple_config, tmpdir, jobs):
+    tmpdir.chdir()
+    tmpdir.join('shared').write('shared')
+    tmpdir.join('a').write('a')
+    tmpdir.join('b').write('b')
+    confs = [
+        simple_config._replace(context={'shared', 'a'}, jobs=jobs),
+        simple_config._replace(context={'shared', 'b'}, command=('b',)),
+    ]
+    with mock.patch.object(
+            context.FileContext,
+            'from_path',
+            wraps=context.FileContext.from_path,
+    ) as from_path:
+        ctxs = context.build_contexts(confs)
+    assert ctxs == [context.build_context(conf) for conf in confs]
+    assert sorted(call[0][0] for call in from_path.call_args_list) == [
+        'a', 'b', 'shared',
+    ]
+
+
+def test_build_context_directory_only_ignore(simple_config, tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('build/a').write('foo', ensure=True)
+    tmpdir.join('src/build').write('bar', ensure=True)
+    ctx = context.build_context(
+        simple_config._replace(context={'.'}, ignore={'build/'}),
+    )
+    assert set(ctx.files) == {'src/build'}
+
+
+def test_build_context_hash_algorithm(simple_config, tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('d/a').write(b'foo', ensure=True)
+    tmpdir.join('d/b').mksymlinkto('a')
+    conf = simple_config._replace(context={'d'}, command=('command',))
+
+    ctx = context.build_context(conf._replace(hash_algorithm='blake2b'))
+    assert ctx.files == {
+        'd/a': context.FileContext('file', context.hash(b'foo', 'blake2b')),
+        'd/b': context.FileContext('link', context.hash(b'a', 'blake2b')),
+    }
+
+    # The top-level hash is still sha256, but namespaced by the algorithm.
+    assert ctx.hash == 'blake2b-' + context.hash(
+        json.dumps((('command',), ctx.files), sort_keys=True).encode('utf8'),
+    )
+    assert ctx.hash != context.build_context(conf).hash
+
+
+def test_build_context_parallel_matches_serial(simple_config, tmpdir):
+    tmpdir.chdir()
+    for i in range(50):
+        tmpdir.join('dir{}'.format(i % 5), 'file{}'.format(i)).write(
+            str(i) * 5000, ensure=True,
+        )
+    conf = simple_config._replace(context={'.'}, ignore=set())
+
+    serial = context.build_context(conf._replace(jobs=1))
+    parallel = context.build_context(conf._replace(jobs=8))
+    assert len(serial.files) == 50
+    assert parallel == serial
+    assert parallel.hash == serial.hash
+
+
 def test_package_artifact(simple_config, tmpdir):
     tmpdir.chdir()
     tmpdir.join('a').ensure()
@@ -76,7 +252,55 @@ def test_package_artifact(simple_config, tmpdir):
     finally:
         os.remove(tmp)
 
-    assert members == {'b/c', 'c'}
+    assert members == {'b', 'b/c', 'c'}
+
+
+def test_package_artifact_round_trip(simple_config, tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('out/bin/run').write('#!/bin/sh\n', ensure=True)
+    tmpdir.join('out/bin/run').chmod(0o755)
+    tmpdir.join('out/empty').mkdir()
+    tmpdir.join('out/link').mksymlinkto('bin/run')
+    tmpdir.join('out/dangling').mksymlinkto('nowhere')
+    conf = simple_config._replace(output={'out'})
+
+    tmp = context.package_artifact(conf)
+    try:
+        tmpdir.join('out').remove()
+        context.extract_artifact(conf, tmp)
+    finally:
+        os.remove(tmp)
+
+    assert tmpdir.join('out/bin/run').read() == '#!/bin/sh\n'
+    assert tmpdir.join('out/bin/run').stat().mode & 0o777 == 0o755
+    assert tmpdir.join('out/empty').isdir()
+    assert tmpdir.join('out/link').readlink() == 'bin/run'
+    assert tmpdir.join('out/dangling').readlink() == 'nowhere'
+
+
+@pytest.mark.parametrize('codec', ('gzip', 'xz', 'none'))
+def test_package_artifact_compressed(simple_config, tmpdir, codec):
+    tmpdir.chdir()
+    tmpdir.join('out/a').write('hello' * 1000, ensure=True)
+    conf = simple_config._replace(output={'out'}, compression=codec)
+
+    tmp = context.package_artifact(conf)
+    try:
+        with tarfile.open(tmp, 'r:*') as tf:
+            assert tf.getnames() == ['out', 'out/a']
+        tmpdir.join('out').remove()
+        context.extract_artifact(conf, tmp, codec)
+    finally:
+        os.remove(tmp)
+
+    assert tmpdir.join('out/a').read() == 'hello' * 1000
+
+
+def test_package_artifact_special_file(simple_config, tmpdir):
+    tmpdir.chdir()
+    os.mkfifo('fifo')
+    with pytest.raises(ValueError):
+        context.package_artifact(simple_config._replace(output={'fifo'}))
 
 
 def test_extract_artifact(simple_config, tmpdir):
@@ -104,3 +328,109 @@ def test_extract_artifact(simple_config, tmpdir):
 
     assert tmpdir.join('a/sup').isfile()
     assert not tmpdir.join('a/b/sup').isfile()
+
+
+def test_package_artifact_manifest(simple_config, tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('out/a').write('hello', ensure=True)
+    tmpdir.join('out/link').mksymlinkto('a')
+    conf = simple_config._replace(output={'out'}, hash_algorithm='blake2b')
+    manifest = context.new_manifest(conf)
+    os.remove(context.package_artifact(conf, manifest=manifest))
+
+    assert manifest['algorithm'] == 'blake2b'
+    by_name = {member['name']: member for member in manifest['members']}
+    assert [member['name'] for member in manifest['members']] == [
+        'out', 'out/a', 'out/link',
+    ]
+    assert by_name['out']['type'] == '5'
+    assert by_name['out/a']['digest'] == context.hash(b'hello', 'blake2b')
+    assert by_name['out/a']['size'] == 5
+    assert by_name['out/link']['linkname'] == 'a'
+
+
+@pytest.fixture
+def restorable(simple_config, tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('out/bin/run').write('#!/bin/sh\n', ensure=True)
+    tmpdir.join('out/bin/run').chmod(0o755)
+    tmpdir.join('out/same').write('same')
+    tmpdir.join('out/changed').write('original')
+    tmpdir.join('out/dir/file').write('in a dir', ensure=True)
+    tmpdir.join('out/empty').mkdir()
+    tmpdir.join('out/link').mksymlinkto('same')
+    conf = simple_config._replace(output={'out'})
+    manifest = context.new_manifest(conf)
+    tmp = context.package_artifact(conf, manifest=manifest)
+    yield conf, tmp, manifest
+    os.remove(tmp)
+
+
+@pytest.mark.parametrize('jobs', (1, 4))
+def test_restore_artifact(restorable, tmpdir, jobs):
+    conf, tmp, manifest = restorable
+    conf = conf._replace(jobs=jobs)
+    same_inode = tmpdir.join('out/same').stat().ino
+
+    tmpdir.join('out/changed').remove()
+    os.mkfifo(tmpdir.join('out/changed').strpath)
+    tmpdir.join('out/bin/run').chmod(0o644)
+    tmpdir.join('out/stale').write('remove me')
+    tmpdir.join('out/empty').remove()
+    tmpdir.join('out/empty').write('now a file')
+    tmpdir.join('out/dir').remove()
+    tmpdir.join('out/dir').mksymlinkto('bin')
+    tmpdir.join('out/link').remove()
+    tmpdir.join('out/link').mksymlinkto('changed')
+
+    with open(tmp, 'rb') as f:
+        written = context.restore_artifact(conf, f, manifest)
+
+    assert tmpdir.join('out/changed').read() == 'original'
+    assert tmpdir.join('out/bin/run').stat().mode & 0o777 == 0o755
+    assert not tmpdir.join('out/stale').exists()
+    assert tmpdir.join('out/empty').isdir()
+    assert tmpdir.join('out/dir/file').read() == 'in a dir'
+    assert tmpdir.join('out/link').readlink() == 'same'
+    # Unchanged files aren't rewritten.
+    assert tmpdir.join('out/same').stat().ino == same_inode
+    # changed, empty, dir, dir/file, and link
+    assert written == 5
+
+
+def test_restore_artifact_into_empty_tree(restorable, tmpdir):
+    conf, tmp, manifest = restorable
+    tmpdir.join('out').remove()
+    context.extract_artifact(conf, tmp, manifest=manifest)
+    assert tmpdir.join('out/same').read() == 'same'
+    assert tmpdir.join('out/link').readlink() == 'same'
+
+
+def test_restore_artifact_uses_hash_cache(restorable, tmpdir):
+    conf, tmp, manifest = restorable
+    hash_cache = mock.Mock(algorithm='sha256')
+    hash_cache.file_context.return_value = context.FileContext('file', 'bad')
+    with open(tmp, 'rb') as f:
+        context.restore_artifact(conf, f, manifest, hash_cache=hash_cache)
+    hash_cache.file_context.assert_any_call('out/same', False)
+    assert tmpdir.join('out/same').read() == 'same'
+
+
+def test_restore_artifact_read_only_dir(restorable, simple_config, tmpdir):
+    conf, tmp, manifest = restorable
+    tmpdir.join('ro/file').write('hi', ensure=True)
+    tmpdir.join('ro').chmod(0o555)
+    conf = conf._replace(output={'ro'})
+    manifest = context.new_manifest(conf)
+    ro_tmp = context.package_artifact(conf, manifest=manifest)
+    try:
+        tmpdir.join('ro').chmod(0o755)
+        tmpdir.join('ro/file').write('changed')
+        tmpdir.join('ro').chmod(0o555)
+        with open(ro_tmp, 'rb') as f:
+            context.restore_artifact(conf, f, manifest)
+    finally:
+        os.remove(ro_tmp)
+    assert tmpdir.join('ro/file').read() == 'hi'
+    assert tmpdir.join('ro').stat().mode & 0o777 == 0o555
+    tmpdir.join('ro').chmod(0o755)
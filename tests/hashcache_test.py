@@ -0,0 +1,159 @@
+import json
+import os
+from unittest import mock
+
+import pytest
+
+import lazy_build
+from lazy_build import context
+from lazy_build import hashcache
+
+
+@pytest.fixture
+def index(tmpdir):
+    tmpdir.chdir()
+    return tmpdir.join('index.json')
+
+
+def backdate(path, seconds=60):
+    st = os.stat(path.strpath)
+    os.utime(
+        path.strpath,
+        ns=(st.st_atime_ns, st.st_mtime_ns - seconds * 10**9),
+    )
+
+
+def test_index_path(cache_dir, tmpdir):
+    tmpdir.chdir()
+    path = hashcache.index_path()
+    assert path.startswith(cache_dir.join('index').strpath + '/')
+    assert path.endswith('.json')
+
+
+def test_load_missing(index):
+    cache = hashcache.HashCache.load(index.strpath)
+    assert cache.entries == {}
+    assert cache.timestamp is None
+
+
+def test_load_corrupt(index):
+    index.write('{not json')
+    assert hashcache.HashCache.load(index.strpath).entries == {}
+
+
+def test_load_unreadable(tmpdir):
+    tmpdir.join('index').write('not a directory')
+    path = tmpdir.join('index', 'index.json').strpath
+    assert hashcache.HashCache.load(path).entries == {}
+
+
+@pytest.mark.parametrize('data', (
+    {'version': '0.0.1', 'algorithm': context.HASH_ALGORITHM},
+    {'version': lazy_build.__version__, 'algorithm': 'md5'},
+))
+def test_load_invalidated(index, data):
+    index.write(json.dumps(dict(data, entries={'a': [1, 2, 3, 4, 'x']})))
+    assert hashcache.HashCache.load(index.strpath).entries == {}
+
+
+def test_file_context_hit_and_miss(index, tmpdir):
+    tmpdir.join('a').write('foo')
+    backdate(tmpdir.join('a'))
+
+    cache = hashcache.HashCache.load(index.strpath)
+    assert cache.file_context('a') == context.FileContext(
+        'file', context.hash(b'foo'),
+    )
+    assert (cache.hits, cache.misses) == (0, 1)
+    cache.save()
+
+    cache = hashcache.HashCache.load(index.strpath)
+    assert cache.file_context('a') == context.FileContext(
+        'file', context.hash(b'foo'),
+    )
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_file_context_changed_file(index, tmpdir):
+    tmpdir.join('a').write('foo')
+    backdate(tmpdir.join('a'))
+    cache = hashcache.HashCache.load(index.strpath)
+    cache.file_context('a')
+    cache.save()
+
+    tmpdir.join('a').write('bar')
+    backdate(tmpdir.join('a'), seconds=30)
+    cache = hashcache.HashCache.load(index.strpath)
+    assert cache.file_context('a').content_hash == context.hash(b'bar')
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_file_context_racy_file(index, tmpdir):
+    """Files modified at or after the index was written must be re-hashed."""
+    tmpdir.join('a').write('foo')
+    backdate(tmpdir.join('a'), seconds=-60)
+    cache = hashcache.HashCache.load(index.strpath)
+    cache.file_context('a')
+    cache.save()
+
+    cache = hashcache.HashCache.load(index.strpath)
+    assert cache.file_context('a').content_hash == context.hash(b'foo')
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_save_prunes_deleted_files(index, tmpdir):
+    for name in ('a', 'b', 'c'):
+        tmpdir.join(name).write(name)
+    cache = hashcache.HashCache.load(index.strpath)
+    for name in ('a', 'b', 'c'):
+        cache.file_context(name)
+    cache.save()
+
+    # `b` isn't looked up (e.g. it's only in another config's context)
+    tmpdir.join('c').remove()
+    cache = hashcache.HashCache.load(index.strpath)
+    cache.file_context('a')
+    cache.save()
+    assert set(json.loads(index.read())['entries']) == {'a', 'b'}
+
+
+def test_file_context_algorithm(index, tmpdir):
+    tmpdir.join('a').write('foo')
+    backdate(tmpdir.join('a'))
+    cache = hashcache.HashCache.load(index.strpath, 'blake2b')
+    cache.file_context('a')
+    cache.save()
+
+    # Switching algorithms throws away the old entries.
+    assert hashcache.HashCache.load(index.strpath).entries == {}
+    cache = hashcache.HashCache.load(index.strpath, 'blake2b')
+    assert cache.file_context('a').content_hash == context.hash(
+        b'foo', 'blake2b',
+    )
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_file_context_symlink(index, tmpdir):
+    tmpdir.join('a').mksymlinkto('/etc/passwd')
+    cache = hashcache.HashCache.load(index.strpath)
+    expected = context.FileContext('link', context.hash(b'/etc/passwd'))
+    assert cache.file_context('a') == expected
+    # When the caller already knows it's a link, it isn't statted again.
+    with mock.patch.object(hashcache.os, 'lstat') as lstat:
+        assert cache.file_context('a', is_link=True) == expected
+    assert not lstat.called
+    assert cache.entries == {}
+
+
+def test_build_context_uses_cache(simple_config, index, tmpdir):
+    tmpdir.join('a').write('foo')
+    backdate(tmpdir.join('a'))
+    conf = simple_config._replace(context={'a'})
+
+    cache = hashcache.HashCache.load(index.strpath)
+    uncached = context.build_context(conf, cache)
+    cache.save()
+
+    cache = hashcache.HashCache.load(index.strpath)
+    assert context.build_context(conf, cache) == uncached
+    assert (cache.hits, cache.misses) == (1, 0)
@@ -1,17 +1,52 @@
 import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from unittest import mock
 
 import pytest
 
+import lazy_build
+from lazy_build import cache
+from lazy_build import config
+from lazy_build import context
+from lazy_build import hashcache
 from lazy_build import main
+from lazy_build import stamp
 
 
-@pytest.fixture
-def simple_project(tmpdir):
+@pytest.fixture(params=(
+    {'compression': 'none', 'streaming': False},
+    {'compression': 'gzip', 'streaming': False},
+    {'compression': 'gzip', 'streaming': True},
+    {'compression': 'gzip', 'streaming': False, 'local-cache': True},
+    {'compression': 'gzip', 'streaming': True, 'local-cache': True},
+    {'compression': 'gzip', 'streaming': False, 'chunking': True},
+    {'compression': 'gzip', 'streaming': True, 'chunking': True},
+    {'compression': 'gzip', 'streaming': False, 'delta-restore': True},
+    {'compression': 'gzip', 'streaming': True, 'delta-restore': True},
+    {'compression': 'gzip', 'streaming': True, 'chunking': True,
+     'delta-restore': True},
+))
+def simple_project(request, tmpdir):
+    cache = {
+        'source': 'filesystem',
+        'path': 'cache',
+        'compression': request.param['compression'],
+    }
+    if request.param.get('local-cache'):
+        cache = [
+            {'source': 'filesystem', 'path': 'local', 'max-size': 2**20},
+            cache,
+        ]
     tmpdir.join('.lazy-build.json').write(json.dumps({
-        'cache': {
-            'source': 'filesystem',
-            'path': 'cache',
-        },
+        'cache': cache,
+        'streaming': request.param['streaming'],
+        'chunking': request.param.get('chunking', False),
+        'delta-restore': request.param.get('delta-restore', False),
+        'stream-buffer-size': 1024,
     }))
     tmpdir.join('cache').mkdir()
     tmpdir.join('input').write('first input\n')
@@ -89,9 +124,485 @@ def test_after_download_works(simple_project, capfd):
     assert 'Uploading artifact to shared cache...' in lines
 
     # The second run should be.
+    simple_project.join('output1').remove()
     main.main(args)
     out, err = capfd.readouterr()
     assert out == 'it was downloaded\n'
     lines = err.splitlines()
     assert 'Found remote build artifact, downloading.' in lines
     assert 'Running after-download script...' in lines
+
+
+def test_delta_restore(tmpdir, capfd):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'delta-restore': True,
+    }))
+    tmpdir.join('input').write('input\n')
+    tmpdir.join('test.sh').write(
+        'cat input > output1\n'
+        'mkdir -p output2\n'
+        'echo asdf > output2/thing\n'
+    )
+    args = (
+        'build',
+        'context=', 'input',
+        'output=', 'output1', 'output2',
+        'command=', 'bash', 'test.sh',
+    )
+    with tmpdir.as_cwd():
+        main.main(args)
+        inode = tmpdir.join('output1').stat().ino
+        tmpdir.join('output2', 'thing').write('local changes')
+        tmpdir.join('output2', 'extra').write('stale')
+        main.main(args)
+
+    assert tmpdir.join('output1').stat().ino == inode
+    assert tmpdir.join('output2', 'thing').read() == 'asdf\n'
+    assert not tmpdir.join('output2', 'extra').exists()
+
+
+def test_delta_restore_without_manifest(tmpdir, capfd):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'delta-restore': True,
+    }))
+    tmpdir.join('input').write('input\n')
+    args = (
+        'build', '--verbose',
+        'context=', 'input',
+        'output=', 'output',
+        'command=', 'cp', 'input', 'output',
+    )
+    with tmpdir.as_cwd():
+        main.main(args)
+        # e.g. built by an older version
+        for path in tmpdir.join('cache').listdir('*-files.*'):
+            path.remove()
+        tmpdir.join('output').write('local changes')
+        capfd.readouterr()
+        main.main(args)
+
+    out, err = capfd.readouterr()
+    lines = err.splitlines()
+    assert 'No file manifest, falling back to full extraction.' in lines
+    assert tmpdir.join('output').read() == 'input\n'
+
+
+def test_hash_index_not_saved(tmpdir, capfd):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'delta-restore': True,
+        'targets': {
+            'output': {
+                'context': ['input'],
+                'output': ['output'],
+                'command': ['cp', 'input', 'output'],
+            },
+        },
+    }))
+    tmpdir.join('input').write('input\n')
+    error = PermissionError(13, 'Permission denied')
+    with tmpdir.as_cwd():
+        with mock.patch.object(hashcache.HashCache, 'save', side_effect=error):
+            main.main(('batch',))
+            tmpdir.join('output').remove()
+            main.main((
+                'build',
+                'context=', 'input',
+                'output=', 'output',
+                'command=', 'cp', 'input', 'output',
+            ))
+
+    out, err = capfd.readouterr()
+    lines = err.splitlines()
+    warning = (
+        'Warning: could not save the hash index: [Errno 13] Permission denied'
+    )
+    # Once after hashing each time, and once after the delta restore.
+    assert lines.count(warning) == 3
+    assert tmpdir.join('output').read() == 'input\n'
+
+
+def test_unwritable_cache_dir(tmpdir, cache_dir, capfd):
+    # e.g. a CI runner with a read-only home directory
+    cache_dir.dirpath().remove()
+    cache_dir.dirpath().write('not a directory')
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+    }))
+    tmpdir.join('input').write('input\n')
+    with tmpdir.as_cwd():
+        main.main((
+            'build',
+            'context=', 'input',
+            'output=', 'output',
+            'command=', 'cp', 'input', 'output',
+        ))
+
+    out, err = capfd.readouterr()
+    warnings = [
+        line.split(': [Errno')[0] for line in err.splitlines()
+        if line.startswith('Warning: ')
+    ]
+    assert warnings == [
+        'Warning: could not save the hash index',
+        'Warning: could not write the stamp',
+    ]
+    assert tmpdir.join('output').read() == 'input\n'
+
+
+def test_filesystem_backend_does_not_import_boto3(simple_project):
+    script = (
+        'import sys\n'
+        'from lazy_build import main\n'
+        'main.main(sys.argv[1:])\n'
+        'print(sorted(\n'
+        '    name for name in sys.modules\n'
+        '    if name.split(".")[0] in ("boto3", "botocore")\n'
+        '))\n'
+    )
+    root = os.path.dirname(os.path.dirname(lazy_build.__file__))
+    env = dict(os.environ, PYTHONPATH=root)
+    for _ in range(2):
+        out = subprocess.check_output(
+            (
+                sys.executable, '-c', script,
+                'build',
+                'context=', 'input',
+                'output=', 'output1', 'output2',
+                'command=', 'bash', 'test.sh',
+            ),
+            env=env,
+        )
+        assert out.decode('UTF-8').splitlines()[-1] == '[]'
+
+
+def _span_names(path):
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    return {event['name']: event['args'] for event in events}
+
+
+def test_trace(simple_project, capfd):
+    args = (
+        'context=', 'input',
+        'output=', 'output1', 'output2',
+        'command=', 'bash', 'test.sh',
+    )
+    main.main(('--trace=build.json', 'build') + args)
+    spans = _span_names('build.json')
+    assert spans['hash context']['files'] == 1
+    assert spans['lookup'] == {'found': False}
+    assert spans['build']['hash']
+    assert 'command' in spans
+    upload = spans.get('upload') or spans['package and upload']
+    assert upload['bytes'] > 0
+
+    simple_project.join('output1').remove()
+    main.main(('--trace=restore.json', '--profile=prof', 'build') + args)
+    spans = _span_names('restore.json')
+    assert spans['lookup'] == {'found': True}
+    assert 'restore' in spans
+    download = spans.get('download') or spans['download and extract']
+    assert download['bytes'] > 0
+    assert simple_project.join('prof').listdir()
+
+
+def test_up_to_date_outputs_skip_backend(simple_project, capfd):
+    args = (
+        'build',
+        'context=', 'input',
+        'output=', 'output1', 'output2',
+        'command=', 'bash', 'test.sh',
+    )
+    main.main(args)
+    capfd.readouterr()
+
+    # Make sure the stamp isn't considered racy.
+    conf = config.Config.from_args(args)
+    os.utime(stamp.stamp_path(conf), (2**32, 2**32))
+
+    with mock.patch.object(
+            type(conf.backend), 'artifact_details',
+    ) as artifact_details:
+        main.main(args)
+    assert not artifact_details.called
+    out, err = capfd.readouterr()
+    assert out == ''
+    assert 'Outputs are already up to date.' in err.splitlines()
+
+    # Touching an output means it's no longer known to be up to date.
+    simple_project.join('output1').write('changed')
+    main.main(args)
+    out, err = capfd.readouterr()
+    assert 'Found remote build artifact, downloading.' in err.splitlines()
+    assert simple_project.join('output1').read() == 'first input\n'
+
+
+@pytest.fixture
+def batch_project(tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'targets': {
+            'one': {
+                'context': ['input1', 'shared'],
+                'output': ['output1'],
+                'command': ['bash', '-c', 'cat input1 shared > output1'],
+            },
+            'two': {
+                'context': ['input2', 'shared'],
+                'output': ['output2'],
+                'command': ['bash', '-c', 'cat input2 shared > output2'],
+            },
+        },
+    }))
+    tmpdir.join('input1').write('one\n')
+    tmpdir.join('input2').write('two\n')
+    tmpdir.join('shared').write('shared\n')
+    with tmpdir.as_cwd():
+        yield tmpdir
+
+
+def test_batch(batch_project, capfd):
+    assert main.main(('batch',)) is None
+    out, err = capfd.readouterr()
+    assert batch_project.join('output1').read() == 'one\nshared\n'
+    assert batch_project.join('output2').read() == 'two\nshared\n'
+    lines = err.splitlines()
+    assert 'one: Found no remote build artifact, building locally.' in lines
+    assert 'two: Found no remote build artifact, building locally.' in lines
+
+    # Only the changed target is rebuilt; the other is restored.
+    batch_project.join('output1').remove()
+    batch_project.join('output2').remove()
+    batch_project.join('input2').write('changed\n')
+    main.main(('batch',))
+    out, err = capfd.readouterr()
+    lines = err.splitlines()
+    assert 'one: Found remote build artifact, downloading.' in lines
+    assert 'two: Found no remote build artifact, building locally.' in lines
+    assert batch_project.join('output1').read() == 'one\nshared\n'
+    assert batch_project.join('output2').read() == 'changed\nshared\n'
+
+
+def test_batch_up_to_date(batch_project, capfd):
+    main.main(('batch',))
+    # Make sure the stamps aren't considered racy.
+    conf = config.Config.from_args(('batch',))
+    for target in conf.targets:
+        os.utime(
+            stamp.stamp_path(conf.for_target(target)), (2**32, 2**32),
+        )
+    capfd.readouterr()
+
+    main.main(('batch', '--verbose'))
+    out, err = capfd.readouterr()
+    lines = err.splitlines()
+    for name in ('one', 'two'):
+        assert any(
+            line.startswith(f'Target {name} has context hash ')
+            for line in lines
+        )
+        assert f'{name}: outputs are already up to date.' in lines
+
+
+def test_batch_failure(batch_project, capfd):
+    # The command can't write to a directory.
+    batch_project.join('output1').mkdir()
+    assert main.main(('batch',)) == 1
+    out, err = capfd.readouterr()
+    assert 'Failed targets: one' in err.splitlines()
+    assert batch_project.join('output2').read() == 'two\nshared\n'
+
+
+@pytest.fixture
+def graph_project(tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'ignore': ['/cache', '/app', '/log', '/.lazy-build.json'],
+        'targets': {
+            'gen': {
+                'context': ['schema'],
+                'output': ['gen'],
+                'command': [
+                    'bash', '-c',
+                    'echo gen >> log; mkdir -p gen; cp schema gen/code',
+                ],
+            },
+            'app': {
+                'context': ['.'],
+                'output': ['app'],
+                'command': [
+                    'bash', '-c', 'echo app >> log; cat gen/code main > app',
+                ],
+                'deps': ['gen'],
+            },
+        },
+    }))
+    tmpdir.join('schema').write('schema v1\n')
+    tmpdir.join('main').write('main\n')
+    with tmpdir.as_cwd():
+        yield tmpdir
+
+
+def test_batch_dependencies(graph_project, capfd):
+    main.main(('batch', 'targets=', 'app'))
+    assert graph_project.join('log').read() == 'gen\napp\n'
+    assert graph_project.join('app').read() == 'schema v1\nmain\n'
+
+    # Changing the upstream input changes the downstream hash too, even
+    # though gen's outputs aren't part of app's context.
+    graph_project.join('log').remove()
+    graph_project.join('schema').write('schema v2\n')
+    main.main(('batch',))
+    assert graph_project.join('log').read() == 'gen\napp\n'
+    assert graph_project.join('app').read() == 'schema v2\nmain\n'
+
+    # Going back to the old schema restores both from the cache.
+    graph_project.join('log').remove()
+    graph_project.join('schema').write('schema v1\n')
+    main.main(('batch',))
+    assert not graph_project.join('log').exists()
+    assert graph_project.join('app').read() == 'schema v1\nmain\n'
+
+
+def test_batch_dependency_failure(graph_project, capfd):
+    graph_project.join('gen').write('not a directory')
+    assert main.main(('batch',)) == 1
+    out, err = capfd.readouterr()
+    lines = err.splitlines()
+    assert 'app: skipped, since gen failed' in lines
+    assert 'Failed targets: gen, app' in lines
+    assert not graph_project.join('app').exists()
+
+
+@pytest.fixture
+def single_flight_project(tmpdir):
+    tmpdir.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'single-flight': 5,
+    }))
+    tmpdir.join('input').write('input\n')
+    tmpdir.join('test.sh').write('echo ohai\ncat input > output\n')
+    with tmpdir.as_cwd():
+        with mock.patch.object(main, 'POLL_INTERVAL', 0.01):
+            yield tmpdir
+
+
+SINGLE_FLIGHT_ARGS = (
+    'build',
+    'context=', 'input',
+    'output=', 'output',
+    'command=', 'bash', 'test.sh',
+)
+
+
+def _hold_lease(seconds, before_release=lambda: None):
+    """Hold the lease like another job would, in the background."""
+    conf = config.Config.from_args(SINGLE_FLIGHT_ARGS)
+    ctx = context.build_context(conf)
+    lease = conf.backend.acquire_lease(ctx)
+    assert lease is not None
+
+    def release():
+        time.sleep(seconds)
+        before_release()
+        lease.release()
+
+    thread = threading.Thread(target=release)
+    thread.start()
+    return thread
+
+
+def test_single_flight_waits_for_other_job(single_flight_project, capfd):
+    # Build the artifact, then hide it until the "other job" finishes.
+    main.main(SINGLE_FLIGHT_ARGS)
+    cache_dir = single_flight_project.join('cache')
+    hidden = single_flight_project.join('hidden')
+    cache_dir.move(hidden)
+    single_flight_project.join('output').remove()
+    capfd.readouterr()
+
+    def finish_build():
+        for path in hidden.listdir():
+            path.move(cache_dir.join(path.basename))
+
+    thread = _hold_lease(0.1, finish_build)
+    main.main(SINGLE_FLIGHT_ARGS)
+    thread.join()
+
+    out, err = capfd.readouterr()
+    assert out == ''
+    lines = err.splitlines()
+    assert 'Another job is building this artifact, waiting for it...' in lines
+    assert 'Found remote build artifact, downloading.' in lines
+    assert single_flight_project.join('output').read() == 'input\n'
+
+
+def test_single_flight_takes_over_from_failed_job(
+        single_flight_project, capfd,
+):
+    thread = _hold_lease(0.1)
+    main.main(SINGLE_FLIGHT_ARGS)
+    thread.join()
+
+    out, err = capfd.readouterr()
+    assert out == 'ohai\n'
+    lines = err.splitlines()
+    assert 'Another job is building this artifact, waiting for it...' in lines
+    assert 'Found no remote build artifact, building locally.' in lines
+    # The lease is released once the artifact is uploaded.
+    assert single_flight_project.join('cache').listdir('*.lock') == []
+
+
+def test_single_flight_gives_up_waiting(single_flight_project, capfd):
+    single_flight_project.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'single-flight': 0.05,
+    }))
+    thread = _hold_lease(0.3)
+    main.main(SINGLE_FLIGHT_ARGS)
+    thread.join()
+
+    out, err = capfd.readouterr()
+    assert out == 'ohai\n'
+    lines = err.splitlines()
+    assert 'Gave up waiting for the other job after 0.05 seconds.' in lines
+
+
+def test_single_flight_rechecks_past_negative_cache(
+        single_flight_project, capfd,
+):
+    single_flight_project.join('.lazy-build.json').write(json.dumps({
+        'cache': {'source': 'filesystem', 'path': 'cache'},
+        'single-flight': 5,
+        'negative-cache-ttl': 60,
+    }))
+    main.main(SINGLE_FLIGHT_ARGS)
+    cache_dir = single_flight_project.join('cache')
+    hidden = single_flight_project.join('hidden')
+    cache_dir.move(hidden)
+    single_flight_project.join('output').remove()
+    capfd.readouterr()
+
+    # Another job uploads the artifact between our lookup (which records a
+    # miss) and our taking the lease.
+    acquire_lease = cache.FilesystemBackend.acquire_lease
+
+    def finish_build_then_acquire(self, ctx):
+        cache_dir.ensure(dir=True)
+        for path in hidden.listdir():
+            path.move(cache_dir.join(path.basename))
+        return acquire_lease(self, ctx)
+
+    with mock.patch.object(
+            cache.FilesystemBackend, 'acquire_lease',
+            finish_build_then_acquire,
+    ):
+        main.main(SINGLE_FLIGHT_ARGS)
+
+    out, err = capfd.readouterr()
+    assert out == ''
+    assert 'Found remote build artifact, downloading.' in err.splitlines()
+    assert cache_dir.listdir('*.lock') == []
@@ -1,5 +1,7 @@
 import contextlib
 import sys
+import threading
+import time
 from unittest import mock
 
 import pytest
@@ -21,8 +23,8 @@ def terminal_width(width):
 
 
 @contextlib.contextmanager
-def mock_time(t):
-    with mock.patch.object(progressbar.time, 'time', return_value=t):
+def mock_monotonic(t):
+    with mock.patch.object(progressbar.time, 'monotonic', return_value=t):
         yield
 
 
@@ -52,6 +54,10 @@ def test_best_unit(b, expected):
         2000 * ONE_MB, 2000 * ONE_MB, 25000 * ONE_MB, 40,
         '\r[===========>] 2.0GB / 2.0GB |  24.4GB/s',
     ),
+    (
+        0, 0, 0, 40,
+        '\r[===========>] 0.0B  / 0.0B  |   0.0B /s',
+    ),
 
     # window too small
     (
@@ -67,6 +73,13 @@ def test_progressbar(cur, total, speed, width, expected):
         ) == expected
 
 
+def test_progressbar_unknown_total():
+    assert progressbar.progressbar(
+        300 * ONE_MB, None, 1.5 * ONE_MB,
+        file=mock.Mock(**{'isatty.return_value': True}),
+    ) == '\r300.0MB | 1.5MB/s'
+
+
 def test_progressbar_not_a_tty():
     with terminal_width(80):
         assert progressbar.progressbar(
@@ -75,24 +88,146 @@ def test_progressbar_not_a_tty():
         ) == ''
 
 
-def test_progress_manager(capsys):
+def test_progressbar_label():
+    with terminal_width(46):
+        assert progressbar.progressbar(
+            0, 1, 0,
+            file=mock.Mock(**{'isatty.return_value': True}),
+            label='venv',
+        ) == '\rvenv: [>           ] 0.0B  / 1.0B  |   0.0B /s'
+
+
+@contextlib.contextmanager
+def tty():
     with terminal_width(40):
         with mock.patch.object(sys.stderr, 'isatty', return_value=True):
-            with progressbar.Progress(5 * ONE_MB) as pb:
-                with mock_time(100):
-                    pb(0)
-                with mock_time(101):
-                    pb(10)
-                with mock_time(107):
-                    pb(ONE_MB)
-                with mock_time(108):
-                    pb(4 * ONE_MB)
-
-    out, err = capsys.readouterr()
-    assert err == (
-        '\r[>           ] 0.0MB / 5.0MB |   0.0B /s'
-        '\r[>           ] 0.0MB / 5.0MB |  10.0B /s'
-        '\r[==>         ] 1.0MB / 5.0MB | 146.3KB/s'
-        '\r[===========>] 5.0MB / 5.0MB |   4.0MB/s'
-        '\n'
+            yield
+
+
+@pytest.fixture
+def renderer():
+    # Long enough that the background thread never draws during a test.
+    return progressbar.Renderer(interval=3600)
+
+
+def test_progress_counts_bytes(renderer):
+    with progressbar.Progress(None, renderer=renderer) as pb:
+        pb(10)
+        pb(5)
+    assert pb.so_far == 15
+
+
+def test_progress_not_a_tty(capsys, renderer):
+    with mock.patch.object(sys.stderr, 'isatty', return_value=False):
+        with progressbar.Progress(5, renderer=renderer) as pb:
+            pb(5)
+            renderer.tick()
+    assert renderer._thread is None
+    assert capsys.readouterr().err == ''
+
+
+def test_progress_empty_transfer(capsys, renderer):
+    with tty():
+        with progressbar.Progress(0, renderer=renderer):
+            pass
+    assert capsys.readouterr().err.endswith(
+        '[===========>] 0.0B  / 0.0B  |   0.0B /s\n',
+    )
+
+
+def test_progress_draws_on_ticks(capsys, renderer):
+    with tty():
+        with mock_monotonic(100):
+            pb = progressbar.Progress(5 * ONE_MB, renderer=renderer)
+            pb.__enter__()
+        pb(10)
+        # Callbacks alone don't draw anything.
+        assert capsys.readouterr().err == (
+            '[>           ] 0.0MB / 5.0MB |   0.0B /s'
+        )
+        with mock_monotonic(101):
+            renderer.tick()
+        pb(ONE_MB)
+        with mock_monotonic(107):
+            renderer.tick()
+        pb(4 * ONE_MB - 10)
+        with mock_monotonic(108):
+            pb.__exit__(None, None, None)
+
+    assert capsys.readouterr().err == (
+        '\r\x1b[J[>           ] 0.0MB / 5.0MB |  10.0B /s'
+        '\r\x1b[J[==>         ] 1.0MB / 5.0MB | 146.3KB/s'
+        '\r\x1b[J[===========>] 5.0MB / 5.0MB |   4.0MB/s\n'
     )
+    assert renderer._thread is None
+
+
+def test_progress_speed_window(renderer):
+    pb = progressbar.Progress(None, renderer=renderer)
+    for t in range(100):
+        pb(t)
+        pb.sample(t)
+    # Only the last SPEED_WINDOW seconds are kept, and count towards the speed.
+    assert [t for t, _ in pb.samples] == [94, 95, 96, 97, 98, 99]
+    assert pb.speed == sum(range(94, 100)) / 6
+
+
+def test_multiple_bars(capsys, renderer):
+    with tty(), mock_monotonic(100):
+        with progressbar.Progress(2, 'a', renderer=renderer) as a:
+            with progressbar.Progress(2, 'b', renderer=renderer) as b:
+                a(2)
+                capsys.readouterr()
+                renderer.tick()
+                assert capsys.readouterr().err == (
+                    '\x1b[1A\r\x1b[J'
+                    'a: [========>] 2.0B  / 2.0B  |   0.0B /s\n'
+                    'b: [>        ] 0.0B  / 2.0B  |   0.0B /s'
+                )
+            # Finished bars stay above the ones still running.
+            assert capsys.readouterr().err == (
+                '\x1b[1A\r\x1b[J'
+                'b: [>        ] 0.0B  / 2.0B  |   0.0B /s\n'
+                'a: [========>] 2.0B  / 2.0B  |   0.0B /s'
+            )
+            b(2)
+    assert capsys.readouterr().err == (
+        '\r\x1b[Ja: [========>] 2.0B  / 2.0B  |   0.0B /s\n'
+    )
+
+
+def test_write_above_bars(capsys, renderer):
+    with tty(), mock_monotonic(100):
+        renderer.write('before\n')
+        with progressbar.Progress(2, 'a', renderer=renderer):
+            renderer.write('Extracting...')
+        renderer.write('done\n')
+    assert capsys.readouterr().err == (
+        'before\n'
+        'a: [>        ] 0.0B  / 2.0B  |   0.0B /s'
+        '\r\x1b[JExtracting...\n'
+        'a: [>        ] 0.0B  / 2.0B  |   0.0B /s'
+        '\r\x1b[Ja: [>        ] 0.0B  / 2.0B  |   0.0B /s\n'
+        'done\n'
+    )
+
+
+def test_write_from_threads(capsys, renderer):
+    renderer.write('Extracting... ')
+    thread = threading.Thread(target=renderer.write, args=('two: hi\n',))
+    thread.start()
+    thread.join()
+    renderer.write('done!\n')
+    assert capsys.readouterr().err == 'Extracting... \ntwo: hi\ndone!\n'
+
+
+def test_background_redraws(capsys):
+    renderer = progressbar.Renderer(interval=0.001)
+    with tty():
+        with progressbar.Progress(10, renderer=renderer) as pb:
+            thread = renderer._thread
+            pb(5)
+            while '5.0B' not in capsys.readouterr().err:
+                time.sleep(0.001)
+    assert not thread.is_alive()
+    assert renderer._thread is None
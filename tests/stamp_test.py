@@ -0,0 +1,85 @@
+import json
+import os
+from unittest import mock
+
+import pytest
+
+from lazy_build import stamp
+
+
+@pytest.fixture
+def conf(simple_config, tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('out/a').write('hello', ensure=True)
+    return simple_config._replace(output={'out', 'missing'})
+
+
+def settle(conf):
+    """Move the stamp into the future, so it's not racy."""
+    os.utime(stamp.stamp_path(conf), (2**32, 2**32))
+
+
+def test_stamp_path(cache_dir, conf):
+    path = stamp.stamp_path(conf)
+    assert path.startswith(cache_dir.join('stamps').strpath + '/')
+    assert path != stamp.stamp_path(conf._replace(output={'out'}))
+
+
+def test_is_current_without_stamp(conf):
+    assert not stamp.is_current(conf, mock.Mock(hash='my-hash'))
+
+
+def test_is_current(conf):
+    ctx = mock.Mock(hash='my-hash')
+    stamp.write(conf, ctx)
+    settle(conf)
+    assert stamp.is_current(conf, ctx)
+    assert not stamp.is_current(conf, mock.Mock(hash='other-hash'))
+
+
+@pytest.mark.parametrize('change', (
+    lambda tmpdir: tmpdir.join('out/a').write('world'),
+    lambda tmpdir: tmpdir.join('out/b').write(''),
+    lambda tmpdir: tmpdir.join('out/a').remove(),
+    lambda tmpdir: tmpdir.join('out/a').chmod(0o600),
+    lambda tmpdir: tmpdir.join('missing').write(''),
+))
+def test_is_current_outputs_changed(conf, tmpdir, change):
+    ctx = mock.Mock(hash='my-hash')
+    stamp.write(conf, ctx)
+    change(tmpdir)
+    settle(conf)
+    assert not stamp.is_current(conf, ctx)
+
+
+def test_is_current_racy(conf, tmpdir):
+    ctx = mock.Mock(hash='my-hash')
+    stamp.write(conf, ctx)
+    st = os.stat(stamp.stamp_path(conf))
+    os.utime(
+        tmpdir.join('out/a').strpath,
+        ns=(st.st_atime_ns, st.st_mtime_ns + 1),
+    )
+    stamp.write(conf, ctx)
+    os.utime(stamp.stamp_path(conf), ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert not stamp.is_current(conf, ctx)
+
+
+def test_is_current_other_version(conf):
+    ctx = mock.Mock(hash='my-hash')
+    stamp.write(conf, ctx)
+    with open(stamp.stamp_path(conf)) as f:
+        data = json.load(f)
+    data['version'] = '0.0.1'
+    with open(stamp.stamp_path(conf), 'w') as f:
+        json.dump(data, f)
+    settle(conf)
+    assert not stamp.is_current(conf, ctx)
+
+
+def test_is_current_corrupt(conf):
+    ctx = mock.Mock(hash='my-hash')
+    stamp.write(conf, ctx)
+    with open(stamp.stamp_path(conf), 'w') as f:
+        f.write('{not json')
+    assert not stamp.is_current(conf, ctx)
@@ -0,0 +1,84 @@
+import json
+import pstats
+
+import pytest
+
+from lazy_build import trace
+
+
+def test_span_records_event():
+    tracer = trace.Tracer()
+    with tracer.span('download', bytes=5) as args:
+        args['files'] = 2
+    event, = tracer.events
+    assert event['name'] == 'download'
+    assert event['ph'] == 'X'
+    assert event['dur'] >= 0
+    assert event['args'] == {'bytes': 5, 'files': 2}
+
+
+def test_span_records_event_on_failure():
+    tracer = trace.Tracer()
+    with pytest.raises(ValueError):
+        with tracer.span('command'):
+            raise ValueError()
+    assert [event['name'] for event in tracer.events] == ['command']
+
+
+def test_nested_spans():
+    tracer = trace.Tracer()
+    with tracer.span('build'):
+        with tracer.span('command'):
+            pass
+    inner, outer = tracer.events
+    assert (inner['name'], outer['name']) == ('command', 'build')
+    assert outer['ts'] <= inner['ts']
+    assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+
+
+def test_profile_per_phase(tmpdir):
+    tracer = trace.Tracer(profile_dir=tmpdir.join('prof').strpath)
+    with tracer.span('build', profile=False):
+        with tracer.span('Hash context'):
+            # Spans inside a profiled span are part of its profile.
+            with tracer.span('inner'):
+                sorted(range(10))
+        with tracer.span('upload'):
+            pass
+    names = sorted(p.basename for p in tmpdir.join('prof').listdir())
+    assert names == ['001-hash-context.prof', '002-upload.prof']
+    stats = pstats.Stats(tmpdir.join('prof', names[0]).strpath)
+    functions = {func[2] for func in stats.stats}
+    assert '<built-in method builtins.sorted>' in functions
+
+
+def test_span_without_tracer():
+    with trace.span('download', bytes=5) as args:
+        args['files'] = 1
+    assert args == {'bytes': 5, 'files': 1}
+
+
+def test_tracing_writes_trace(tmpdir):
+    path = tmpdir.join('trace.json')
+    with pytest.raises(ValueError):
+        with trace.tracing(path.strpath):
+            with trace.span('command'):
+                pass
+            raise ValueError()
+    assert trace._tracer is None
+    data = json.loads(path.read())
+    assert [event['name'] for event in data['traceEvents']] == ['command']
+
+
+def test_tracing_profile_only(tmpdir):
+    with trace.tracing(profile_dir=tmpdir.join('prof').strpath):
+        with trace.span('command'):
+            pass
+    assert trace._tracer is None
+    assert [p.basename for p in tmpdir.listdir()] == ['prof']
+    assert tmpdir.join('prof', '001-command.prof').exists()
+
+
+def test_tracing_disabled():
+    with trace.tracing():
+        assert trace._tracer is None
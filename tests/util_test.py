@@ -1,3 +1,8 @@
+import errno
+import io
+import threading
+from unittest import mock
+
 import pytest
 
 from lazy_build import util
@@ -20,3 +25,154 @@ def test_atomic_write_exception(tmpdir):
             f.flush()
             raise ValueError('sorry buddy')
     assert a.read() == 'sup'
+
+
+def test_copyfile(tmpdir):
+    tmpdir.join('src').write('hello world')
+    callback = mock.Mock()
+    with open(tmpdir.join('src').strpath, 'rb') as src:
+        src.read(6)
+        with open(tmpdir.join('dest').strpath, 'wb') as dest:
+            dest.write(b'>')
+            util.copyfile(src, dest, callback)
+        assert src.tell() == 11
+    assert tmpdir.join('dest').read() == '>world'
+    callback.assert_called_once_with(5)
+
+
+@pytest.mark.parametrize('err', (errno.EXDEV, errno.ENOSYS))
+def test_copyfile_falls_back(tmpdir, err):
+    tmpdir.join('src').write('hello world')
+    dest = io.BytesIO()
+    callback = mock.Mock()
+    with mock.patch.object(
+            util.os, 'copy_file_range', side_effect=OSError(err, 'nope'),
+            create=True,
+    ):
+        with open(tmpdir.join('src').strpath, 'rb') as src:
+            dest.fileno = lambda: 1
+            util.copyfile(src, dest, callback)
+    assert dest.getvalue() == b'hello world'
+    callback.assert_called_once_with(11)
+
+
+def test_copyfile_error(tmpdir):
+    tmpdir.join('src').write('hello world')
+    with mock.patch.object(
+            util.os, 'copy_file_range', side_effect=OSError(errno.EIO, 'no'),
+            create=True,
+    ):
+        with open(tmpdir.join('src').strpath, 'rb') as src:
+            with open(tmpdir.join('dest').strpath, 'wb') as dest:
+                with pytest.raises(OSError):
+                    util.copyfile(src, dest, mock.Mock())
+
+
+def test_pipe_read_sizes():
+    pipe = util.Pipe(max_size=100)
+    pipe.write(b'hello')
+    pipe.write(memoryview(b' world'))
+    pipe.close()
+    assert pipe.read(3) == b'hel'
+    assert pipe.read(4) == b'lo w'
+    assert pipe.read() == b'orld'
+    assert pipe.read() == b''
+
+
+def test_pipe_is_a_stream():
+    pipe = util.Pipe(max_size=100)
+    assert pipe.readable()
+    assert pipe.writable()
+    assert not pipe.seekable()
+
+
+def test_pipe_empty_write_is_not_eof():
+    pipe = util.Pipe(max_size=100)
+    pipe.write(b'')
+    pipe.write(b'hi')
+    assert pipe.read(10) == b'hi'
+
+
+def test_pipe_is_bounded():
+    pipe = util.Pipe(max_size=10)
+    pipe.write(b'x' * 10)
+    blocked = threading.Thread(target=pipe.write, args=(b'y',))
+    blocked.start()
+    blocked.join(0.05)
+    assert blocked.is_alive()
+
+    assert pipe.read(5) == b'x' * 5
+    blocked.join()
+    pipe.close()
+    assert pipe.read() == b'x' * 5 + b'y'
+
+
+def test_pipe_close_with_error():
+    pipe = util.Pipe(max_size=10)
+    pipe.close(ValueError('sorry buddy'))
+    with pytest.raises(ValueError):
+        pipe.read()
+
+
+def test_pipe_abort():
+    pipe = util.Pipe(max_size=1)
+    pipe.abort()
+    with pytest.raises(BrokenPipeError):
+        pipe.write(b'hi')
+
+
+def test_pipeline():
+    def producer(f):
+        for i in range(100):
+            f.write(str(i).encode() * 100)
+
+    def consumer(f):
+        return f.read(50)
+
+    # The consumer stops early; the rest should be drained for the producer.
+    assert util.pipeline(producer, consumer, max_size=10) == b'0' * 50
+
+
+def test_pipeline_producer_error():
+    def producer(f):
+        f.write(b'hi')
+        raise ValueError('sorry buddy')
+
+    with pytest.raises(ValueError):
+        util.pipeline(producer, lambda f: f.read(), max_size=10)
+
+
+def test_pipeline_producer_error_not_swallowed():
+    def producer(f):
+        f.write(b'hi')
+        raise ValueError('sorry buddy')
+
+    def consumer(f):
+        # e.g. a download failing after the consumer has all it needs
+        return f.read(2)
+
+    with pytest.raises(ValueError):
+        util.pipeline(producer, consumer, max_size=10)
+
+
+def test_pipeline_consumer_error():
+    def producer(f):
+        while True:
+            f.write(b'hi')
+
+    def consumer(f):
+        f.read(1)
+        raise ValueError('sorry buddy')
+
+    with pytest.raises(ValueError):
+        util.pipeline(producer, consumer, max_size=10)
+
+
+def test_pwrite(tmpdir):
+    path = tmpdir.join('f')
+    path.write_binary(b'.' * 8)
+    with open(path.strpath, 'r+b') as f:
+        util.pwrite(f.fileno(), b'ab', 6)
+        util.pwrite(f.fileno(), b'cd', 0)
+        assert f.tell() == 0
+    assert path.read_binary() == b'cd....ab'